@@ -28,6 +28,52 @@ def create_app():
         from app.models import User
         return User.query.get(int(user_id))
 
+    # Метрики запросов (SQL, шаблоны, Server-Timing) и контроль бюджета SQL-запросов
+    from app.utilities import instrumentation
+    instrumentation.init_app(app)
+
+    # Миграции схемы (flask migrate ...)
+    from app.utilities import migrations
+    migrations.init_app(app)
+
+    # Сборка sitemap в файлы (flask sitemap build)
+    from app.utilities import sitemaps
+    sitemaps.init_app(app)
+
+    # Импорт и экспорт каталога (flask catalog ...)
+    from app.utilities import catalog_io
+    catalog_io.init_app(app)
+
+    # Фоновая обработка загруженных изображений (flask images ...)
+    from app.utilities.images import image_pipeline
+    image_pipeline.init_app(app)
+
+    # Производные изображений по запросу (/img/<preset>/...)
+    from app.utilities import image_cache
+    image_cache.init_app(app)
+
+    # Поисковый индекс товаров
+    from app.utilities.search import search_index
+    search_index.init_app(app)
+
+    # Кэш страниц для анонимных посетителей (PAGE_CACHE_URL)
+    from app.utilities.page_cache import page_cache
+    page_cache.init_app(app)
+
+    # ETag/Last-Modified и ответы 304 (хук регистрируется после кэша страниц, чтобы
+    # выполниться раньше него и сохранить валидаторы вместе со страницей)
+    from app.utilities import http_cache
+    http_cache.init_app(app)
+
+    # Индекс автоподсказок строится в фоне, чтобы не задерживать старт воркера
+    if app.config.get('AUTOCOMPLETE_PRELOAD'):
+        from app.utilities.autocomplete import warm_up
+        warm_up(app)
+
+    # Тег {% cache %} для фрагментов шаблонов (FRAGMENT_CACHE_URL)
+    from app.utilities import fragment_cache
+    fragment_cache.init_app(app)
+
     # Добавляем функции в контекст Jinja2
     from app.utilities.template_utils import template_functions
     @app.context_processor
@@ -42,6 +88,7 @@ def create_app():
     from app.profile_routes import profile
     from app.sitemap_routes import sitemap
     from app.robots_routes import robots
+    from app.image_routes import images
 
     app.register_blueprint(main)
     app.register_blueprint(auth)
@@ -50,5 +97,6 @@ def create_app():
     app.register_blueprint(profile)
     app.register_blueprint(sitemap)
     app.register_blueprint(robots)
+    app.register_blueprint(images)
 
     return app
\ No newline at end of file
@@ -1,17 +1,29 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app
+from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app, jsonify, abort, \
+    stream_with_context
 from flask_login import login_required, current_user
 from app import db
-from app.models import User, Product, Category, Brand, Country, News, Setting, SeoMeta
+from app.models import User, Product, Category, Brand, Country, News, Setting, SeoMeta, load_options
 from app.forms.product_forms import ProductForm
-from app.utilities.helpers import transliterate, generate_slug, save_product_image, save_brand_image, \
-    save_category_image, save_news_image
+from app.utilities.helpers import transliterate, generate_slug
+from app.utilities.images import queue_image, image_jobs_for, retry_job
 from app.utilities.template_utils import get_site_setting, get_seo_meta
-import os
+from app.utilities.pagination import KeysetOrder, paginate_query
+from app.utilities.category_tree import product_counts
+from app.utilities.instrumentation import query_budget, metrics, slow_queries
+from app.utilities.fragment_cache import fragment_metrics
+import re
 from PIL import Image
 import uuid
 
 admin = Blueprint('admin', __name__)
 
+# Порядок списков админки для постраничного вывода
+USER_ORDER = KeysetOrder('id', User.id)
+PRODUCT_ORDER = KeysetOrder('id', Product.id)
+
+# Сколько медленных запросов показывать на дашборде
+DASHBOARD_SLOW_QUERIES = 20
+
 
 def admin_required(func):
     """Декоратор для проверки прав администратора"""
@@ -29,6 +41,13 @@ def admin_required(func):
     return decorated_view
 
 
+def split_numbers(value):
+    """Разбивает введенный список номеров (через запятую, точку с запятой или перенос строки)"""
+    if not value:
+        return []
+    return [number for number in re.split(r'[,;\n]+', value) if number.strip()]
+
+
 # === Дашборд админки ===
 @admin.route('/admin')
 @admin_required
@@ -40,15 +59,17 @@ def dashboard():
         'categories_count': Category.query.count(),
         'news_count': News.query.count()
     }
-    return render_template('admin/dashboard.html', stats=stats)
+    # Последние медленные SQL-запросы этого воркера (при включенном SLOW_QUERY_MS)
+    return render_template('admin/dashboard.html', stats=stats,
+                           slow_queries_enabled=slow_queries.threshold is not None,
+                           slow_queries=slow_queries.records()[:DASHBOARD_SLOW_QUERIES])
 
 
 # === Управление пользователями ===
 @admin.route('/admin/users')
 @admin_required
 def users():
-    page = request.args.get('page', 1, type=int)
-    users = User.query.paginate(page=page, per_page=10)
+    users = paginate_query(User.query, USER_ORDER, per_page=10, versions=('users',))
     return render_template('admin/users.html', users=users)
 
 
@@ -67,11 +88,24 @@ def toggle_admin(user_id):
 
 # === Управление товарами ===
 @admin.route('/admin/products')
+@query_budget(12)
 @admin_required
 def products():
-    page = request.args.get('page', 1, type=int)
-    products = Product.query.paginate(page=page, per_page=10)
-    return render_template('admin/products.html', products=products)
+    products = paginate_query(Product.query.options(*load_options('product_detail')), PRODUCT_ORDER, per_page=10, versions=('catalog',))
+    # Последнее задание обработки изображения по каждому товару страницы - одним запросом
+    image_jobs = image_jobs_for('products', [product.id for product in products.items])
+    return render_template('admin/products.html', products=products, image_jobs=image_jobs)
+
+
+@admin.route('/admin/images/retry/<int:job_id>', methods=['POST'])
+@admin_required
+def retry_image_job(job_id):
+    """Повторный запуск упавшего задания обработки изображения"""
+    if retry_job(job_id):
+        flash('Обработка изображения запущена повторно', 'success')
+    else:
+        flash('Задание не найдено или не завершилось ошибкой', 'warning')
+    return redirect(request.referrer or url_for('admin.products'))
 
 
 @admin.route('/admin/products/create', methods=['GET', 'POST'])
@@ -97,30 +131,26 @@ def create_product():
             brand_id=form.brand_id.data,
             country_id=form.country_id.data
         )
+        product.set_cross_numbers(split_numbers(form.cross_numbers.data))
+
+        db.session.add(product)
+        db.session.flush()  # Чтобы получить ID
 
-        # Обработка изображения
+        # Обновляем slug с учетом ID
+        product.slug = f"{product.id}-{transliterate(product.name)}"
+
+        # Изображение сохраняется как есть, производные строятся в фоне после коммита
         if form.image.data:
             try:
-                main_path, thumbnail_path = save_product_image(
-                    form.image.data,
-                    form.name.data,
-                    0,  # Временный ID
-                    current_app
-                )
-                product.image_url = main_path
+                queue_image(form.image.data, 'products', product.id)
             except Exception as e:
+                db.session.rollback()
                 flash(f'Ошибка при загрузке изображения: {str(e)}', 'error')
                 return render_template('admin/product_form.html',
                                        form=form,
                                        title='Создать товар',
                                        categories=all_categories)
 
-        db.session.add(product)
-        db.session.flush()  # Чтобы получить ID
-
-        # Обновляем slug с учетом ID
-        product.slug = f"{product.id}-{transliterate(product.name)}"
-
         # Добавляем категории
         category_ids = request.form.getlist('category_ids')
         for cat_id in category_ids:
@@ -165,17 +195,12 @@ def edit_product(product_id):
         product.stock = form.stock.data
         product.brand_id = form.brand_id.data
         product.country_id = form.country_id.data
+        product.set_cross_numbers(split_numbers(form.cross_numbers.data))
 
-        # Обработка изображения
+        # Изображение сохраняется как есть, производные строятся в фоне после коммита
         if form.image.data:
             try:
-                main_path, thumbnail_path = save_product_image(
-                    form.image.data,
-                    form.name.data,
-                    product.id,
-                    current_app
-                )
-                product.image_url = main_path
+                queue_image(form.image.data, 'products', product.id)
             except Exception as e:
                 flash(f'Ошибка при загрузке изображения: {str(e)}', 'error')
                 return render_template('admin/product_form.html',
@@ -201,6 +226,8 @@ def edit_product(product_id):
 
     # Предзаполняем форму текущими значениями
     form.category_ids.data = [c.id for c in product.categories] if product.categories else []
+    if not form.is_submitted():
+        form.cross_numbers.data = ', '.join(product.get_cross_numbers())
 
     return render_template('admin/product_form.html',
                            form=form,
@@ -219,17 +246,61 @@ def delete_product(product_id):
     return redirect(url_for('admin.products'))
 
 
+# === Импорт и экспорт каталога ===
+@admin.route('/admin/catalog/import', methods=['GET', 'POST'])
+@admin_required
+def catalog_import():
+    """Загрузка прайса CSV/JSONL: товары обновляются по артикулу, пробный запуск показывает изменения"""
+    from app.utilities.catalog_io import FORMATS, detect_format, import_catalog
+    report = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        file_format = request.form.get('format') or detect_format(upload.filename if upload else None)
+        if not upload or not upload.filename:
+            flash('Выберите файл для импорта', 'error')
+        elif file_format not in FORMATS:
+            flash('Не удалось определить формат файла: нужен .csv или .jsonl', 'error')
+        else:
+            try:
+                report = import_catalog(upload.stream, file_format,
+                                        dry_run=request.form.get('dry_run') == '1',
+                                        create_missing=request.form.get('create_missing') == '1')
+            except Exception as e:
+                db.session.rollback()
+                # Пачки до ошибки уже записаны - каждая в своей транзакции
+                flash(f'Ошибка при импорте: {str(e)}', 'error')
+    return render_template('admin/catalog_import.html', report=report, formats=FORMATS)
+
+
+@admin.route('/admin/catalog/export')
+@admin_required
+def catalog_export():
+    """Выгрузка каталога потоком (формат файла подходит для импорта)"""
+    from datetime import date
+    from app.utilities.catalog_io import FORMATS, export_chunks
+    file_format = request.args.get('format', 'csv')
+    if file_format not in FORMATS:
+        abort(404)
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    response = current_app.response_class(stream_with_context(export_chunks(file_format)),
+                                          mimetype=f'{mimetype}; charset=utf-8')
+    response.headers['Content-Disposition'] = f'attachment; filename=catalog-{date.today()}.{file_format}'
+    return response
+
+
 # === Управление категориями ===
 @admin.route('/admin/categories')
+@query_budget(12)
 @admin_required
 def categories():
     # Получаем только родительские категории
-    parent_categories = Category.query.filter_by(parent_id=None).all()
+    parent_categories = Category.query.options(*load_options('category_tree')).filter_by(parent_id=None).all()
     # Получаем все категории для выпадающего списка
     all_categories = Category.query.all()
     return render_template('admin/categories.html',
                            parent_categories=parent_categories,
-                           all_categories=all_categories)
+                           all_categories=all_categories,
+                           product_counts=product_counts(include_descendants=False))
 
 
 @admin.route('/admin/categories/create', methods=['POST'])
@@ -301,7 +372,7 @@ def edit_category(category_id):
 @admin_required
 def delete_category(category_id):
     category = Category.query.get_or_404(category_id)
-    if category.products:
+    if product_counts(include_descendants=False).get(category.id):
         flash('Нельзя удалить категорию, содержащую товары', 'error')
     else:
         db.session.delete(category)
@@ -312,10 +383,13 @@ def delete_category(category_id):
 
 # === Управление брендами ===
 @admin.route('/admin/brands')
+@query_budget(10)
 @admin_required
 def brands():
     brands = Brand.query.all()
-    return render_template('admin/brands.html', brands=brands)
+    # Количество товаров по брендам одним запросом, а не загрузкой brand.products
+    counts = dict(db.session.query(Product.brand_id, db.func.count()).group_by(Product.brand_id).all())
+    return render_template('admin/brands.html', brands=brands, product_counts=counts)
 
 
 @admin.route('/admin/brands/create', methods=['POST'])
@@ -347,10 +421,13 @@ def delete_brand(brand_id):
 
 # === Управление странами ===
 @admin.route('/admin/countries')
+@query_budget(10)
 @admin_required
 def countries():
     countries = Country.query.all()
-    return render_template('admin/countries.html', countries=countries)
+    # Количество товаров по странам одним запросом, а не загрузкой country.products
+    counts = dict(db.session.query(Product.country_id, db.func.count()).group_by(Product.country_id).all())
+    return render_template('admin/countries.html', countries=countries, product_counts=counts)
 
 
 @admin.route('/admin/countries/create', methods=['POST'])
@@ -398,31 +475,21 @@ def create_news():
         if title and content:
             news = News(title=title, content=content)
 
-            # Обработка изображения
-            if 'image' in request.files:
-                image_file = request.files['image']
-                if image_file and image_file.filename:
-                    try:
-                        image_url = save_news_image(image_file, title, 0, current_app)  # 0 - временный ID
-                        news.image_url = image_url
-                    except Exception as e:
-                        flash(f'Ошибка при загрузке изображения: {str(e)}', 'error')
-                        return render_template('admin/news_form.html', title='Создать новость')
-
             db.session.add(news)
             db.session.flush()  # Чтобы получить ID
 
             # Обновляем slug с учетом ID
             news.slug = f"{news.id}-{transliterate(news.title)}"
 
-            # Обновляем изображение с правильным ID
-            if 'image' in request.files and request.files['image'].filename:
+            # Изображение сохраняется как есть, производные строятся в фоне после коммита
+            image_file = request.files.get('image')
+            if image_file and image_file.filename:
                 try:
-                    image_file = request.files['image']
-                    image_url = save_news_image(image_file, news.title, news.id, current_app)
-                    news.image_url = image_url
+                    queue_image(image_file, 'news', news.id)
                 except Exception as e:
-                    flash(f'Ошибка при обновлении изображения: {str(e)}', 'warning')
+                    db.session.rollback()
+                    flash(f'Ошибка при загрузке изображения: {str(e)}', 'error')
+                    return render_template('admin/news_form.html', title='Создать новость')
 
             db.session.commit()
             flash('Новость успешно создана', 'success')
@@ -444,13 +511,12 @@ def edit_news(news_id):
             news.title = title
             news.content = content
 
-            # Обработка изображения
+            # Изображение сохраняется как есть, производные строятся в фоне после коммита
             if 'image' in request.files:
                 image_file = request.files['image']
                 if image_file and image_file.filename:
                     try:
-                        image_url = save_news_image(image_file, title, news.id, current_app)
-                        news.image_url = image_url
+                        queue_image(image_file, 'news', news.id)
                     except Exception as e:
                         flash(f'Ошибка при загрузке изображения: {str(e)}', 'error')
                         return render_template('admin/news_form.html', news=news, title='Редактировать новость')
@@ -607,54 +673,50 @@ def delete_seo_setting(seo_id):
     return redirect(url_for('admin.seo_settings'))
 
 
-# === Управление Sitemap ===
-@admin.route('/admin/sitemap/generate')
+# === Поиск ===
+@admin.route('/admin/search/stats')
 @admin_required
-def generate_sitemap():
-    """Генерация статического sitemap.xml"""
-    try:
-        # Импортируем функции для генерации
-        from flask import current_app
-        from app.sitemap_routes import sitemap_xml
-
-        # Генерируем sitemap
-        with current_app.test_request_context('/sitemap.xml'):
-            response = sitemap_xml()
-
-            # Сохраняем в статический файл
-            static_folder = os.path.join(current_app.root_path, 'static')
-            sitemap_path = os.path.join(static_folder, 'sitemap.xml')
-
-            # Создаем папку если её нет
-            os.makedirs(static_folder, exist_ok=True)
-
-            # Записываем содержимое в файл
-            with open(sitemap_path, 'w', encoding='utf-8') as f:
-                f.write(response.get_data(as_text=True))
+def search_stats():
+    """Статистика поисковых индексов (память, время перестройки) для подбора размера воркеров"""
+    from app.utilities.autocomplete import autocomplete_index
+    from app.utilities.search import search_index
+    return jsonify({
+        'search_backend': search_index.backend.name,
+        'search_cache': search_index.cache.stats(),
+        'autocomplete': autocomplete_index.stats()
+    })
+
+
+@admin.route('/admin/metrics')
+@admin_required
+def request_metrics():
+    """Гистограммы времени и числа SQL-запросов по endpoint и обращения к кэшу фрагментов (формат Prometheus, данные текущего воркера)"""
+    return current_app.response_class(metrics.render() + fragment_metrics.render(),
+                                      mimetype='text/plain; version=0.0.4')
 
-            flash('Sitemap успешно сгенерирован и сохранен', 'success')
-    except Exception as e:
-        flash(f'Ошибка при генерации sitemap: {str(e)}', 'error')
 
-    return redirect(url_for('admin.dashboard'))
+# === Управление Sitemap ===
+@admin.route('/admin/sitemap/generate', methods=['POST'])
+@admin_required
+def generate_sitemap():
+    """Запуск сборки sitemap в фоне (перестраиваются только изменившиеся шарды)"""
+    from app.utilities.sitemaps import build_in_background
+    force = request.form.get('force') == '1'
+    if build_in_background(current_app._get_current_object(), request.host_url.rstrip('/'), force):
+        flash('Сборка sitemap запущена, обновите страницу через несколько секунд', 'success')
+    else:
+        flash('Сборка sitemap уже идет', 'warning')
+    return redirect(url_for('admin.view_sitemap'))
 
 
 @admin.route('/admin/sitemap/view')
 @admin_required
 def view_sitemap():
-    """Просмотр sitemap"""
+    """Итог последней сборки sitemap: время, число URL, шарды"""
+    from app.utilities.sitemaps import read_manifest
     try:
-        from flask import current_app
-        static_folder = os.path.join(current_app.root_path, 'static')
-        sitemap_path = os.path.join(static_folder, 'sitemap.xml')
-
-        if os.path.exists(sitemap_path):
-            with open(sitemap_path, 'r', encoding='utf-8') as f:
-                sitemap_content = f.read()
-            return render_template('admin/sitemap_view.html', sitemap_content=sitemap_content)
-        else:
-            flash('Sitemap файл не найден. Сгенерируйте его сначала.', 'warning')
-            return redirect(url_for('admin.generate_sitemap'))
-    except Exception as e:
-        flash(f'Ошибка при чтении sitemap: {str(e)}', 'error')
-        return redirect(url_for('admin.dashboard'))
\ No newline at end of file
+        manifest = read_manifest()
+    except (OSError, ValueError) as e:
+        flash(f'Ошибка при чтении итогов сборки sitemap: {str(e)}', 'error')
+        manifest = None
+    return render_template('admin/sitemap_view.html', manifest=manifest)
\ No newline at end of file
@@ -1,15 +1,17 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app
 from flask_login import login_required, current_user
 from app import db
-from app.models import Product, CartItem
+from app.models import Product, CartItem, load_options
+from app.utilities.instrumentation import query_budget
 
 cart = Blueprint('cart', __name__)
 
 
 @cart.route('/cart')
+@query_budget(8)
 @login_required
 def view_cart():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+    cart_items = CartItem.query.options(*load_options('cart_item')).filter_by(user_id=current_user.id).all()
     total = sum(item.product.price * item.quantity for item in cart_items)
     return render_template('cart/view_cart.html', cart_items=cart_items, total=total)
 
@@ -17,19 +19,13 @@ def view_cart():
 @cart.route('/cart/add/<int:product_id>', methods=['POST'])
 @login_required
 def add_to_cart(product_id):
-    print(f"DEBUG: add_to_cart called with product_id={product_id}")
-    print(f"DEBUG: request.method={request.method}")
-    print(f"DEBUG: request.form={request.form}")
-
     product = Product.query.get_or_404(product_id)
 
     # Получаем количество из формы или устанавливаем 1 по умолчанию
     try:
         quantity = int(request.form.get('quantity', 1))
-        print(f"DEBUG: quantity={quantity}")
     except (ValueError, TypeError):
         quantity = 1
-        print(f"DEBUG: quantity set to default 1")
 
     # Проверяем наличие товара
     if quantity > product.stock:
@@ -50,7 +46,7 @@ def add_to_cart(product_id):
             flash(f'Недостаточно товара на складе. Максимальное количество: {product.stock} шт.', 'error')
             return redirect(url_for('main.product_detail', product_slug=product.slug))
         cart_item.quantity = new_quantity
-        print(f"DEBUG: Updated existing cart item, new quantity={new_quantity}")
+        current_app.logger.debug('Корзина %s: товар %s, количество %s', current_user.id, product_id, new_quantity)
     else:
         # Создаем новую запись в корзине
         cart_item = CartItem(
@@ -59,7 +55,7 @@ def add_to_cart(product_id):
             quantity=quantity
         )
         db.session.add(cart_item)
-        print(f"DEBUG: Created new cart item with quantity={quantity}")
+        current_app.logger.debug('Корзина %s: добавлен товар %s, количество %s', current_user.id, product_id, quantity)
 
     db.session.commit()
     flash(f'Товар "{product.name}" добавлен в корзину!', 'success')
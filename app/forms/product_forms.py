@@ -6,6 +6,7 @@ from flask_wtf.file import FileField, FileAllowed
 class ProductForm(FlaskForm):
     name = StringField('Название товара', validators=[DataRequired()])
     article = StringField('Артикул', validators=[DataRequired()])
+    cross_numbers = TextAreaField('Кросс-номера', description='Номера аналогов и OEM, через запятую или с новой строки')
     short_desc = TextAreaField('Краткое описание')
     full_desc = TextAreaField('Полное описание')
     price = FloatField('Цена', validators=[DataRequired(), NumberRange(min=0)])
@@ -0,0 +1,17 @@
+from flask import Blueprint, abort, send_file
+from app.utilities.image_cache import IMMUTABLE_MAX_AGE, get_derivative
+
+images = Blueprint('images', __name__)
+
+
+@images.route('/img/<preset>/<kind>/<path:path>')
+def derivative(preset, kind, path):
+    """Производная загрузки по пресету, строится при первом запросе (app/utilities/image_cache.py)"""
+    result = get_derivative(preset, kind, path)
+    if result is None:
+        abort(404)
+    file_path, mimetype = result
+    response = send_file(file_path, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
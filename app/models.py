@@ -1,11 +1,15 @@
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import validates, joinedload, selectinload
 from app import db
+from app.utilities.helpers import normalize_article
 
 # Промежуточная таблица для связи many-to-many Product-Category
 product_category = db.Table('product_category',
                             db.Column('product_id', db.Integer, db.ForeignKey('product.id'), primary_key=True),
-                            db.Column('category_id', db.Integer, db.ForeignKey('category.id'), primary_key=True)
+                            db.Column('category_id', db.Integer, db.ForeignKey('category.id'), primary_key=True),
+                            # Товары категории (фильтр каталога): первичный ключ начинается с product_id
+                            db.Index('ix_product_category_category_product', 'category_id', 'product_id')
                             )
 
 
@@ -36,8 +40,9 @@ class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     slug = db.Column(db.String(100), unique=True, nullable=False)  # Для URL
-    parent_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True, index=True)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
     # Связь с подкатегориями
     children = db.relationship('Category', backref=db.backref('parent', remote_side=[id]))
@@ -60,15 +65,28 @@ class Category(db.Model):
     def get_full_slug(self):
         """Возвращает полный slug с учетом родителей"""
         if self.parent:
-            return f"{self.parent.slug}/{self.slug}"
+            return f"{self.parent.get_full_slug()}/{self.slug}"
         return self.slug
 
     def get_total_products_count(self):
-        """Возвращает общее количество товаров в категории и подкатегориях"""
-        count = len(self.products)
-        for child in self.children:
-            count += len(child.products)
-        return count
+        """Возвращает общее количество товаров в категории и всех подкатегориях (одним запросом)"""
+        from app.utilities.category_tree import subtree_ids
+        return db.session.execute(
+            db.select(db.func.count(db.distinct(product_category.c.product_id)))
+            .where(product_category.c.category_id.in_(subtree_ids(self.id)))
+        ).scalar()
+
+
+class CategoryClosure(db.Model):
+    """Все пары предок-потомок дерева категорий (включая саму категорию с depth=0)"""
+    __tablename__ = 'category_closure'
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='CASCADE'), primary_key=True,
+                              index=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<CategoryClosure {self.ancestor_id}->{self.descendant_id} ({self.depth})>'
 
 
 class Brand(db.Model):
@@ -107,13 +125,60 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     stock = db.Column(db.Integer, nullable=False, default=0)  # Количество на складе
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
     brand_id = db.Column(db.Integer, db.ForeignKey('brand.id'), nullable=False)
-    country_id = db.Column(db.Integer, db.ForeignKey('country.id'), nullable=False)
+    country_id = db.Column(db.Integer, db.ForeignKey('country.id'), nullable=False, index=True)
+
+    # Индексы под запросы каталога (сортировки с id в конце - для постраничного вывода по ключу)
+    __table_args__ = (
+        db.Index('ix_product_created_at_id', 'created_at', 'id'),  # Новинки: главная, сайдбары, ?sort=new
+        db.Index('ix_product_price_id', 'price', 'id'),  # Сортировка и диапазон цены
+        # Фильтр по брендам и покрывающий индекс для матрицы фасетов (бренд, страна, цена)
+        db.Index('ix_product_brand_country_price', 'brand_id', 'country_id', 'price'),
+    )
 
     # Связи
     categories = db.relationship('Category', secondary=product_category, back_populates='products')
     cart_items = db.relationship('CartItem', backref='product', lazy=True)
+    # Номера для поиска по артикулу (основной + кросс-номера)
+    numbers = db.relationship('ProductNumber', backref='product', lazy=True, cascade='all, delete-orphan')
+    # Производные изображения для srcset (images.picture); грузить через load_options
+    image_variants = db.relationship('ImageVariant', primaryjoin='foreign(ImageVariant.image) == Product.image_url',
+                                     viewonly=True, order_by='ImageVariant.width')
+
+    @validates('article')
+    def _sync_article_number(self, key, value):
+        """Поддерживает нормализованную запись основного артикула"""
+        main_number = next((n for n in self.numbers if not n.is_cross), None)
+        if main_number is None:
+            self.numbers.append(ProductNumber(number=value, normalized=normalize_article(value)))
+        else:
+            main_number.number = value
+            main_number.normalized = normalize_article(value)
+        return value
+
+    def get_cross_numbers(self):
+        """Кросс-номера товара (номера аналогов/OEM)"""
+        return [n.number for n in self.numbers if n.is_cross]
+
+    def set_cross_numbers(self, numbers):
+        """Заменяет список кросс-номеров товара"""
+        wanted = {}
+        for number in numbers:
+            number = number.strip()
+            normalized = normalize_article(number)
+            if normalized and normalized not in wanted:
+                wanted[normalized] = number
+
+        for existing in [n for n in self.numbers if n.is_cross]:
+            if existing.normalized in wanted:
+                existing.number = wanted.pop(existing.normalized)
+            else:
+                self.numbers.remove(existing)
+
+        for normalized, number in wanted.items():
+            self.numbers.append(ProductNumber(number=number, normalized=normalized, is_cross=True))
 
     def get_thumbnail_url(self):
         """Генерирует URL миниатюры из URL основного изображения"""
@@ -136,11 +201,26 @@ class Product(db.Model):
         return f'<Product {self.name}>'
 
 
+class ProductNumber(db.Model):
+    """Номер товара для быстрого поиска по артикулу"""
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    number = db.Column(db.String(50), nullable=False)  # Номер в исходном написании
+    normalized = db.Column(db.String(50), nullable=False, index=True)  # Без разделителей, casefold
+    is_cross = db.Column(db.Boolean, nullable=False, default=False)  # Кросс-номер (аналог/OEM)
+
+    def __repr__(self):
+        return f'<ProductNumber {self.number}>'
+
+
 class CartItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False, default=1)
+
+    # Корзина пользователя и поиск позиции по товару при добавлении
+    __table_args__ = (db.Index('ix_cart_item_user_product', 'user_id', 'product_id'),)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
 
     def __repr__(self):
@@ -154,6 +234,14 @@ class News(db.Model):
     content = db.Column(db.Text, nullable=False)
     image_url = db.Column(db.String(200))  # Изображение новости
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+
+    # Лента новостей и сайдбары: новые сверху, id - для постраничного вывода по ключу
+    __table_args__ = (db.Index('ix_news_created_at_id', 'created_at', 'id'),)
+
+    # Производные изображения для srcset (images.picture); грузить через load_options
+    image_variants = db.relationship('ImageVariant', primaryjoin='foreign(ImageVariant.image) == News.image_url',
+                                     viewonly=True, order_by='ImageVariant.width')
 
     def __repr__(self):
         return f'<News {self.title}>'
@@ -190,9 +278,9 @@ class Setting(db.Model):
 
     @staticmethod
     def get(key, default=None):
-        """Получение значения настройки по ключу"""
-        setting = Setting.query.filter_by(key=key).first()
-        return setting.value if setting else default
+        """Получение значения настройки по ключу (из снимка настроек, без запроса)"""
+        from app.utilities.site_settings import get_setting
+        return get_setting(key, default)
 
     @staticmethod
     def set(key, value, description=None):
@@ -224,6 +312,8 @@ class SeoMeta(db.Model):
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
+    __table_args__ = (db.Index('ix_seo_meta_page', 'page_type', 'page_id'),)
+
     def __repr__(self):
         return f'<SeoMeta {self.page_type}:{self.page_id}>'
 
@@ -236,4 +326,108 @@ class SeoMeta(db.Model):
             if seo:
                 return seo
         # Если нет специфичных, ищем общие настройки для типа страницы
-        return SeoMeta.query.filter_by(page_type=page_type, page_id=None).first()
\ No newline at end of file
+        return SeoMeta.query.filter_by(page_type=page_type, page_id=None).first()
+
+
+class SchemaMigration(db.Model):
+    """Примененные миграции схемы (app/utilities/migrations.py)"""
+    __tablename__ = 'schema_migration'
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<SchemaMigration {self.name}>'
+
+
+class CacheVersion(db.Model):
+    """Счетчики версий данных для инвалидации кэшей во всех воркерах"""
+    name = db.Column(db.String(50), primary_key=True)  # catalog, settings, ...
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)  # Время последнего увеличения (для Last-Modified)
+
+    def __repr__(self):
+        return f'<CacheVersion {self.name}={self.value}>'
+
+
+class ImageJob(db.Model):
+    """Задание на построение производных изображения (app/utilities/images.py)"""
+    __tablename__ = 'image_job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # products, news, brands, categories
+    entity_id = db.Column(db.Integer, nullable=False)
+    source = db.Column(db.String(300), nullable=False)  # Исходный файл загрузки (URL от /static)
+    target = db.Column(db.String(300), nullable=False)  # Основное изображение - станет image_url
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+
+    __table_args__ = (
+        db.Index('ix_image_job_status_id', 'status', 'id'),  # Очередь: следующие ожидающие задания
+        db.Index('ix_image_job_kind_entity', 'kind', 'entity_id'),  # Статус изображения в списках админки
+    )
+
+    def __repr__(self):
+        return f'<ImageJob {self.id} {self.kind}:{self.entity_id} {self.status}>'
+
+
+class ImageBlob(db.Model):
+    """Загрузка, хранимая по хэшу содержимого; refcount - число сущностей с image_url = url"""
+    __tablename__ = 'image_blob'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # products, news, ...
+    hash = db.Column(db.String(64), nullable=False)  # SHA-256 исходного файла
+    source = db.Column(db.String(300), nullable=False)  # Исходный файл (URL от /static)
+    url = db.Column(db.String(300), nullable=False, unique=True)  # Основное изображение - значение image_url
+    size = db.Column(db.Integer, nullable=False, default=0)  # Байт исходного файла
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    # Поиск загрузки с тем же содержимым; сборка мусора - по refcount
+    __table_args__ = (db.Index('ix_image_blob_kind_hash', 'kind', 'hash', unique=True),)
+
+    def __repr__(self):
+        return f'<ImageBlob {self.kind}:{self.hash[:12]} refs={self.refcount}>'
+
+
+class ImageVariant(db.Model):
+    """Производная изображения: ширина x формат (набор для srcset и <picture>)"""
+    __tablename__ = 'image_variant'
+    id = db.Column(db.Integer, primary_key=True)
+    image = db.Column(db.String(300), nullable=False)  # image_url сущности, к которому относится набор
+    preset = db.Column(db.String(20), nullable=False, default='')  # Суффикс пресета: '' - основное, _thumb
+    format = db.Column(db.String(10), nullable=False)  # avif, webp, jpeg, png
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    size = db.Column(db.Integer, nullable=False)  # Байт на диске
+    url = db.Column(db.String(300), nullable=False)
+
+    __table_args__ = (db.Index('ix_image_variant_image', 'image'),)
+
+    def __repr__(self):
+        return f'<ImageVariant {self.url}>'
+
+
+# Профили загрузки связей: какие связи страница читает и как их загружать,
+# чтобы число запросов не зависело от размера страницы.
+# Собираются при вызове - backref-атрибуты (Product.brand) появляются после настройки мапперов
+_LOAD_PROFILES = {
+    # Карточка товара в списках: бренд и страна - в том же запросе
+    'product_card': lambda: (joinedload(Product.brand), joinedload(Product.country),
+                             selectinload(Product.image_variants)),
+    # Страница товара и список товаров в админке: плюс категории одним запросом на страницу
+    'product_detail': lambda: (joinedload(Product.brand), joinedload(Product.country),
+                               selectinload(Product.categories), selectinload(Product.image_variants)),
+    # Корзина: товары позиций в том же запросе
+    'cart_item': lambda: (joinedload(CartItem.product).selectinload(Product.image_variants),),
+    # Новости в лентах и сайдбарах: производные изображений одним запросом
+    'news_card': lambda: (selectinload(News.image_variants),),
+    # Дерево категорий: подкатегории одним запросом
+    'category_tree': lambda: (selectinload(Category.children),),
+}
+
+
+def load_options(profile):
+    """Опции загрузки связей для профиля: Product.query.options(*load_options('product_card'))"""
+    return _LOAD_PROFILES[profile]()
@@ -1,9 +1,14 @@
 from flask import Blueprint, render_template, request, Response
+from app.utilities.http_cache import conditional
 
 robots = Blueprint('robots', __name__)
 
 @robots.route('/robots.txt')
 def robots_txt():
     """Генерация robots.txt"""
+    # Содержимое зависит только от хоста (и шаблона - он входит в любой ETag)
+    not_modified = conditional(('robots', request.host_url), max_age=86400)
+    if not_modified:
+        return not_modified
     robots_content = render_template('robots.txt')
     return Response(robots_content, mimetype='text/plain')
\ No newline at end of file
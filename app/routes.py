@@ -1,66 +1,103 @@
-from flask import Blueprint, render_template, request, jsonify, url_for, abort, flash, redirect
+from flask import Blueprint, render_template, request, jsonify, url_for, abort, flash, redirect, current_app
 from flask_login import current_user, login_required
 from app import db
-from app.models import Product, News, Category, Brand, Country, product_category, CartItem
-from sqlalchemy import or_, func
-from app.utils import transliterate
-import re
+from app.models import Product, News, CartItem, load_options
+from app.utilities.pagination import ManualPagination, KeysetOrder, paginate_query
+from app.utilities.search import search_index, find_by_article
+from app.utilities.autocomplete import autocomplete_index, refresh_if_stale
+from app.utilities.category_tree import products_in_subtree
+from app.utilities.navigation import get_navigation
+from app.utilities.facets import CatalogFilters, catalog_facets
+from app.utilities.instrumentation import query_budget
+from app.utilities.page_cache import add_page_tags
+from app.utilities.http_cache import conditional
+from app.utilities.image_cache import image_url_for
 
 main = Blueprint('main', __name__)
 
+# Максимум товаров, найденных по артикулу (больше - уже не "номер детали")
+ARTICLE_SEARCH_LIMIT = 500
 
-# Функции для нормализации текста поиска
-def normalize_text_for_search(text):
-    """Нормализует текст для поиска - убирает лишние пробелы и приводит к нижнему регистру"""
-    if not text:
-        return ""
-    return re.sub(r'\s+', ' ', str(text).strip().lower())
+# Варианты сортировки каталога (?sort=); последняя колонка - id для стабильного порядка
+PRODUCT_ORDERS = {
+    'default': KeysetOrder('default', Product.id),
+    'new': KeysetOrder('new', Product.created_at, Product.id, descending=True),
+    'price_asc': KeysetOrder('price_asc', Product.price, Product.id),
+    'price_desc': KeysetOrder('price_desc', Product.price, Product.id, descending=True),
+}
 
+NEWS_ORDER = KeysetOrder('new', News.created_at, News.id, descending=True)
 
-def advanced_search_in_text(text, search_query):
-    """Продвинутый поиск в тексте - регистронезависимо, с нормализацией"""
-    if not text or not search_query:
-        return False
 
-    normalized_text = normalize_text_for_search(text)
-    normalized_query = normalize_text_for_search(search_query)
+def get_product_order():
+    """Порядок сортировки каталога из параметра ?sort="""
+    return PRODUCT_ORDERS.get(request.args.get('sort'), PRODUCT_ORDERS['default'])
 
-    # Проверяем точное совпадение
-    if normalized_query in normalized_text:
-        return True
 
-    # Проверяем частичные совпадения слов
-    text_words = normalized_text.split()
-    query_words = normalized_query.split()
-
-    for query_word in query_words:
-        for text_word in text_words:
-            if query_word in text_word or text_word in query_word:
-                return True
-
-    return False
-
-
-def search_products_python(query_text):
-    """Поиск товаров с использованием Python-фильтрации"""
-    if not query_text:
-        return Product.query.all()
-
-    all_products = Product.query.all()
-    matching_products = []
-    normalized_query = normalize_text_for_search(query_text)
-
-    for product in all_products:
-        # Проверяем все поля товара
-        if (advanced_search_in_text(product.name, query_text) or
-                advanced_search_in_text(product.article, query_text) or
-                advanced_search_in_text(product.short_desc, query_text) or
-                advanced_search_in_text(product.full_desc, query_text) or
-                (product.brand and advanced_search_in_text(product.brand.name, query_text)) or
-                any(advanced_search_in_text(cat.name, query_text) for cat in product.categories)):
-            matching_products.append(product)
-
-    return matching_products
+def get_checked_ids(prefix):
+    """id, отмеченные в фильтре каталога (параметры вида brand_3=on)"""
+    ids = set()
+    for key, value in request.args.items():
+        if key.startswith(prefix) and value == 'on':
+            try:
+                ids.add(int(key[len(prefix):]))
+            except ValueError:
+                continue
+    return frozenset(ids)
+
+
+def get_catalog_filters(category_id=None):
+    """Фильтры каталога из параметров запроса"""
+    return CatalogFilters(category_id=category_id,
+                          price_from=request.args.get('price_from', type=float),
+                          price_to=request.args.get('price_to', type=float),
+                          brand_ids=get_checked_ids('brand_'),
+                          country_ids=get_checked_ids('country_'))
+
+
+def filter_catalog_query(filters):
+    """Запрос товаров каталога с примененными фильтрами"""
+    query = Product.query.options(*load_options('product_card'))
+    if filters.category_id:
+        query = query.filter(Product.id.in_(products_in_subtree(filters.category_id)))
+    if filters.price_from is not None:
+        query = query.filter(Product.price >= filters.price_from)
+    if filters.price_to is not None:
+        query = query.filter(Product.price <= filters.price_to)
+    if filters.brand_ids:
+        query = query.filter(Product.brand_id.in_(sorted(filters.brand_ids)))
+    if filters.country_ids:
+        query = query.filter(Product.country_id.in_(sorted(filters.country_ids)))
+    return query
+
+
+def get_products_by_ids(product_ids):
+    """Загружает товары по списку id, сохраняя порядок списка"""
+    if not product_ids:
+        return []
+    products_by_id = {p.id: p for p in Product.query.options(*load_options('product_card'))
+                      .filter(Product.id.in_(product_ids)).all()}
+    return [products_by_id[product_id] for product_id in product_ids if product_id in products_by_id]
+
+
+def search_products(query_text, page, per_page):
+    """Поиск товаров: сначала по артикулу, затем через поисковый индекс (пагинация в БД)"""
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+
+    def compute():
+        # Быстрый путь для номеров деталей
+        article_ids = find_by_article(query_text, limit=ARTICLE_SEARCH_LIMIT)
+        if article_ids:
+            return {'ids': article_ids[offset:offset + per_page], 'total': len(article_ids)}
+        ids, total = search_index.search(query_text, limit=per_page, offset=offset)
+        return {'ids': ids, 'total': total}
+
+    result = search_index.cached('page', query_text, page, compute)
+
+    # Загружаем только товары текущей страницы
+    return ManualPagination(items=get_products_by_ids(result['ids']), page=page, per_page=per_page,
+                            total=result['total'])
 
 
 # Функции для получения SEO настроек
@@ -111,12 +148,18 @@ def get_search_page_seo(query, count):
 # === Маршруты ===
 
 @main.route('/')
+@query_budget(12)
 def index():
     """Главная страница"""
+    not_modified = conditional(('index',), versions=('catalog', 'news', 'settings'))
+    if not_modified:
+        return not_modified
+
     # Получаем последние новости
-    latest_news = News.query.order_by(News.created_at.desc()).limit(3).all()
+    latest_news = News.query.options(*load_options('news_card')).order_by(News.created_at.desc()).limit(3).all()
     # Получаем последние товары (последние 6 добавленных)
-    latest_products = Product.query.order_by(Product.created_at.desc()).limit(6).all()
+    latest_products = Product.query.options(*load_options('product_card')) \
+        .order_by(Product.created_at.desc()).limit(6).all()
 
     # Получаем SEO настройки
     seo = get_main_page_seo()
@@ -129,82 +172,59 @@ def index():
 
 # Маршрут для категорий по slug
 @main.route('/catalog/<path:category_slug>')
+@query_budget(15)
 def catalog_by_slug(category_slug):
     """Каталог по slug"""
-    # Разбиваем slug на части для поддержки вложенных категорий
-    slug_parts = category_slug.split('/')
-
-    # Находим последнюю категорию в пути
-    category = None
-
-    for i, slug_part in enumerate(slug_parts):
-        if i == 0:
-            # Ищем родительскую категорию
-            category = Category.query.filter_by(slug=slug_part, parent_id=None).first()
-        else:
-            # Ищем подкатегорию
-            if category:
-                category = Category.query.filter_by(slug=slug_part, parent_id=category.id).first()
-            else:
-                break
-
+    # Полный путь вида parent/child/... ищется в снимке дерева категорий
+    navigation = get_navigation()
+    category = navigation.by_path.get(category_slug.strip('/'))
     if not category:
         abort(404)
+    not_modified = conditional(('catalog', category.id), versions=('catalog', 'navigation', 'settings'))
+    if not_modified:
+        return not_modified
 
-    page = request.args.get('page', 1, type=int)
-    price_from = request.args.get('price_from', type=float)
-    price_to = request.args.get('price_to', type=float)
-
-    # Получаем бренды из запроса
-    brand_filters = []
-    for key, value in request.args.items():
-        if key.startswith('brand_') and value == 'on':
-            try:
-                brand_id = int(key.split('_')[1])
-                brand_filters.append(brand_id)
-            except (ValueError, IndexError):
-                continue
-
-    # Фильтрация по категории
-    query = Product.query.join(product_category).join(Category).filter(Category.id == category.id)
-
-    # Фильтрация по цене
-    if price_from is not None:
-        query = query.filter(Product.price >= price_from)
-    if price_to is not None:
-        query = query.filter(Product.price <= price_to)
-
-    # Фильтрация по брендам
-    if brand_filters:
-        query = query.filter(Product.brand_id.in_(brand_filters))
-
-    products = query.paginate(page=page, per_page=9)
-
-    # Получаем категории и бренды для фильтрации
-    parent_categories = Category.query.filter_by(parent_id=None).all()
-    all_categories = Category.query.all()
-    brands = Brand.query.all()
+    filters = get_catalog_filters(category.id)
+    add_page_tags(f'category:{category.id}')
+    products = paginate_query(filter_catalog_query(filters), get_product_order(), per_page=9,
+                              versions=('catalog',))
 
     # Получаем SEO настройки
     seo = get_catalog_page_seo(category)
 
+    # Категории и бренды для фильтрации - из снимка навигации, без запросов
     return render_template('catalog.html',
                            products=products,
-                           parent_categories=parent_categories,
-                           all_categories=all_categories,
+                           parent_categories=navigation.roots,
+                           all_categories=navigation.categories,
                            current_category=category.id,
-                           brands=brands,
+                           brands=navigation.brands,
+                           facets=catalog_facets(filters),
                            category=category,
                            seo=seo)
 
 
 # Маршрут для товаров по slug
 @main.route('/product/<string:product_slug>')
+@query_budget(12)
 def product_detail(product_slug):
     """Страница товара"""
     from app.forms.cart_forms import AddToCartForm
-    product = Product.query.filter_by(slug=product_slug).first_or_404()
+    # Валидаторы - по легкому запросу, товар со связями загружается только для полного ответа
+    row = db.session.execute(
+        db.select(Product.id, Product.updated_at).where(Product.slug == product_slug)
+    ).first()
+    if row is None:
+        abort(404)
+    # updated_at хранится с точностью до секунды - правку в ту же секунду ловит версия каталога
+    not_modified = conditional(('product', row.id, row.updated_at), last_modified=row.updated_at,
+                               versions=('catalog', 'navigation', 'settings'))
+    if not_modified:
+        return not_modified
+
+    product = db.session.get(Product, row.id, options=load_options('product_detail'))
     form = AddToCartForm()
+    add_page_tags(f'product:{product.id}')
 
     # Получаем SEO настройки
     seo = get_product_page_seo(product)
@@ -214,160 +234,97 @@ def product_detail(product_slug):
 
 # Маршрут для новостей по slug
 @main.route('/news/<string:news_slug>')
+@query_budget(12)
 def news_item(news_slug):
     """Страница новости"""
-    news_item = News.query.filter_by(slug=news_slug).first_or_404()
+    row = db.session.execute(db.select(News.id, News.updated_at).where(News.slug == news_slug)).first()
+    if row is None:
+        abort(404)
+    # Сайдбары показывают последние новости и товары - их версии тоже входят в валидаторы
+    not_modified = conditional(('news', row.id, row.updated_at), last_modified=row.updated_at,
+                               versions=('news', 'catalog', 'settings'))
+    if not_modified:
+        return not_modified
 
-    # Получаем последние новости для сайдбара (исключая текущую новость)
-    latest_news_sidebar = News.query.filter(News.id != news_item.id).order_by(News.created_at.desc()).limit(3).all()
-    # Получаем последние товары для сайдбара
-    latest_products_sidebar = Product.query.order_by(Product.created_at.desc()).limit(3).all()
+    news_item = db.session.get(News, row.id)
+    add_page_tags(f'news:{news_item.id}')
 
+    # Сайдбары с последними новостями и товарами шаблон берет из кэша фрагментов (latest_news/latest_products)
     # Получаем SEO настройки
     seo = get_news_page_seo(news_item)
 
     return render_template('news_item.html',
                            news=news_item,
-                           seo=seo,
-                           latest_news_sidebar=latest_news_sidebar,
-                           latest_products_sidebar=latest_products_sidebar)
+                           seo=seo)
 
 
 # Основной маршрут каталога
 @main.route('/catalog')
+@query_budget(15)
 def catalog():
     """Каталог (общий)"""
-    page = request.args.get('page', 1, type=int)
+    navigation = get_navigation()
     category_id = request.args.get('category', type=int)
-    price_from = request.args.get('price_from', type=float)
-    price_to = request.args.get('price_to', type=float)
-
-    # Получаем бренды из запроса
-    brand_filters = []
-    for key, value in request.args.items():
-        if key.startswith('brand_') and value == 'on':
-            try:
-                brand_id = int(key.split('_')[1])
-                brand_filters.append(brand_id)
-            except (ValueError, IndexError):
-                continue
-
-    # Базовый запрос
-    query = Product.query
-
-    # Фильтрация по категории
-    if category_id:
-        category = Category.query.get_or_404(category_id)
-        if category.is_parent():
-            # Если родительская, ищем по всем подкатегориям
-            subcategory_ids = [child.id for child in category.children]
-            subcategory_ids.append(category_id)
-            query = query.join(product_category).join(Category).filter(Category.id.in_(subcategory_ids))
-        else:
-            # Если подкатегория, ищем только по ней
-            query = query.join(product_category).join(Category).filter(Category.id == category_id)
-
-    # Фильтрация по цене
-    if price_from is not None:
-        query = query.filter(Product.price >= price_from)
-    if price_to is not None:
-        query = query.filter(Product.price <= price_to)
-
-    # Фильтрация по брендам
-    if brand_filters:
-        query = query.filter(Product.brand_id.in_(brand_filters))
-
-    products = query.paginate(page=page, per_page=9)
+    if category_id and category_id not in navigation.by_id:
+        abort(404)
+    not_modified = conditional(('catalog', category_id), versions=('catalog', 'navigation', 'settings'))
+    if not_modified:
+        return not_modified
 
-    # Получаем категории и бренды для фильтрации
-    parent_categories = Category.query.filter_by(parent_id=None).all()
-    all_categories = Category.query.all()
-    brands = Brand.query.all()
+    # Товары категории (со всеми подкатегориями любой глубины), цена, бренды и страны
+    filters = get_catalog_filters(category_id)
+    products = paginate_query(filter_catalog_query(filters), get_product_order(), per_page=9,
+                              versions=('catalog',))
 
     # Получаем SEO настройки
     seo = get_catalog_page_seo()
 
+    # Категории и бренды для фильтрации - из снимка навигации, без запросов
     return render_template('catalog.html',
                            products=products,
-                           parent_categories=parent_categories,
-                           all_categories=all_categories,
+                           parent_categories=navigation.roots,
+                           all_categories=navigation.categories,
                            current_category=category_id,
-                           brands=brands,
+                           brands=navigation.brands,
+                           facets=catalog_facets(filters),
                            seo=seo)
 
 
 # Страница новостей
 @main.route('/news')
+@query_budget(12)
 def news():
     """Страница новостей"""
-    page = request.args.get('page', 1, type=int)
-    news_items = News.query.order_by(News.created_at.desc()).paginate(page=page, per_page=5)
+    not_modified = conditional(('news',), versions=('news', 'catalog', 'settings'))
+    if not_modified:
+        return not_modified
 
-    # Получаем последние новости для сайдбара
-    latest_news_sidebar = News.query.order_by(News.created_at.desc()).limit(3).all()
-    # Получаем последние товары для сайдбара
-    latest_products_sidebar = Product.query.order_by(Product.created_at.desc()).limit(3).all()
+    news_items = paginate_query(News.query.options(*load_options('news_card')), NEWS_ORDER, per_page=5, versions=('news',))
 
+    # Сайдбары с последними новостями и товарами шаблон берет из кэша фрагментов (latest_news/latest_products)
     # Получаем SEO настройки
     seo = get_news_page_seo()
 
     return render_template('news.html',
                            news=news_items,
-                           seo=seo,
-                           latest_news_sidebar=latest_news_sidebar,
-                           latest_products_sidebar=latest_products_sidebar)
+                           seo=seo)
 
 
 # Поиск
 @main.route('/search')
+@query_budget(15)
 def search():
     """Страница результатов поиска"""
     query_text = request.args.get('q', '').strip()
     page = request.args.get('page', 1, type=int)
 
-    # Получаем все товары и фильтруем в Python
+    per_page = 12
     if query_text:
-        all_matching_products = search_products_python(query_text)
+        products = search_products(query_text, page, per_page)
     else:
-        all_matching_products = Product.query.all()
-
-    # Ручная пагинация
-    per_page = 12
-    total = len(all_matching_products)
-    start = (page - 1) * per_page
-    end = start + per_page
-    paginated_products = all_matching_products[start:end]
-
-    # Создаем объект пагинации вручную
-    class ManualPagination:
-        def __init__(self, items, page, per_page, total):
-            self.items = items
-            self.page = page
-            self.per_page = per_page
-            self.total = total
-            self.pages = (total + per_page - 1) // per_page if per_page > 0 else 0
-            self.has_prev = page > 1
-            self.has_next = page < self.pages
-            self.prev_num = page - 1 if self.has_prev else None
-            self.next_num = page + 1 if self.has_next else None
-
-        def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
-            last = 0
-            for num in range(1, self.pages + 1):
-                if num <= left_edge or \
-                        (num > self.page - left_current - 1 and num < self.page + right_current) or \
-                        num > self.pages - right_edge:
-                    if last + 1 != num:
-                        yield None
-                    yield num
-                    last = num
-
-    products = ManualPagination(
-        items=paginated_products,
-        page=page,
-        per_page=per_page,
-        total=total
-    )
+        products = Product.query.options(*load_options('product_card')).order_by(Product.id) \
+            .paginate(page=page, per_page=per_page, error_out=False)
+    total = products.total
 
     # Получаем SEO настройки
     seo = get_search_page_seo(query_text, total)
@@ -387,27 +344,26 @@ def api_search():
     if len(query_text) < 2:
         return jsonify([])
 
-    # Используем Python-фильтрацию для автоподсказок
-    all_products = Product.query.all()
-    matching_products = []
-    normalized_query = normalize_text_for_search(query_text)
-
-    for product in all_products:
-        # Проверяем название и артикул
-        if (advanced_search_in_text(product.name, query_text) or
-                advanced_search_in_text(product.article, query_text)):
-            matching_products.append(product)
+    def compute():
+        # Номера деталей ищем по индексу артикулов, остальное - в in-memory индексе подсказок
+        product_ids = find_by_article(query_text, limit=8)
+        if len(product_ids) < 8:
+            refresh_if_stale(current_app)
+            for product_id in autocomplete_index.suggest(query_text, limit=8):
+                if product_id not in product_ids and len(product_ids) < 8:
+                    product_ids.append(product_id)
+        return product_ids
 
-            # Ограничиваем до 8 результатов
-            if len(matching_products) >= 8:
-                break
+    product_ids = search_index.cached('suggest', query_text, 1, compute)
+    matching_products = get_products_by_ids(product_ids)
 
     # Формируем результаты
     results = []
     for product in matching_products:
         # Используем правильный путь к placeholder
         if product.image_url:
-            image_url = product.image_url
+            # Подсказка показывает 50px - отдаем маленькую производную, а не основное изображение
+            image_url = image_url_for(product.image_url, 'icon')
         else:
             image_url = url_for('static', filename='images/placeholder.png')
 
@@ -1,73 +1,69 @@
-from flask import Blueprint, render_template, request, Response
-from app.models import Product, News, Category
-from datetime import datetime
-import math
+import os
+
+from flask import Blueprint, render_template, request, Response, abort, send_from_directory, stream_with_context
+from app.utilities.http_cache import conditional
+from app.utilities.sitemaps import SHARDED_SECTIONS, PAGES_VERSIONS, INDEX_FILE, list_shards, shard_exists, \
+    main_pages, shard_pages, render_stream, sitemap_folder
 
 sitemap = Blueprint('sitemap', __name__)
 
+# Группы данных (versions.py), от которых зависят разделы карты
+SECTION_VERSIONS = {
+    'pages': PAGES_VERSIONS,
+    'products': ('catalog',),
+    'news': ('news',),
+}
+
+# Сколько секунд краулер может не перепроверять карту
+SITEMAP_MAX_AGE = 3600
+
+
+def stream_sitemap(pages):
+    """Потоковый ответ urlset: страницы берутся из генератора по мере отправки"""
+    stream = render_stream('sitemap.xml', pages=pages, base_url=request.host_url[:-1])
+    return Response(stream_with_context(stream), mimetype='application/xml')
+
 
 @sitemap.route('/sitemap.xml')
 def sitemap_xml():
-    """Генерация sitemap.xml"""
-    # Получаем все страницы для sitemap
-    pages = []
-
-    # Основные страницы
-    pages.extend([
-        {
-            'loc': '/',
-            'lastmod': datetime.utcnow().strftime('%Y-%m-%d'),
-            'changefreq': 'daily',
-            'priority': '1.0'
-        },
-        {
-            'loc': '/catalog',
-            'lastmod': datetime.utcnow().strftime('%Y-%m-%d'),
-            'changefreq': 'weekly',
-            'priority': '0.9'
-        },
-        {
-            'loc': '/news',
-            'lastmod': datetime.utcnow().strftime('%Y-%m-%d'),
-            'changefreq': 'daily',
-            'priority': '0.8'
-        }
-    ])
-
-    # Категории
-    categories = Category.query.all()
-    for category in categories:
-        pages.append({
-            'loc': f'/catalog/{category.slug}',
-            'lastmod': category.created_at.strftime('%Y-%m-%d') if category.created_at else datetime.utcnow().strftime(
-                '%Y-%m-%d'),
-            'changefreq': 'weekly',
-            'priority': '0.7'
-        })
-
-    # Товары
-    products = Product.query.all()
-    for product in products:
-        pages.append({
-            'loc': f'/product/{product.slug}',
-            'lastmod': product.created_at.strftime('%Y-%m-%d') if product.created_at else datetime.utcnow().strftime(
-                '%Y-%m-%d'),
-            'changefreq': 'monthly',
-            'priority': '0.6'
-        })
-
-    # Новости
-    news_items = News.query.all()
-    for news_item in news_items:
-        pages.append({
-            'loc': f'/news/{news_item.slug}',
-            'lastmod': news_item.created_at.strftime(
-                '%Y-%m-%d') if news_item.created_at else datetime.utcnow().strftime('%Y-%m-%d'),
-            'changefreq': 'monthly',
-            'priority': '0.5'
-        })
-
-    # Генерируем XML
-    xml_sitemap = render_template('sitemap.xml', pages=pages)
-
-    return Response(xml_sitemap, mimetype='application/xml')
\ No newline at end of file
+    """Индекс sitemap: собранный файл (flask sitemap build) или ссылки на шарды, отдаваемые на лету"""
+    if os.path.exists(os.path.join(sitemap_folder(), INDEX_FILE)):
+        return send_from_directory(sitemap_folder(), INDEX_FILE, mimetype='application/xml',
+                                   max_age=SITEMAP_MAX_AGE)
+
+    # Краулер перепроверяет карту часто - без изменений каталога и новостей ему хватит 304
+    not_modified = conditional(('sitemap',), versions=SECTION_VERSIONS['pages'], max_age=SITEMAP_MAX_AGE)
+    if not_modified:
+        return not_modified
+
+    sitemaps = [{'loc': f'/sitemap-{shard.name}.xml', 'lastmod': shard.lastmod} for shard in list_shards()]
+    return Response(render_template('sitemap_index.xml', sitemaps=sitemaps, base_url=request.host_url[:-1]),
+                    mimetype='application/xml')
+
+
+@sitemap.route('/sitemap-<name>.xml.gz')
+def sitemap_file(name):
+    """Собранный сжатый шард"""
+    return send_from_directory(sitemap_folder(), f'sitemap-{name}.xml.gz', mimetype='application/gzip',
+                               max_age=SITEMAP_MAX_AGE)
+
+
+@sitemap.route('/sitemap-pages.xml')
+def sitemap_pages():
+    """Шард с основными страницами и категориями"""
+    not_modified = conditional(('sitemap', 'pages'), versions=SECTION_VERSIONS['pages'], max_age=SITEMAP_MAX_AGE)
+    if not_modified:
+        return not_modified
+    return stream_sitemap(main_pages())
+
+
+@sitemap.route('/sitemap-<section>-<int:number>.xml')
+def sitemap_shard(section, number):
+    """Шард товаров или новостей по диапазону id"""
+    if section not in SHARDED_SECTIONS or not shard_exists(section, number):
+        abort(404)
+    not_modified = conditional(('sitemap', section, number), versions=SECTION_VERSIONS[section],
+                               max_age=SITEMAP_MAX_AGE)
+    if not_modified:
+        return not_modified
+    return stream_sitemap(shard_pages(section, number))
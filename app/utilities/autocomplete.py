@@ -0,0 +1,421 @@
+"""
+In-memory индекс автоподсказок для /api/search
+
+Индекс живет в памяти каждого воркера и хранится в компактных массивах:
+отсортированный список термов + смещения + массив постингов (CSR). Постинги
+содержат не id товара, а его "порядковый номер" в статическом порядке
+ранжирования (короткие названия выше, затем по id), поэтому лучшие подсказки
+получаются слиянием уже отсортированных списков без сортировки кандидатов.
+
+Изменения товаров в этом воркере применяются инкрементально (оверлей
+поверх базового индекса); оверлей сливается с базой при перестройке.
+"""
+import heapq
+import re
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from sqlalchemy import event, inspect, select
+
+from app import db
+from app.models import Product
+from app.utilities.helpers import normalize_article
+
+# Группы термов в порядке убывания релевантности
+GROUP_ARTICLE = 0      # артикул без разделителей
+GROUP_NAME_FIRST = 1   # первое слово названия
+GROUP_NAME = 2         # остальные слова названия
+GROUPS = (GROUP_ARTICLE, GROUP_NAME_FIRST, GROUP_NAME)
+
+# После стольких инкрементальных изменений оверлей сливается с базой
+OVERLAY_COMPACT_THRESHOLD = 1000
+
+_WORD_RE = re.compile(r'\w+')
+_MAX_TERM = '\U0010ffff'
+
+
+def product_terms(name, article):
+    """Возвращает множество пар (группа, терм) для товара"""
+    terms = set()
+    words = _WORD_RE.findall((name or '').lower())
+    for position, word in enumerate(words):
+        terms.add((GROUP_NAME_FIRST if position == 0 else GROUP_NAME, word))
+    article_key = normalize_article(article)
+    if article_key:
+        terms.add((GROUP_ARTICLE, article_key))
+    # Части артикула ("12345" из "AF-12345") ищутся как обычные слова
+    for part in _WORD_RE.findall((article or '').lower()):
+        terms.add((GROUP_NAME, part))
+    return terms
+
+
+class _TermTable:
+    """Неизменяемая таблица термов одной группы: термы, смещения, постинги"""
+
+    def __init__(self, pairs):
+        # pairs - отсортированный список (терм, порядковый номер)
+        self.terms = []
+        self.offsets = array('I', [0])
+        self.postings = array('I')
+        for term, ordinal in pairs:
+            if not self.terms or self.terms[-1] != term:
+                if self.terms:
+                    self.offsets.append(len(self.postings))
+                self.terms.append(sys.intern(term))
+            self.postings.append(ordinal)
+        self.offsets.append(len(self.postings))
+        if not self.terms:
+            self.offsets = array('I', [0])
+
+    def prefix_slices(self, prefix):
+        """Постинги всех термов, начинающихся с prefix (каждый срез отсортирован)"""
+        start = bisect_left(self.terms, prefix)
+        end = bisect_left(self.terms, prefix + _MAX_TERM, lo=start)
+        return [self.postings[self.offsets[i]:self.offsets[i + 1]] for i in range(start, end)]
+
+    def exact_slice(self, term):
+        i = bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return [self.postings[self.offsets[i]:self.offsets[i + 1]]]
+        return []
+
+    def memory_bytes(self):
+        return (sys.getsizeof(self.terms) + sum(sys.getsizeof(t) for t in self.terms) +
+                self.offsets.buffer_info()[1] * self.offsets.itemsize +
+                self.postings.buffer_info()[1] * self.postings.itemsize)
+
+
+class AutocompleteIndex:
+    """Индекс автоподсказок по названию и артикулу товара"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ready = False
+        self._refreshing = False
+        self._tables = {}
+        # Данные по порядковым номерам
+        self._ids = array('I')
+        self._names = []
+        self._articles = []
+        self._ordinal_by_id = {}
+        # Инкрементальные изменения поверх базы
+        self._overlay = {}
+        self._removed = set()
+        self._changes = 0
+        # Изменения, пришедшие во время перестройки (None - перестройки нет)
+        self._pending = None
+        self._stats = {'rebuilds': 0, 'last_rebuild_seconds': None, 'last_rebuild_at': None,
+                       'queries': 0, 'last_query_ms': None}
+
+    @property
+    def ready(self):
+        return self._ready
+
+    # === Построение ===
+    def rebuild(self):
+        """Полная перестройка индекса по таблице товаров"""
+        started = time.perf_counter()
+        # Чтение идет без блокировки: изменения, закоммиченные за это время,
+        # записываются в журнал и повторяются поверх новой базы при замене
+        with self._lock:
+            self._pending = []
+        try:
+            self._build(started)
+        finally:
+            self._pending = None
+
+    def _build(self, started):
+        rows = db.session.execute(select(Product.id, Product.name, Product.article)).all()
+        # Статический порядок: короткие названия выше, при равенстве - меньший id
+        rows.sort(key=lambda row: (len(row.name or ''), row.id))
+
+        ids = array('I')
+        names = []
+        articles = []
+        pairs = {group: [] for group in GROUPS}
+        for ordinal, (product_id, name, article) in enumerate(rows):
+            ids.append(product_id)
+            names.append(name or '')
+            articles.append(article or '')
+            for group, term in product_terms(name, article):
+                pairs[group].append((term, ordinal))
+
+        tables = {}
+        for group, group_pairs in pairs.items():
+            group_pairs.sort()
+            tables[group] = _TermTable(group_pairs)
+
+        with self._lock:
+            self._tables = tables
+            self._ids = ids
+            self._names = names
+            self._articles = articles
+            self._ordinal_by_id = {product_id: ordinal for ordinal, product_id in enumerate(ids)}
+            self._overlay = {}
+            self._removed = set()
+            self._changes = 0
+            for product_id, row in self._pending:
+                if row is None:
+                    self._remove_locked(product_id)
+                else:
+                    self._update_locked(*row)
+            self._sort_overlay_locked()
+            self._ready = True
+            self._stats['rebuilds'] += 1
+            self._stats['last_rebuild_seconds'] = round(time.perf_counter() - started, 4)
+            self._stats['last_rebuild_at'] = time.time()
+
+    def ensure(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    self.rebuild()
+
+    # === Инкрементальные изменения ===
+    def update_products(self, rows):
+        """Добавляет или обновляет товары: rows - итерируемое (id, name, article)"""
+        with self._lock:
+            if not self._ready and self._pending is None:
+                return
+            for row in rows:
+                if self._pending is not None:
+                    self._pending.append((row[0], tuple(row)))
+                if self._ready:
+                    self._update_locked(*row)
+            self._sort_overlay_locked()
+
+    def remove_products(self, product_ids):
+        with self._lock:
+            if not self._ready and self._pending is None:
+                return
+            for product_id in product_ids:
+                if self._pending is not None:
+                    self._pending.append((product_id, None))
+                if self._ready:
+                    self._remove_locked(product_id)
+
+    def _update_locked(self, product_id, name, article):
+        self._remove_locked(product_id)
+        # Новые версии получают номер в конце порядка до следующей перестройки
+        ordinal = len(self._ids)
+        self._ids.append(product_id)
+        self._names.append(name or '')
+        self._articles.append(article or '')
+        self._ordinal_by_id[product_id] = ordinal
+        for group, term in product_terms(name, article):
+            self._overlay.setdefault(group, []).append((term, ordinal))
+
+    def _remove_locked(self, product_id):
+        ordinal = self._ordinal_by_id.pop(product_id, None)
+        if ordinal is not None:
+            self._removed.add(ordinal)
+        self._changes += 1
+
+    def _sort_overlay_locked(self):
+        for group_pairs in self._overlay.values():
+            group_pairs.sort()
+
+    @property
+    def needs_compaction(self):
+        return self._changes >= OVERLAY_COMPACT_THRESHOLD
+
+    # === Поиск ===
+    def _group_streams(self, group, prefix, exact=False):
+        table = self._tables.get(group)
+        slices = []
+        if table is not None:
+            slices = table.exact_slice(prefix) if exact else table.prefix_slices(prefix)
+        overlay = self._overlay.get(group)
+        if overlay:
+            start = bisect_left(overlay, (prefix,))
+            end = bisect_left(overlay, (prefix + _MAX_TERM,), lo=start)
+            matched = [o for t, o in overlay[start:end] if not exact or t == prefix]
+            if matched:
+                slices.append(sorted(matched))
+        return slices
+
+    def _matches_all(self, ordinal, words):
+        tokens = _WORD_RE.findall(self._names[ordinal].lower())
+        tokens.extend(_WORD_RE.findall(self._articles[ordinal].lower()))
+        return all(any(token.startswith(word) for token in tokens) for word in words)
+
+    def suggest(self, query_text, limit=8):
+        """Возвращает id лучших товаров для подсказки в порядке релевантности"""
+        self.ensure()
+        started = time.perf_counter()
+        words = _WORD_RE.findall((query_text or '').lower())
+        article_key = normalize_article(query_text)
+        if not words and not article_key:
+            return []
+
+        # Ведущее слово - самое длинное (самое избирательное), остальные проверяются по товару
+        lead = max(words, key=len) if words else ''
+        others = [w for w in words if w != lead]
+
+        result = []
+        seen = set()
+        with self._lock:
+            plan = [
+                (GROUP_ARTICLE, article_key, True, []),
+                (GROUP_ARTICLE, article_key, False, []),
+                (GROUP_NAME_FIRST, lead, False, others),
+                (GROUP_NAME, lead, False, others),
+            ]
+            for group, prefix, exact, verify in plan:
+                if not prefix:
+                    continue
+                for ordinal in heapq.merge(*self._group_streams(group, prefix, exact)):
+                    if ordinal in seen or ordinal in self._removed:
+                        continue
+                    seen.add(ordinal)
+                    if verify and not self._matches_all(ordinal, verify):
+                        continue
+                    result.append(self._ids[ordinal])
+                    if len(result) >= limit:
+                        break
+                if len(result) >= limit:
+                    break
+
+        self._stats['queries'] += 1
+        self._stats['last_query_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        return result
+
+    # === Фоновая перестройка ===
+    def start_refresh(self):
+        """Помечает начало фоновой перестройки; False, если она уже идет"""
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+            return True
+
+    def finish_refresh(self):
+        try:
+            self.rebuild()
+        finally:
+            self._refreshing = False
+
+    # === Статистика ===
+    def stats_value(self, key):
+        return self._stats.get(key)
+
+    def memory_bytes(self):
+        with self._lock:
+            total = sum(table.memory_bytes() for table in self._tables.values())
+            total += self._ids.buffer_info()[1] * self._ids.itemsize
+            total += sys.getsizeof(self._names) + sum(sys.getsizeof(n) for n in self._names)
+            total += sys.getsizeof(self._articles) + sum(sys.getsizeof(a) for a in self._articles)
+            total += sys.getsizeof(self._ordinal_by_id)
+            total += sum(sys.getsizeof(pairs) for pairs in self._overlay.values())
+            return total
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'ready': self._ready,
+                'products': len(self._ordinal_by_id),
+                'terms': sum(len(table.terms) for table in self._tables.values()),
+                'postings': sum(len(table.postings) for table in self._tables.values()),
+                'overlay_changes': self._changes,
+            })
+        stats['memory_bytes'] = self.memory_bytes()
+        return stats
+
+
+autocomplete_index = AutocompleteIndex()
+
+
+def _run_in_background(app, func, name):
+    def target():
+        with app.app_context():
+            try:
+                func()
+            except Exception as e:
+                app.logger.warning(f'Ошибка при построении индекса автоподсказок: {e}')
+
+    threading.Thread(target=target, name=name, daemon=True).start()
+
+
+def warm_up(app):
+    """Строит индекс в фоне при старте приложения"""
+
+    def build():
+        # База может быть еще не создана (например, при запуске init_db.py)
+        if inspect(db.engine).has_table(Product.__tablename__):
+            autocomplete_index.ensure()
+
+    _run_in_background(app, build, 'autocomplete-warmup')
+
+
+def refresh_if_stale(app):
+    """
+    Перестраивает индекс в фоне, если он старше AUTOCOMPLETE_REFRESH_SECONDS
+
+    Изменения, сделанные в других воркерах, попадают в индекс этого воркера
+    только при перестройке. Разросшийся оверлей также сливается с базой.
+    """
+    max_age = app.config.get('AUTOCOMPLETE_REFRESH_SECONDS')
+    built_at = autocomplete_index.stats_value('last_rebuild_at')
+    if built_at is None:
+        return
+    expired = max_age and time.time() - built_at >= max_age
+    if not expired and not autocomplete_index.needs_compaction:
+        return
+    if autocomplete_index.start_refresh():
+        _run_in_background(app, autocomplete_index.finish_refresh, 'autocomplete-refresh')
+
+
+# === Синхронизация с изменениями товаров ===
+@event.listens_for(db.session, 'after_flush')
+def _collect_autocomplete_changes(session, flush_context):
+    changes = session.info.setdefault('autocomplete_changes', {'updated': set(), 'deleted': set()})
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Product):
+            changes['updated'].add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Product):
+            changes['deleted'].add(obj.id)
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _load_autocomplete_changes(session, flush_context):
+    """
+    Читает актуальные названия/артикулы, пока транзакция еще открыта
+
+    Строки читаются и до готовности индекса: если к коммиту начнется первое
+    построение, они попадут в его журнал (update_products).
+    """
+    changes = session.info.get('autocomplete_changes')
+    if not changes:
+        return
+    updated = changes['updated'] - changes['deleted']
+    if updated:
+        rows = session.connection().execute(
+            select(Product.id, Product.name, Product.article).where(Product.id.in_(updated))
+        ).all()
+        session.info.setdefault('autocomplete_rows', {}).update({row.id: tuple(row) for row in rows})
+    changes['updated'] = set()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_autocomplete_changes(session):
+    changes = session.info.pop('autocomplete_changes', None)
+    rows = session.info.pop('autocomplete_rows', {})
+    if not changes:
+        return
+    for product_id in changes['deleted']:
+        rows.pop(product_id, None)
+    if changes['deleted']:
+        autocomplete_index.remove_products(changes['deleted'])
+    if rows:
+        autocomplete_index.update_products(rows.values())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_autocomplete_changes(session):
+    session.info.pop('autocomplete_changes', None)
+    session.info.pop('autocomplete_rows', None)
@@ -0,0 +1,243 @@
+"""
+Кэши с ограничением размера и временем жизни записей
+
+Бэкенд задается URL:
+    memory://                      - LRU в памяти процесса (по умолчанию)
+    sqlite:////path/to/cache.db    - файл SQLite, общий для воркеров на одной машине
+    redis://host:6379/0            - Redis-совместимый сервер (нужен пакет redis)
+
+Значения сериализуются pickle, поэтому класть в кэш стоит простые данные
+(id, словари, строки), а не ORM-объекты.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class BaseCache:
+    """Общий интерфейс кэшей и счетчики попаданий"""
+
+    def __init__(self, max_entries=1000, default_ttl=300):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._counters = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0}
+        self._counters_lock = threading.Lock()
+
+    def _count(self, counter, amount=1):
+        with self._counters_lock:
+            self._counters[counter] += amount
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def get_or_set(self, key, compute, ttl=None):
+        """Возвращает значение из кэша или вычисляет и сохраняет его"""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.set(key, value, ttl)
+        return value
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+        stats['backend'] = self.name
+        return stats
+
+
+class MemoryCache(BaseCache):
+    """LRU-кэш в памяти процесса"""
+    name = 'memory'
+
+    def __init__(self, max_entries=1000, default_ttl=300):
+        super().__init__(max_entries, default_ttl)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self._count('hits')
+                    return value
+                del self._data[key]
+        self._count('misses')
+        return None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        evicted = 0
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evicted += 1
+        self._count('sets')
+        if evicted:
+            self._count('evictions', evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats['entries'] = len(self._data)
+        return stats
+
+
+class SqliteCache(BaseCache):
+    """Кэш в файле SQLite: общий для всех воркеров на одной машине"""
+    name = 'sqlite'
+
+    # Проверять переполнение раз в столько записей
+    EVICTION_CHECK_EVERY = 100
+
+    def __init__(self, path, max_entries=1000, default_ttl=300):
+        super().__init__(max_entries, default_ttl)
+        self.path = path
+        self._local = threading.local()
+        self._sets_since_check = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_accessed_at ON cache (accessed_at)')
+
+    def _connection(self):
+        # Отдельное соединение на поток; после fork воркера соединение создается заново
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            value, expires_at = row
+            if expires_at is None or expires_at > now:
+                connection.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+                self._count('hits')
+                return pickle.loads(value)
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+        self._count('misses')
+        return None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now + ttl if ttl else None, now)
+        )
+        self._count('sets')
+        self._sets_since_check += 1
+        if self._sets_since_check >= self.EVICTION_CHECK_EVERY:
+            self._sets_since_check = 0
+            self._evict(connection, now)
+
+    def _evict(self, connection, now):
+        """Удаляет просроченные записи и самые давно использованные сверх лимита"""
+        evicted = connection.execute('DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?',
+                                     (now,)).rowcount
+        overflow = connection.execute('SELECT count(*) FROM cache').fetchone()[0] - self.max_entries
+        if overflow > 0:
+            evicted += connection.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)',
+                (overflow,)
+            ).rowcount
+        if evicted:
+            self._count('evictions', evicted)
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+    def stats(self):
+        stats = super().stats()
+        stats['entries'] = self._connection().execute('SELECT count(*) FROM cache').fetchone()[0]
+        return stats
+
+
+class RedisCache(BaseCache):
+    """Кэш в Redis-совместимом хранилище; вытеснение выполняет сам сервер (maxmemory-policy)"""
+    name = 'redis'
+
+    def __init__(self, url, max_entries=1000, default_ttl=300, prefix='autoparts:'):
+        super().__init__(max_entries, default_ttl)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Для кэша в Redis установите пакет redis')
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        if value is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        self._client.set(self.prefix + key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                         ex=ttl or None)
+        self._count('sets')
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self._client.scan_iter(match=self.prefix + '*'):
+            self._client.delete(key)
+
+
+def create_cache(url=None, max_entries=1000, default_ttl=300):
+    """Создает кэш по URL бэкенда (см. описание модуля)"""
+    url = url or 'memory://'
+    if url.startswith('memory://'):
+        return MemoryCache(max_entries, default_ttl)
+    if url.startswith('sqlite:///'):
+        return SqliteCache(url[len('sqlite:///'):], max_entries, default_ttl)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url, max_entries, default_ttl)
+    raise ValueError(f'Неизвестный бэкенд кэша: {url}')
@@ -0,0 +1,660 @@
+"""
+Импорт и экспорт каталога товаров (CSV и JSONL)
+
+Файл читается потоком и обрабатывается пачками по IMPORT_BATCH_SIZE строк,
+каждая пачка - отдельная транзакция. Товары сопоставляются по артикулу
+(одним запросом на пачку): новые добавляются одним INSERT, у существующих
+обновляются только изменившиеся поля - одним UPDATE по первичному ключу на
+пачку. Колонки, которой нет в файле, и пустые значения не меняют товар,
+поэтому прайс поставщика из article;price;stock обновляет только цены и
+остатки.
+
+Колонки - FIELDS. Категории и кросс-номера перечисляются через ';'.
+Категория задается названием, а если названия в дереве повторяются - путем
+'Родитель → Категория' (так ее пишет экспорт). Бренды, страны и категории
+ищутся в словарях, загруженных один раз на импорт; slug нового товара
+строится из названия и артикула по множеству занятых slug, тоже загруженному
+один раз. Неизвестные бренды и страны с create_missing создаются, иначе
+строка пропускается с ошибкой; категории не создаются - место в дереве по
+названию не определить.
+
+Пачка пишется в обход ORM-объектов, поэтому хуки сессии (номера товаров,
+поисковый индекс, версии данных, кэш страниц, автоподсказки) не срабатывают
+и их работу делает импорт: номера, индекс и версии - в транзакции пачки,
+кэш страниц и автоподсказки - после ее коммита. Изображения импорт не
+трогает.
+
+В режиме dry_run выполняются все сопоставления и проверки, но ничего не
+пишется; отчет содержит изменения по полям.
+
+    flask catalog import FILE [--format csv|jsonl] [--dry-run] [--create-missing]
+    flask catalog export [--format csv|jsonl] [--output FILE]
+"""
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, insert, select, update
+
+from app import db
+from app.models import Brand, Category, Country, Product, ProductNumber, product_category
+from app.utilities.autocomplete import autocomplete_index
+from app.utilities.helpers import generate_slug, normalize_article, transliterate
+from app.utilities.page_cache import page_cache
+from app.utilities.versions import bump_versions, invalidate_local
+
+# Колонки файла в порядке экспорта
+FIELDS = ('article', 'name', 'brand', 'country', 'categories', 'price', 'stock',
+          'short_desc', 'full_desc', 'cross_numbers')
+
+# Предельная длина текстовых значений (по колонкам моделей)
+MAX_LENGTHS = {
+    'article': Product.__table__.c.article.type.length,
+    'name': Product.__table__.c.name.type.length,
+    'brand': Brand.__table__.c.name.type.length,
+    'country': Country.__table__.c.name.type.length,
+}
+SLUG_LENGTH = Product.__table__.c.slug.type.length - 10  # Запас под суффикс -N
+
+# Колонки, без которых не создать новый товар
+REQUIRED_FIELDS = ('name', 'brand', 'country', 'price')
+
+# Поля, от которых зависит поисковый документ товара (артикул при импорте не меняется)
+SEARCH_FIELDS = ('name', 'short_desc', 'full_desc', 'brand', 'categories')
+
+FORMATS = ('csv', 'jsonl')
+
+# Разделитель списков (категории, кросс-номера) и пути категории
+LIST_SEPARATOR = ';'
+PATH_SEPARATOR = ' → '
+
+# Строк в одной транзакции импорта и товаров в одном запросе экспорта
+IMPORT_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+
+# Сколько ошибок и изменений хранить в отчете (счетчики считают все)
+REPORT_LIMIT = 200
+
+
+class RowError(ValueError):
+    """Строку нельзя импортировать; остальные строки обрабатываются дальше"""
+
+
+class ImportReport:
+    """Итог импорта: счетчики, ошибки и изменения по полям"""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.errors = []  # (строка, артикул, сообщение)
+        self.changes = []  # (строка, артикул, {поле: (было, стало)}); для новых товаров было - None
+        # Новые бренды и страны: {название.casefold(): название}
+        self.new_brands = {}
+        self.new_countries = {}
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows / self.seconds) if self.seconds else None
+
+    def error(self, line, article, message):
+        self.failed += 1
+        if len(self.errors) < REPORT_LIMIT:
+            self.errors.append((line, article, message))
+
+    def change(self, line, article, fields):
+        if len(self.changes) < REPORT_LIMIT:
+            self.changes.append((line, article, fields))
+
+    def summary(self):
+        verb = 'будет ' if self.dry_run else ''
+        text = (f'Строк: {self.rows} за {self.seconds:.2f} c ({self.rows_per_second or 0} строк/с); '
+                f'{verb}создано: {self.created}, {verb}обновлено: {self.updated}, '
+                f'без изменений: {self.unchanged}, с ошибкой: {self.failed}')
+        if self.new_brands or self.new_countries:
+            text += f'; новых брендов: {len(self.new_brands)}, стран: {len(self.new_countries)}'
+        return text
+
+
+# === Чтение файла ===
+def detect_format(filename):
+    """Формат по расширению файла; None - не распознан"""
+    ext = os.path.splitext(filename or '')[1].lower()
+    return {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}.get(ext)
+
+
+def read_rows(stream, file_format):
+    """
+    Строки файла из бинарного потока: (номер строки, словарь колонок)
+
+    Заголовок CSV приводится к нижнему регистру, разделитель (',', ';' или
+    табуляция) определяется по нему. Битая строка JSONL отдается как RowError.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'jsonl':
+        for number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                row = RowError(f'Некорректный JSON: {e}')
+            if not isinstance(row, (dict, RowError)):
+                row = RowError('Строка JSONL должна быть объектом')
+            yield number, row
+        return
+
+    header_line = text.readline()
+    delimiter = max((',', ';', '\t'), key=header_line.count)
+    reader = csv.reader(itertools.chain([header_line], text), delimiter=delimiter)
+    header = [name.strip().lower() for name in next(reader, [])]
+    if 'article' not in header:
+        raise ValueError('В файле нет колонки article')
+    for values in reader:
+        if any(value.strip() for value in values):
+            yield reader.line_num, dict(zip(header, values))
+
+
+def _text(value, field, max_length=None):
+    value = str(value).strip() if value is not None else ''
+    if max_length and len(value) > max_length:
+        raise RowError(f'{field}: длиннее {max_length} символов')
+    return value
+
+
+def _number(value, field, convert):
+    try:
+        number = convert(str(value).replace(' ', '').replace('\xa0', '').replace(',', '.'))
+    except ValueError:
+        raise RowError(f'{field}: не число ({value})') from None
+    if not math.isfinite(number) or number < 0:
+        raise RowError(f'{field}: недопустимое значение ({value})')
+    return number
+
+
+def _list(value):
+    if isinstance(value, list):
+        items = value
+    else:
+        items = str(value).split(LIST_SEPARATOR)
+    return [str(item).strip() for item in items if str(item).strip()]
+
+
+def parse_row(row):
+    """
+    Артикул и значения полей строки файла (RowError - строку нельзя импортировать)
+
+    В значениях только непустые колонки из FIELDS: бренд, страна и категории -
+    названиями, кросс-номера - словарем {нормализованный: как в файле}.
+    """
+    if isinstance(row, RowError):
+        raise row
+    article = _text(row.get('article'), 'article', MAX_LENGTHS['article'])
+    if not article:
+        raise RowError('Не указан артикул')
+
+    values = {}
+    for field in FIELDS[1:]:
+        raw = row.get(field)
+        if raw is None or (not isinstance(raw, list) and str(raw).strip() == ''):
+            continue
+        if field == 'price':
+            values[field] = _number(raw, field, float)
+        elif field == 'stock':
+            values[field] = _number(raw, field, int)
+        elif field == 'categories':
+            values[field] = frozenset(_list(raw))
+        elif field == 'cross_numbers':
+            numbers = {}
+            for number in _list(raw):
+                numbers.setdefault(normalize_article(number), number)
+            numbers.pop('', None)
+            values[field] = numbers
+        else:
+            values[field] = _text(raw, field, MAX_LENGTHS.get(field))
+    return article, values
+
+
+# === Импорт ===
+def _category_paths(connection):
+    """{id: 'Родитель → Категория'} по всему дереву (категорий немного - читаются целиком)"""
+    rows = {category_id: (name, parent_id) for category_id, name, parent_id
+            in connection.execute(select(Category.id, Category.name, Category.parent_id))}
+    paths = {}
+
+    def path(category_id):
+        if category_id not in paths:
+            name, parent_id = rows[category_id]
+            paths[category_id] = name
+            if parent_id in rows:
+                paths[category_id] = path(parent_id) + PATH_SEPARATOR + name
+        return paths[category_id]
+
+    for category_id in rows:
+        path(category_id)
+    return paths
+
+
+class CatalogImport:
+    """Импорт строк файла пачками; словари брендов, стран, категорий и slug - на весь импорт"""
+
+    def __init__(self, dry_run=False, create_missing=False, batch_size=IMPORT_BATCH_SIZE):
+        self.dry_run = dry_run
+        self.create_missing = create_missing
+        self.batch_size = batch_size
+        self.report = ImportReport(dry_run)
+
+        connection = db.session.connection()
+        self.brands = {name.casefold(): (brand_id, name) for brand_id, name
+                       in connection.execute(select(Brand.id, Brand.name))}
+        self.brand_slugs = set(connection.execute(select(Brand.slug)).scalars())
+        self.countries = {name.casefold(): (country_id, name) for country_id, name
+                          in connection.execute(select(Country.id, Country.name))}
+        self.category_paths = _category_paths(connection)
+        self.categories_by_path = {path.casefold(): category_id for category_id, path in self.category_paths.items()}
+        self.categories_by_name = {}
+        for category_id, path in self.category_paths.items():
+            name = path.rsplit(PATH_SEPARATOR, 1)[-1].casefold()
+            self.categories_by_name.setdefault(name, []).append(category_id)
+        self._product_slugs = None
+        db.session.commit()
+
+    @property
+    def product_slugs(self):
+        # Нужны только при создании товаров - читаются при первом новом товаре
+        if self._product_slugs is None:
+            self._product_slugs = set(db.session.execute(select(Product.slug)).scalars())
+        return self._product_slugs
+
+    def run(self, rows, progress=None):
+        """Импортирует строки read_rows(); progress(report) вызывается после каждой пачки"""
+        started = time.perf_counter()
+        batch = {}
+        for line, row in rows:
+            self.report.rows += 1
+            try:
+                article, values = parse_row(row)
+            except RowError as e:
+                self.report.error(line, row.get('article') if isinstance(row, dict) else None, str(e))
+                continue
+            # Повтор артикула в пачке: поля более поздней строки дополняют и перекрывают ранние
+            previous = batch.pop(article, (None, {}))[1]
+            batch[article] = (line, {**previous, **values})
+            if len(batch) >= self.batch_size:
+                self._import_batch(batch)
+                batch = {}
+                self.report.seconds = time.perf_counter() - started
+                if progress:
+                    progress(self.report)
+        if batch:
+            self._import_batch(batch)
+        self.report.seconds = time.perf_counter() - started
+        return self.report
+
+    # === Сопоставление ===
+    def _check_reference(self, lookup, created, name, label):
+        """Бренд/страна по названию; неизвестное название с create_missing запоминается для создания"""
+        if name.casefold() in lookup:
+            return
+        if not self.create_missing:
+            raise RowError(f'{label}: {name}')
+        created.setdefault(name.casefold(), name)
+
+    def _category_ids(self, names):
+        ids = set()
+        for name in names:
+            # Полный путь однозначен; просто название - если такая категория одна
+            category_id = self.categories_by_path.get(name.casefold())
+            if category_id is None:
+                found = self.categories_by_name.get(name.casefold())
+                if not found:
+                    raise RowError(f'Неизвестная категория: {name}')
+                if len(found) > 1:
+                    raise RowError(f'Категорий «{name}» несколько, укажите путь: Родитель{PATH_SEPARATOR}{name}')
+                category_id = found[0]
+            ids.add(category_id)
+        return frozenset(ids)
+
+    def _resolve(self, values):
+        """Поля товара по значениям строки: категории - id, бренд и страна проверяются по словарям"""
+        fields = {field: value for field, value in values.items() if field not in ('brand', 'country', 'categories')}
+        if 'brand' in values:
+            fields['brand'] = values['brand']
+            self._check_reference(self.brands, self.report.new_brands, values['brand'], 'Неизвестный бренд')
+        if 'country' in values:
+            fields['country'] = values['country']
+            self._check_reference(self.countries, self.report.new_countries, values['country'], 'Неизвестная страна')
+        if 'categories' in values:
+            fields['categories'] = self._category_ids(values['categories'])
+        return fields
+
+    def _current(self, connection, articles):
+        """Текущие значения товаров пачки: {артикул: поля}; категории и кросс-номера - одним запросом каждые"""
+        current = {}
+        for row in connection.execute(
+            select(Product.id, Product.article, Product.name, Product.price, Product.stock, Product.short_desc,
+                   Product.full_desc, Brand.name.label('brand'), Country.name.label('country'))
+            .outerjoin(Brand, Brand.id == Product.brand_id)
+            .outerjoin(Country, Country.id == Product.country_id)
+            .where(Product.article.in_(articles))
+        ).mappings():
+            current[row['article']] = dict(row, categories=frozenset(), cross_numbers={})
+        by_id = {fields['id']: fields for fields in current.values()}
+        if by_id:
+            for product_id, category_id in connection.execute(
+                select(product_category.c.product_id, product_category.c.category_id)
+                .where(product_category.c.product_id.in_(by_id))
+            ):
+                by_id[product_id]['categories'] |= {category_id}
+            for product_id, number, normalized in connection.execute(
+                select(ProductNumber.product_id, ProductNumber.number, ProductNumber.normalized)
+                .where(ProductNumber.product_id.in_(by_id), ProductNumber.is_cross.is_(True))
+            ):
+                by_id[product_id]['cross_numbers'][normalized] = number
+        return current
+
+    @staticmethod
+    def _same(field, old, new):
+        if field in ('brand', 'country'):
+            return (old or '').casefold() == new.casefold()
+        if field == 'cross_numbers':
+            return old.keys() == new.keys()
+        return old == new
+
+    def _shown(self, field, value):
+        """Значение поля для отчета"""
+        if field == 'categories':
+            return sorted(self.category_paths[category_id] for category_id in value)
+        if field == 'cross_numbers':
+            return sorted(value.values())
+        return value
+
+    # === Пачка ===
+    def _import_batch(self, batch):
+        connection = db.session.connection()
+        current = self._current(connection, list(batch))
+        new, changed = {}, {}
+        for article, (line, values) in batch.items():
+            try:
+                fields = self._resolve(values)
+                old = current.get(article)
+                if old is None:
+                    missing = [field for field in REQUIRED_FIELDS if field not in fields]
+                    if missing:
+                        raise RowError(f'Новый товар без полей: {", ".join(missing)}')
+                    new[article] = fields
+                    self.report.change(line, article, {field: (None, self._shown(field, value))
+                                                       for field, value in fields.items()})
+                    continue
+                diff = {field: value for field, value in fields.items() if not self._same(field, old[field], value)}
+                if not diff:
+                    self.report.unchanged += 1
+                    continue
+                changed[article] = diff
+                self.report.change(line, article, {field: (self._shown(field, old[field]), self._shown(field, value))
+                                                   for field, value in diff.items()})
+            except RowError as e:
+                self.report.error(line, article, str(e))
+
+        self.report.created += len(new)
+        self.report.updated += len(changed)
+        if self.dry_run or not (new or changed):
+            db.session.rollback()
+            return
+        try:
+            self._write(connection, new, changed, {article: fields['id'] for article, fields in current.items()})
+        except BaseException:
+            db.session.rollback()
+            raise
+
+    def _reference_ids(self, connection, model, lookup, names):
+        """id по названиям; недостающие бренды/страны добавляются в транзакции пачки"""
+        # Написания одного названия в разном регистре - один бренд/страна
+        missing = {}
+        for name in names:
+            if name.casefold() not in lookup:
+                missing.setdefault(name.casefold(), name)
+        if missing:
+            rows = []
+            for _, name in sorted(missing.items()):
+                row = {'name': name}
+                if model is Brand:
+                    row['slug'] = generate_slug(name, self.brand_slugs)
+                    self.brand_slugs.add(row['slug'])
+                rows.append(row)
+            for record_id, name in connection.execute(insert(model).returning(model.id, model.name), rows):
+                lookup[name.casefold()] = (record_id, name)
+        return {name: lookup[name.casefold()][0] for name in names}
+
+    def _write(self, connection, new, changed, product_ids):
+        rows = list(new.values()) + list(changed.values())
+        references = len(self.brands) + len(self.countries)
+        brand_ids = self._reference_ids(connection, Brand, self.brands,
+                                        {fields['brand'] for fields in rows if 'brand' in fields})
+        country_ids = self._reference_ids(connection, Country, self.countries,
+                                          {fields['country'] for fields in rows if 'country' in fields})
+
+        def columns(fields):
+            values = {field: value for field, value in fields.items()
+                      if field not in ('brand', 'country', 'categories', 'cross_numbers')}
+            if 'brand' in fields:
+                values['brand_id'] = brand_ids[fields['brand']]
+            if 'country' in fields:
+                values['country_id'] = country_ids[fields['country']]
+            return values
+
+        if new:
+            inserts = []
+            for article, fields in new.items():
+                slug = transliterate(f'{fields["name"]} {article}')[:SLUG_LENGTH].rstrip('-')
+                if slug in self.product_slugs:
+                    slug = generate_slug(slug, self.product_slugs)
+                self.product_slugs.add(slug)
+                inserts.append(dict(columns(fields), article=article, slug=slug))
+            # Через сессию: ORM группирует строки с разным набором колонок
+            for product_id, article in db.session.execute(insert(Product).returning(Product.id, Product.article),
+                                                          inserts):
+                product_ids[article] = product_id
+            connection.execute(insert(ProductNumber), [
+                {'product_id': product_ids[article], 'number': article,
+                 'normalized': normalize_article(article), 'is_cross': False}
+                for article in new
+            ])
+
+        updates = [dict(columns(fields), id=product_ids[article]) for article, fields in changed.items()]
+        updates = [values for values in updates if len(values) > 1]
+        if updates:
+            db.session.execute(update(Product), updates)
+
+        written = {**changed, **new}
+        categories = {product_ids[article]: fields['categories']
+                      for article, fields in written.items() if 'categories' in fields}
+        if categories:
+            connection.execute(delete(product_category).where(product_category.c.product_id.in_(categories)))
+            links = [{'product_id': product_id, 'category_id': category_id}
+                     for product_id, ids in categories.items() for category_id in ids]
+            if links:
+                connection.execute(insert(product_category), links)
+
+        cross_numbers = {product_ids[article]: fields['cross_numbers']
+                         for article, fields in written.items() if 'cross_numbers' in fields}
+        if cross_numbers:
+            connection.execute(delete(ProductNumber).where(ProductNumber.product_id.in_(cross_numbers),
+                                                           ProductNumber.is_cross.is_(True)))
+            numbers = [{'product_id': product_id, 'number': number, 'normalized': normalized, 'is_cross': True}
+                       for product_id, numbers in cross_numbers.items() for normalized, number in numbers.items()]
+            if numbers:
+                connection.execute(insert(ProductNumber), numbers)
+
+        # Поисковый документ - только у товаров, где изменились попадающие в него поля
+        search_ids = [product_ids[article] for article, fields in written.items()
+                      if article in new or any(field in fields for field in SEARCH_FIELDS)]
+        backend = current_app.extensions.get('search_index')
+        if backend is not None and search_ids:
+            backend.ensure(connection)
+            backend.index_products(connection, search_ids)
+
+        # Новые бренды и страны меняют навигацию и фильтры каталога
+        navigation = references != len(self.brands) + len(self.countries)
+        bump_versions(connection, ['catalog', 'navigation'] if navigation else ['catalog'])
+        db.session.commit()
+
+        # После коммита: версии этого воркера, кэш страниц и автоподсказки
+        invalidate_local()
+        tags = ['catalog', 'navigation'] if navigation else ['catalog']
+        page_cache.invalidate(tags + [f'product:{product_ids[article]}' for article in written])
+        named = {product_ids[article]: (product_ids[article], fields['name'], article)
+                 for article, fields in written.items() if 'name' in fields}
+        if named:
+            autocomplete_index.update_products(named.values())
+
+
+def import_catalog(stream, file_format, dry_run=False, create_missing=False, batch_size=IMPORT_BATCH_SIZE,
+                   progress=None):
+    """Импорт каталога из бинарного потока; возвращает ImportReport"""
+    importer = CatalogImport(dry_run, create_missing, batch_size)
+    return importer.run(read_rows(stream, file_format), progress)
+
+
+# === Экспорт ===
+def export_rows():
+    """Товары каталога словарями FIELDS (генератор), по EXPORT_BATCH_SIZE товаров на запрос"""
+    connection = db.session.connection()
+    paths = _category_paths(connection)
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(Product.id, Product.article, Product.name, Brand.name, Country.name, Product.price,
+                   Product.stock, Product.short_desc, Product.full_desc)
+            .outerjoin(Brand, Brand.id == Product.brand_id)
+            .outerjoin(Country, Country.id == Product.country_id)
+            .where(Product.id > last_id)
+            .order_by(Product.id)
+            .limit(EXPORT_BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        ids = [row[0] for row in rows]
+        categories, numbers = {}, {}
+        for product_id, category_id in connection.execute(
+            select(product_category.c.product_id, product_category.c.category_id)
+            .where(product_category.c.product_id.in_(ids))
+        ):
+            categories.setdefault(product_id, []).append(paths[category_id])
+        for product_id, number in connection.execute(
+            select(ProductNumber.product_id, ProductNumber.number)
+            .where(ProductNumber.product_id.in_(ids), ProductNumber.is_cross.is_(True))
+            .order_by(ProductNumber.id)
+        ):
+            numbers.setdefault(product_id, []).append(number)
+
+        for product_id, article, name, brand, country, price, stock, short_desc, full_desc in rows:
+            yield {'article': article, 'name': name, 'brand': brand, 'country': country,
+                   'categories': sorted(categories.get(product_id, [])), 'price': price, 'stock': stock,
+                   'short_desc': short_desc or '', 'full_desc': full_desc or '',
+                   'cross_numbers': numbers.get(product_id, [])}
+        last_id = ids[-1]
+
+
+def export_chunks(file_format):
+    """Куски текста экспорта; CSV - с BOM и ';', чтобы файл сразу открывался в Excel"""
+    rows = export_rows()
+    if file_format == 'jsonl':
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';', lineterminator='\n')
+    buffer.write('\ufeff')
+    writer.writerow(FIELDS)
+    for number, row in enumerate(rows, 1):
+        writer.writerow([LIST_SEPARATOR.join(row[field]) if isinstance(row[field], list) else row[field]
+                         for field in FIELDS])
+        if number % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# === CLI ===
+catalog_cli = AppGroup('catalog', help='Импорт и экспорт каталога товаров')
+
+
+def _format_of(filename, file_format):
+    file_format = file_format or detect_format(filename)
+    if file_format is None:
+        raise click.UsageError('Не удалось определить формат по имени файла, укажите --format')
+    return file_format
+
+
+def _shown_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, list):
+        return LIST_SEPARATOR.join(value) or '-'
+    text = str(value)
+    return text if len(text) <= 60 else text[:57] + '...'
+
+
+@catalog_cli.command('import')
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', 'file_format', type=click.Choice(FORMATS), help='Формат (по умолчанию - по расширению)')
+@click.option('--dry-run', is_flag=True, help='Только показать изменения, ничего не записывая')
+@click.option('--create-missing', is_flag=True, help='Создавать неизвестные бренды и страны')
+@click.option('--batch-size', type=click.IntRange(1), default=IMPORT_BATCH_SIZE, show_default=True,
+              help='Строк в одной транзакции')
+@click.option('--show', type=click.IntRange(0), default=20, show_default=True,
+              help='Сколько изменений и ошибок вывести')
+def import_command(file, file_format, dry_run, create_missing, batch_size, show):
+    """Импортировать товары из CSV или JSONL (обновление по артикулу)"""
+    file_format = _format_of(file.name, file_format)
+
+    def progress(report):
+        click.echo(f'... {report.rows} строк, {report.rows_per_second} строк/с', err=True)
+
+    try:
+        report = import_catalog(file, file_format, dry_run, create_missing, batch_size, progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    for line, article, fields in report.changes[:show]:
+        mark = '+' if all(old is None for old, _ in fields.values()) else '~'
+        details = '; '.join(f'{field}: {_shown_value(old)} → {_shown_value(new)}'
+                            for field, (old, new) in fields.items())
+        click.echo(f'{mark} {article} (строка {line}): {details}')
+    for line, article, message in report.errors[:show]:
+        click.echo(f'! {article or "-"} (строка {line}): {message}')
+    if report.new_brands or report.new_countries:
+        click.echo(f'Новые бренды: {", ".join(sorted(report.new_brands.values())) or "-"}; '
+                   f'страны: {", ".join(sorted(report.new_countries.values())) or "-"}')
+    click.echo(('Пробный запуск, ничего не записано. ' if dry_run else '') + report.summary())
+
+
+@catalog_cli.command('export')
+@click.option('--format', 'file_format', type=click.Choice(FORMATS), help='Формат (по умолчанию - по расширению)')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-',
+              help='Файл (по умолчанию - stdout)')
+def export_command(file_format, output):
+    """Выгрузить товары в CSV или JSONL"""
+    file_format = file_format or detect_format(output.name) or 'csv'
+    started = time.perf_counter()
+    for chunk in export_chunks(file_format):
+        output.write(chunk)
+    click.echo(f'Выгружено за {time.perf_counter() - started:.2f} c', err=True)
+
+
+def init_app(app):
+    app.cli.add_command(catalog_cli)
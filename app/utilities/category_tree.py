@@ -0,0 +1,132 @@
+"""
+Дерево категорий в таблице замыкания (category_closure)
+
+Для каждой категории хранятся все ее предки с глубиной, поэтому товары
+поддерева любой глубины и количество товаров по всем категориям
+получаются одним запросом. Таблица пересчитывается целиком
+в той же транзакции, что и создание, перенос или удаление категории:
+категорий немного, а так дерево не может разойтись с parent_id.
+"""
+from flask import has_app_context
+from sqlalchemy import delete, distinct, event, func, inspect, select
+
+from app import db
+from app.models import Category, CategoryClosure, product_category
+
+_table_ready = False
+
+
+def build_closure(parents):
+    """Строит строки замыкания по словарю {id категории: id родителя}"""
+    rows = []
+    for category_id in parents:
+        ancestor_id, depth, visited = category_id, 0, set()
+        # visited защищает от циклов в parent_id (категория стала потомком самой себя)
+        while ancestor_id is not None and ancestor_id not in visited:
+            visited.add(ancestor_id)
+            rows.append({'ancestor_id': ancestor_id, 'descendant_id': category_id, 'depth': depth})
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    return rows
+
+
+def rebuild_closure(connection):
+    """Пересчитывает таблицу замыкания по текущим parent_id"""
+    _ensure_table(connection, populate=False)
+    fill_closure(connection)
+
+
+def fill_closure(connection):
+    """Заполняет таблицу замыкания заново (таблица должна существовать)"""
+    parents = dict(connection.execute(select(Category.id, Category.parent_id)).all())
+    connection.execute(delete(CategoryClosure))
+    rows = build_closure(parents)
+    if rows:
+        connection.execute(CategoryClosure.__table__.insert(), rows)
+
+
+def _ensure_table(connection, populate=True):
+    """
+    Создает (и с populate заполняет) таблицу замыкания; True - она изменена в транзакции connection
+
+    Готовой таблица считается только после фиксации этой транзакции: при откате
+    (SQLite не откатывает CREATE TABLE, но откатывает заполнение) следующий
+    вызов заполнит ее снова.
+    """
+    global _table_ready
+    if _table_ready:
+        return False
+    if inspect(connection).has_table(CategoryClosure.__tablename__) and (
+            not populate or connection.execute(select(CategoryClosure.depth).limit(1)).first() is not None):
+        _table_ready = True
+        return False
+    CategoryClosure.__table__.create(connection, checkfirst=True)
+    # Таблица могла появиться через create_all в базе, где категории уже были
+    if populate:
+        fill_closure(connection)
+    event.listen(connection, 'commit', _mark_table_ready, once=True)
+    return True
+
+
+def _mark_table_ready(connection):
+    global _table_ready
+    _table_ready = True
+
+
+def ensure_closure():
+    """Создает и заполняет таблицу замыкания в базе без миграции 0006 при первом обращении"""
+    if _ensure_table(db.session.connection()):
+        # Заполнение сделано в транзакции запроса: без фиксации оно пропало бы при ее откате
+        db.session.commit()
+
+
+def subtree_ids(category_id):
+    """Подзапрос: id категории и всех ее потомков"""
+    ensure_closure()
+    return select(CategoryClosure.descendant_id).where(CategoryClosure.ancestor_id == category_id)
+
+
+def products_in_subtree(category_id):
+    """Подзапрос: id товаров категории и всех ее потомков (для Product.id.in_())"""
+    return select(product_category.c.product_id) \
+        .where(product_category.c.category_id.in_(subtree_ids(category_id)))
+
+
+def product_counts(include_descendants=True):
+    """
+    Количество товаров по категориям {id категории: количество}
+
+    С include_descendants товар подкатегории учитывается и во всех ее предках
+    (без повторов, если товар лежит в нескольких категориях поддерева).
+    """
+    if not include_descendants:
+        return dict(db.session.execute(
+            select(product_category.c.category_id, func.count())
+            .group_by(product_category.c.category_id)
+        ).all())
+    ensure_closure()
+    return dict(db.session.execute(
+        select(CategoryClosure.ancestor_id, func.count(distinct(product_category.c.product_id)))
+        .join(product_category, product_category.c.category_id == CategoryClosure.descendant_id)
+        .group_by(CategoryClosure.ancestor_id)
+    ).all())
+
+
+# === Поддержка таблицы замыкания при изменении категорий ===
+@event.listens_for(db.session, 'after_flush')
+def _collect_tree_changes(session, flush_context):
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Category):
+            session.info['category_tree_changed'] = True
+            return
+    for obj in session.dirty:
+        if isinstance(obj, Category) and (inspect(obj).attrs.parent_id.history.has_changes()
+                                          or inspect(obj).attrs.parent.history.has_changes()):
+            session.info['category_tree_changed'] = True
+            return
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _apply_tree_changes(session, flush_context):
+    if session.info.pop('category_tree_changed', False) and has_app_context():
+        rebuild_closure(session.connection())
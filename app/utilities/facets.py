@@ -0,0 +1,147 @@
+"""
+Фасеты каталога: сколько товаров даст каждый бренд, страна и диапазон цен
+
+Все счетчики считаются одним GROUP BY по (бренд, страна, диапазон цены,
+попадание в фильтр цены) для товаров текущей категории. Получается небольшая
+матрица (брендов x стран x диапазонов, только непустые сочетания), из которой
+счетчики для каждого фасета складываются в Python с учетом остальных фильтров:
+счетчик бренда показывает, сколько товаров будет, если отметить этот бренд
+при уже выбранных странах и цене. Матрица кэшируется до изменения каталога.
+"""
+import hashlib
+import heapq
+from collections import Counter, namedtuple
+
+from flask import request, url_for
+from sqlalchemy import and_, case, func, literal, select
+
+from app import db
+from app.models import Product
+from app.utilities.cache import MemoryCache
+from app.utilities.category_tree import products_in_subtree
+from app.utilities.navigation import get_navigation
+from app.utilities.versions import get_version
+
+# Сколько самых частых значений фасета показывать (отмеченные показываются всегда)
+FACET_VALUES_LIMIT = 10
+
+# Верхние границы диапазонов цен (последний диапазон - без верхней границы)
+PRICE_BUCKETS = (500, 1000, 2500, 5000, 10000, 25000)
+
+CatalogFilters = namedtuple('CatalogFilters', 'category_id price_from price_to brand_ids country_ids')
+FacetValue = namedtuple('FacetValue', 'item count selected')
+PriceBucket = namedtuple('PriceBucket', 'price_from price_to count selected')
+Facets = namedtuple('Facets', 'brands countries prices total')
+
+_matrix_cache = MemoryCache(max_entries=1000, default_ttl=600)
+
+
+def price_bucket_bounds():
+    """Границы диапазонов цен: [(от, до), ...], до=None у последнего"""
+    lower = [0] + list(PRICE_BUCKETS)
+    upper = list(PRICE_BUCKETS) + [None]
+    return list(zip(lower, upper))
+
+
+def facet_matrix(filters):
+    """
+    Строки (brand_id, country_id, номер диапазона цены, попадает ли в фильтр цены, количество)
+
+    Фильтры брендов и стран в запрос не входят - они применяются при сложении,
+    поэтому одна матрица годится для любых отметок в сайдбаре.
+    """
+    bucket = case(*((Product.price < upper, i) for i, upper in enumerate(PRICE_BUCKETS)),
+                  else_=len(PRICE_BUCKETS))
+    price_conditions = []
+    if filters.price_from is not None:
+        price_conditions.append(Product.price >= filters.price_from)
+    if filters.price_to is not None:
+        price_conditions.append(Product.price <= filters.price_to)
+    in_price = case((and_(*price_conditions), 1), else_=0) if price_conditions else literal(1)
+
+    query = select(Product.brand_id, Product.country_id, bucket, in_price, func.count()) \
+        .group_by(Product.brand_id, Product.country_id, bucket, in_price)
+    if filters.category_id:
+        query = query.where(Product.id.in_(products_in_subtree(filters.category_id)))
+    return [tuple(row) for row in db.session.execute(query).all()]
+
+
+def _marginals(rows, filters):
+    """Счетчики бренды/страны/диапазоны цен и итог по матрице с учетом отметок"""
+    brand_counts, country_counts, bucket_counts = Counter(), Counter(), Counter()
+    total = 0
+    for brand_id, country_id, bucket, in_price, count in rows:
+        brand_ok = not filters.brand_ids or brand_id in filters.brand_ids
+        country_ok = not filters.country_ids or country_id in filters.country_ids
+        if country_ok and in_price:
+            brand_counts[brand_id] += count
+        if brand_ok and in_price:
+            country_counts[country_id] += count
+        if brand_ok and country_ok:
+            bucket_counts[bucket] += count
+            if in_price:
+                total += count
+    return brand_counts, country_counts, bucket_counts, total
+
+
+def cached_facet_matrix(filters):
+    """
+    Матрица и счетчики без отметок брендов/стран (самый частый случай) из кэша
+
+    Ключ - категория, фильтр цены и версия каталога.
+    """
+    key = hashlib.sha1(repr((filters.category_id, filters.price_from, filters.price_to)).encode()).hexdigest()
+
+    def compute():
+        rows = facet_matrix(filters)
+        return rows, _marginals(rows, filters._replace(brand_ids=frozenset(), country_ids=frozenset()))
+
+    return _matrix_cache.get_or_set(f'facets:{get_version("catalog")}:{key}', compute)
+
+
+def _top_values(items_by_id, counts, selected_ids, limit):
+    """Отмеченные значения и limit самых частых (отмеченные - первыми, чтобы их можно было снять)"""
+    selected = [FacetValue(items_by_id[item_id], counts.get(item_id, 0), True)
+                for item_id in selected_ids if item_id in items_by_id]
+    selected.sort(key=lambda value: value.item.name)
+    top = heapq.nsmallest(
+        limit,
+        ((-count, items_by_id[item_id].name, item_id) for item_id, count in counts.items()
+         if count and item_id in items_by_id and item_id not in selected_ids)
+    )
+    return selected + [FacetValue(items_by_id[item_id], -count, False) for count, _, item_id in top]
+
+
+def catalog_facets(filters, limit=FACET_VALUES_LIMIT):
+    """Фасеты для текущих фильтров каталога"""
+    rows, marginals = cached_facet_matrix(filters)
+    if filters.brand_ids or filters.country_ids:
+        marginals = _marginals(rows, filters)
+    brand_counts, country_counts, bucket_counts, total = marginals
+
+    navigation = get_navigation()
+    prices = []
+    for i, (price_from, price_to) in enumerate(price_bucket_bounds()):
+        if bucket_counts.get(i):
+            selected = filters.price_from == price_from and filters.price_to == price_to
+            prices.append(PriceBucket(price_from, price_to, bucket_counts[i], selected))
+
+    return Facets(
+        brands=_top_values(navigation.brand_by_id, brand_counts, filters.brand_ids, limit),
+        countries=_top_values(navigation.country_by_id, country_counts, filters.country_ids, limit),
+        prices=prices,
+        total=total,
+    )
+
+
+def filter_url(**changes):
+    """Ссылка на текущую страницу каталога с измененными фильтрами (None убирает параметр)"""
+    args = request.args.to_dict(flat=False)
+    args.pop('page', None)
+    args.pop('cursor', None)
+    for key, value in changes.items():
+        if value is None:
+            args.pop(key, None)
+        else:
+            args[key] = value
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
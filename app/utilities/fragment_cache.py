@@ -0,0 +1,103 @@
+"""
+Кэш фрагментов шаблонов
+
+Расширение Jinja добавляет тег cache:
+
+    {% cache ('latest-news', news.id), 300, 'news' %}
+        ... {% for item in latest_news(3, exclude_id=news.id) %} ...
+    {% endcache %}
+
+Аргументы: ключ (строка или кортеж простых значений), время жизни в
+секундах (0 - без срока, не задано - FRAGMENT_CACHE_TTL) и группы данных
+versions.py, от которых зависит фрагмент. Версии групп входят в ключ,
+поэтому правка в админке делает фрагмент устаревшим сразу, не дожидаясь TTL.
+В ключ также входят шаблон, строка тега и отпечаток шаблонов.
+
+Фрагмент общий для всех посетителей - внутри не должно быть ничего, что
+зависит от пользователя, сессии или CSRF-токена. Данные для фрагмента
+лучше получать внутри блока ленивыми функциями (latest_news(), ...), тогда
+при попадании в кэш не выполняется ни одного запроса.
+
+Хранилище - FRAGMENT_CACHE_URL (memory://, sqlite:///..., redis://...),
+пустое значение выключает кэш (блоки рендерятся каждый раз). Попадания и
+промахи по фрагментам отдаются вместе с метриками запросов на /admin/metrics.
+"""
+import threading
+
+from flask import current_app, has_app_context
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app.utilities.cache import create_cache
+from app.utilities.template_utils import templates_version
+from app.utilities.versions import get_versions
+
+
+class FragmentMetrics:
+    """Счетчики попаданий и промахов по фрагментам (в памяти процесса)"""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, fragment, result):
+        with self._lock:
+            self._counts[(fragment, result)] = self._counts.get((fragment, result), 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def render(self, prefix='flask_'):
+        """Текстовый формат экспозиции Prometheus"""
+        name = prefix + 'fragment_cache_total'
+        lines = [f'# HELP {name} Обращения к кэшу фрагментов шаблонов', f'# TYPE {name} counter']
+        with self._lock:
+            for (fragment, result), count in sorted(self._counts.items()):
+                lines.append(f'{name}{{fragment="{fragment}",result="{result}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+fragment_metrics = FragmentMetrics()
+
+
+class FragmentCacheExtension(Extension):
+    """Тег {% cache key[, ttl[, 'group', ...]] %}...{% endcache %}"""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        fragment = nodes.Const(f'{parser.name}:{lineno}')
+        call = self.call_method('_render_fragment', [fragment, nodes.List(args)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, fragment, args, caller):
+        cache = current_app.extensions.get('fragment_cache') if has_app_context() else None
+        if cache is None:
+            return caller()
+
+        key, ttl, versions = args[0], args[1] if len(args) > 1 else None, args[2:]
+        cache_key = f'fragment:{fragment}:{key!r}:{get_versions(*versions)}:{templates_version()}'
+        html = cache.get(cache_key)
+        if html is not None:
+            fragment_metrics.count(fragment, 'hit')
+            return Markup(html)
+        fragment_metrics.count(fragment, 'miss')
+        html = caller()
+        cache.set(cache_key, str(html), ttl)
+        return html
+
+
+def init_app(app):
+    # Тег нужен шаблонам всегда; без FRAGMENT_CACHE_URL блоки просто рендерятся
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    url = app.config.get('FRAGMENT_CACHE_URL')
+    if url:
+        app.extensions['fragment_cache'] = create_cache(url, app.config.get('FRAGMENT_CACHE_SIZE', 500),
+                                                        app.config.get('FRAGMENT_CACHE_TTL', 300))
@@ -0,0 +1,114 @@
+"""
+Условные GET-запросы: ETag, Last-Modified и ответ 304
+
+Маршрут вычисляет валидаторы до тяжелых запросов - из версий данных
+(versions.py) и updated_at записей - и сразу отдает 304, если копия
+у браузера, CDN или краулера актуальна:
+
+    not_modified = conditional(('product', product_id, updated_at), last_modified=updated_at,
+                               versions=('navigation', 'settings'))
+    if not_modified:
+        return not_modified
+
+Заголовки ETag/Last-Modified/Cache-Control ставятся на ответ 200 в after_request.
+Валидаторы действуют только для анонимных посетителей без flash-сообщений:
+вошедшему пользователю страница показывает его имя и корзину, ей нужен
+Cache-Control: private, no-cache без общих валидаторов.
+"""
+import hashlib
+from datetime import timezone
+
+from flask import current_app, g, request, session
+from flask_login import current_user
+from sqlalchemy import event, func, inspect as sa_inspect
+
+from app import db
+from app.models import Product
+from app.utilities.template_utils import templates_version
+from app.utilities.versions import get_versions, get_version_time
+
+# Связи, изменение которых меняет страницу записи без изменения ее колонок
+TOUCHED_RELATIONSHIPS = {
+    Product: ('categories', 'numbers'),
+}
+
+def _http_time(value):
+    """datetime из базы (UTC без зоны) для заголовков: с зоной, с точностью до секунды"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.replace(microsecond=0)
+
+
+def conditional(parts, last_modified=None, versions=(), max_age=0):
+    """
+    Запоминает валидаторы ответа; возвращает готовый 304, если копия клиента актуальна
+
+    parts - данные, от которых зависит страница (id, updated_at и т.п.);
+    versions - группы данных versions.py, они добавляются и в ETag, и в Last-Modified;
+    max_age - сколько секунд клиент может не перепроверять страницу.
+    """
+    if current_user.is_authenticated or '_flashes' in session:
+        g.http_cache = None
+        return None
+
+    if versions:
+        parts = tuple(parts) + (get_versions(*versions),)
+        version_time = get_version_time(*versions)
+        if version_time is not None and (last_modified is None or version_time > last_modified):
+            last_modified = version_time
+    # URL со строкой запроса: страницы, фильтры и сортировка каталога - разные представления
+    raw = repr((request.url, tuple(parts), templates_version())).encode('utf-8')
+    etag = hashlib.sha1(raw).hexdigest()[:20]
+    last_modified = _http_time(last_modified)
+    g.http_cache = (etag, last_modified, max_age)
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = (last_modified is not None and request.if_modified_since is not None
+                 and last_modified <= request.if_modified_since)
+    if not fresh:
+        return None
+    response = current_app.response_class(status=304)
+    _apply_headers(response, etag, last_modified, max_age)
+    return response
+
+
+def _apply_headers(response, etag, last_modified, max_age):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if not max_age:
+        response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+
+
+def _set_validators(response):
+    if 'http_cache' not in g:
+        return response
+    if g.http_cache is None:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    elif response.status_code == 200:
+        _apply_headers(response, *g.http_cache)
+    return response
+
+
+def init_app(app):
+    app.after_request(_set_validators)
+
+
+# === updated_at при изменении только связей ===
+@event.listens_for(db.session, 'before_flush')
+def _touch_changed_relationships(session, flush_context, instances):
+    for obj in session.dirty:
+        names = TOUCHED_RELATIONSHIPS.get(type(obj))
+        if not names:
+            continue
+        state = sa_inspect(obj)
+        if any(state.attrs[name].history.has_changes() for name in names):
+            obj.updated_at = func.current_timestamp()
@@ -0,0 +1,247 @@
+"""
+Производные изображений по запросу: /img/<preset>/<path>
+
+path - путь загрузки от /static/uploads (products/f/1_name_ab12.jpg),
+расширение задает формат ответа (.jpg, .png, .webp, .avif). Производная
+строится из оригинала загрузки (<имя>_orig.*), а у старых загрузок - из
+основного файла, при первом запросе, и кладется в дисковый кэш
+IMAGE_CACHE_FOLDER. Размер кэша ограничен IMAGE_CACHE_MAX_MB: при
+превышении удаляются давно не запрашивавшиеся файлы (LRU по mtime, который
+обновляется при попаданиях не чаще раза в TOUCH_INTERVAL).
+
+Размеры задаются только именованными пресетами ENDPOINT_PRESETS -
+произвольный размер в URL позволил бы заставить сервер строить бесконечно
+много производных. Смена пресета меняет ключ кэша и параметр v в ссылках
+image_url_for(), поэтому ответ можно отдавать как immutable на год.
+
+Одновременные запросы одной производной в воркере ждут первого (single-flight);
+между процессами возможна повторная сборка, но файл пишется атомарно.
+"""
+import glob
+import hashlib
+import os
+import threading
+import time
+
+from flask import current_app, url_for
+from PIL import Image
+from werkzeug.security import safe_join
+
+from app.utilities.images import (DEFAULT_QUALITY, FORMAT_TYPES, IMAGE_QUALITY, MODERN_FORMATS, ORIGINAL_SUFFIX,
+                                  VARIANT_NAME, make_derivative)
+
+# Пресеты эндпоинта: (режим, размер); fit - вписать, square - вписать и обрезать до квадрата
+ENDPOINT_PRESETS = {
+    'icon': ('square', (100, 100)),
+    'thumb': ('square', (300, 300)),
+    'card': ('fit', (400, 400)),
+    'main': ('fit', (800, 800)),
+    'news': ('fit', (800, 600)),
+}
+
+# Форматы ответа по расширению
+ENDPOINT_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png',
+                    **{f'.{name}': name for name in MODERN_FORMATS}}
+
+# Время жизни в кэше браузера и CDN: URL меняется вместе с файлом и пресетом
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Как часто обновлять mtime файла кэша при попаданиях (для LRU)
+TOUCH_INTERVAL = 3600
+
+# До какой доли лимита очищать кэш при переполнении
+EVICT_TO = 0.9
+
+# Сколько секунд помнить, что производную собрать не удалось (битый или слишком большой исходник)
+FAILURE_TTL = 300
+
+
+def preset_version(name):
+    """Короткий отпечаток пресета: входит в ключ кэша и в ссылки"""
+    return hashlib.sha1(repr(ENDPOINT_PRESETS[name]).encode()).hexdigest()[:8]
+
+
+class SingleFlight:
+    """Один вызов на ключ: одновременные вызовы с тем же ключом ждут результата первого"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = function()
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+        return call['result']
+
+
+class DerivativeCache:
+    """Дисковый кэш производных с ограничением размера (LRU по mtime)"""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._size = None  # Оценка занятого места; считается обходом папки при первой записи
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._failures = {}  # Ключ -> время, до которого не пытаться собирать снова
+
+    def path(self, key, ext):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, digest[:2], digest + ext)
+
+    def get_or_build(self, key, ext, build):
+        """Путь к файлу кэша; при промахе build(path) строит его (один раз на ключ в воркере)"""
+        path = self.path(key, ext)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return self._flight.do(key, lambda: self._build(path, build))
+        if time.time() - mtime > TOUCH_INTERVAL:
+            os.utime(path)
+        return path
+
+    def failed(self, key):
+        """True, если сборка по ключу недавно завершилась ошибкой"""
+        expires = self._failures.get(key)
+        if expires is None:
+            return False
+        if expires > time.monotonic():
+            return True
+        self._failures.pop(key, None)
+        return False
+
+    def mark_failed(self, key):
+        with self._lock:
+            now = time.monotonic()
+            # Просроченные записи чистятся здесь, чтобы словарь не рос без ограничений
+            for stale in [k for k, expires in self._failures.items() if expires <= now]:
+                del self._failures[stale]
+            self._failures[key] = now + FAILURE_TTL
+
+    def _build(self, path, build):
+        if os.path.exists(path):
+            # Файл успел построить соседний воркер или предыдущий вызов с тем же ключом
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        build(path)
+        self._added(os.path.getsize(path))
+        return path
+
+    def _files(self):
+        for root, _, filenames in os.walk(self.folder):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += size
+            if self._size <= self.max_bytes:
+                return
+            # Переполнение: пересчитываем по диску (другие воркеры тоже пишут) и удаляем старые
+            files = sorted(self._files())
+            self._size = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if self._size <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._size -= size
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in list(self._files()):
+                os.remove(path)
+            self._size = 0
+
+
+def init_app(app):
+    app.extensions['image_cache'] = DerivativeCache(app.config['IMAGE_CACHE_FOLDER'],
+                                                    app.config.get('IMAGE_CACHE_MAX_MB', 512) * 1024 * 1024)
+
+
+def find_source(kind, relative_path):
+    """Файл, из которого строится производная: оригинал загрузки или основной файл; None - нет такой загрузки"""
+    folder = current_app.config['UPLOAD_FOLDERS'].get(kind)
+    path = safe_join(folder, relative_path) if folder else None
+    if path is None:
+        return None
+    stem = glob.escape(os.path.splitext(path)[0])
+    extensions = Image.registered_extensions()
+    for pattern in (f'{stem}{ORIGINAL_SUFFIX}.*', f'{stem}.*'):
+        for candidate in sorted(glob.glob(pattern)):
+            if os.path.splitext(candidate)[1].lower() in extensions and not VARIANT_NAME.search(candidate):
+                return candidate
+    return None
+
+
+def get_derivative(preset_name, kind, relative_path):
+    """
+    Путь к производной в кэше и ее формат; None - пресет, формат или загрузка
+    неизвестны либо исходник не удалось декодировать
+
+    Неизвестные пресеты и форматы отклоняются до любого обращения к диску.
+    Неудачная сборка запоминается на FAILURE_TTL секунд: повторные запросы
+    битого исходника сразу получают 404 и не пишут в лог.
+    """
+    if preset_name not in ENDPOINT_PRESETS:
+        return None
+    ext = os.path.splitext(relative_path)[1].lower()
+    image_format = ENDPOINT_FORMATS.get(ext)
+    if image_format is None:
+        return None
+    source = find_source(kind, relative_path)
+    if source is None:
+        return None
+
+    mode, size = ENDPOINT_PRESETS[preset_name]
+    quality = IMAGE_QUALITY.get(kind, DEFAULT_QUALITY)
+    # Замена исходника (пересборка набора) меняет mtime и, значит, ключ
+    key = f'{preset_name}:{preset_version(preset_name)}:{quality}:{source}:{os.path.getmtime(source)}'
+    cache = current_app.extensions['image_cache']
+    if cache.failed(key):
+        return None
+    try:
+        path = cache.get_or_build(
+            key, ext, lambda path: make_derivative(source, path, mode, size, image_format, quality,
+                                                   current_app.config.get('IMAGE_MAX_PIXELS', 50_000_000)))
+    except (OSError, Image.DecompressionBombError, ValueError) as e:
+        cache.mark_failed(key)
+        current_app.logger.warning(f'Не удалось собрать производную {preset_name} для {source}: {e}')
+        return None
+    return path, FORMAT_TYPES[image_format]
+
+
+def image_url_for(image_url, preset):
+    """Ссылка на производную загрузки (image_url вида /static/uploads/...) по пресету эндпоинта"""
+    prefix = '/static/uploads/'
+    if not image_url or not image_url.startswith(prefix):
+        return image_url
+    kind, _, path = image_url[len(prefix):].partition('/')
+    return url_for('images.derivative', preset=preset, kind=kind, path=path, v=preset_version(preset))
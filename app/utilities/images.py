@@ -0,0 +1,1051 @@
+"""
+Фоновая обработка загруженных изображений
+
+Запрос админки только проверяет заголовок файла, сохраняет загрузку как есть
+(<имя>_orig.<ext>) и ставит задание в таблицу image_job. После коммита задание
+уходит в пул процессов (Pillow упирается в CPU, потокам мешает GIL), который
+строит производные по пресету типа: основное изображение и, для товаров,
+квадратную миниатюру. Когда производные готовы, image_url сущности
+переключается на новое изображение - до этого витрина показывает прежнее
+изображение или заглушку.
+
+Каждый пресет строится набором: несколько ширин x AVIF/WebP и запасной
+формат (JPEG, PNG для изображений с прозрачностью) с качеством по типу
+сущности. Наибольшая ширина в запасном формате лежит под прежним именем
+(<имя><суффикс>.<ext>) - на нее указывает image_url. Набор записывается в
+image_variant, шаблоны выводят его через picture() (<picture> со srcset);
+у старых загрузок без набора picture() выводит обычный <img>.
+
+Память на задание ограничена: изображения больше IMAGE_MAX_PIXELS
+отклоняются по заголовку (при загрузке и еще раз в задании), исходник
+декодируется один раз и сразу в уменьшенном виде (draft для JPEG, reduce для
+остальных), поворот по EXIF применяется после уменьшения. Все производные
+строятся из одного декодированного изображения, ширины - каскадом.
+
+Загрузки хранятся по хэшу содержимого: SHA-256 считается при записи файла,
+файлы лежат в <тип>/<2 символа хэша>/<хэш>_orig.<ext>, запись image_blob
+связывает хэш с основным изображением. Повторная загрузка того же файла
+(одно фото поставщика на 40 артикулов) не пишет и не обрабатывает его
+заново - сущность сразу получает готовый image_url. У записи есть счетчик
+ссылок (сущностей с этим image_url), его ведет хук сессии; после коммита,
+который обнулил счетчик (удаление товара, замена изображения), файлы
+загрузки и ее производных удаляются.
+
+Пул ограничен: IMAGE_WORKERS процессов и не больше IMAGE_QUEUE_SIZE заданий
+в работе на воркер приложения, остальные ждут в таблице. Задание захватывается
+условным UPDATE (status pending -> running), поэтому несколько воркеров не
+возьмут одно задание дважды. Неудачное задание повторяется до
+IMAGE_JOB_ATTEMPTS раз, потом помечается failed (видно в списке товаров,
+оттуда же его можно перезапустить).
+
+Если процесс пула погиб (например, его убил OOM killer на огромном
+исходнике), пул пересоздается, а задания, бывшие в нем, возвращаются в
+очередь без траты попытки - упали они не по своей вине. Задание, которое
+застало IMAGE_JOB_ATTEMPTS таких падений, считается их причиной и
+завершается с ошибкой.
+
+IMAGE_WORKERS=0 - задания выполняются в одном фоновом потоке без процессов
+(разработка, окружения без multiprocessing).
+
+    flask images process [--stale-minutes N]   - выполнить ожидающие задания в этом процессе
+    flask images status                        - число заданий по статусам
+    flask images rebuild [--kind K]            - построить наборы для загрузок без них
+    flask images report [--kind K]             - сколько байт экономят WebP/AVIF на текущих загрузках
+    flask images dedup [--dry-run] [--orphans] - перевести старые загрузки на хранение по хэшу
+    flask images gc                            - пересчитать ссылки и удалить загрузки без них
+"""
+import glob
+import hashlib
+import io
+import math
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import uuid
+from collections import Counter, namedtuple
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+from PIL import Image, ImageOps, features
+from sqlalchemy import delete, event, func, insert, inspect, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import ImageBlob, ImageJob, ImageVariant, News, Product
+
+Preset = namedtuple('Preset', 'suffix mode size widths')
+
+# Производные по типу: суффикс имени файла, режим, наибольший размер и ширины для srcset;
+# fit - вписать с сохранением пропорций, square - вписать и обрезать до квадрата по центру
+IMAGE_PRESETS = {
+    'products': (Preset('', 'fit', (800, 800), (400, 800)),
+                 Preset('_thumb', 'square', (300, 300), (150, 300))),
+    'brands': (Preset('', 'fit', (400, 400), (200, 400)),),
+    'categories': (Preset('', 'fit', (600, 400), (300, 600)),),
+    'news': (Preset('', 'fit', (800, 600), (200, 400, 800)),),
+}
+
+# Качество кодирования по типу и формату (png - без потерь)
+IMAGE_QUALITY = {
+    'products': {'avif': 60, 'webp': 80, 'jpeg': 85},
+    'news': {'avif': 50, 'webp': 75, 'jpeg': 80},
+}
+DEFAULT_QUALITY = {'avif': 55, 'webp': 80, 'jpeg': 85}
+
+# Современные форматы в порядке предпочтения браузером; AVIF - если Pillow собран с ним
+MODERN_FORMATS = tuple(name for name in ('avif', 'webp') if name in features.modules and features.check_module(name))
+
+FORMAT_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg', 'png': 'image/png',
+                'gif': 'image/gif'}
+
+# Файлы наборов: <имя><суффикс>_<ширина>w.<ext>
+VARIANT_NAME = re.compile(r'_\d+w\.\w+$')
+
+# Модели, у которых готовое изображение записывается в image_url
+IMAGE_MODELS = {
+    'products': Product,
+    'news': News,
+}
+
+ORIGINAL_SUFFIX = '_orig'
+
+# Во сколько раз декодированное изображение должно быть больше нужного размера:
+# остаток уменьшения делает LANCZOS (как reducing_gap в Image.thumbnail)
+REDUCING_GAP = 2
+
+# Поворот и отражение по тегу EXIF Orientation
+EXIF_ORIENTATION = 0x0112
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Размер куска при записи загрузки и подсчете хэша
+CHUNK_SIZE = 64 * 1024
+
+# Задания, пока не завершившиеся: их загрузки не удаляются сборкой мусора
+ACTIVE_JOB_STATUSES = ('pending', 'running')
+
+
+# === Построение производных (выполняется в процессе пула) ===
+def _extension(image_format):
+    return '.jpg' if image_format == 'jpeg' else f'.{image_format}'
+
+
+def _format_of(path):
+    """Формат по расширению файла: jpeg, png, webp, ..."""
+    return (Image.registered_extensions().get(os.path.splitext(path)[1].lower()) or 'jpeg').lower()
+
+
+def _encode(image, image_format, quality, output):
+    """Кодирует изображение в формат с качеством типа сущности"""
+    params = {}
+    if image_format == 'jpeg':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        params = {'quality': quality['jpeg'], 'optimize': True, 'progressive': True}
+    elif image_format in ('webp', 'avif'):
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if image.mode in ('LA', 'PA', 'P') else 'RGB')
+        params = {'quality': quality[image_format]}
+    elif image_format == 'png':
+        params = {'optimize': True}
+    image.save(output, format=image_format.upper(), **params)
+
+
+def _save_atomic(image, path, image_format, quality):
+    """Сохраняет во временный файл и подменяет path - недописанный файл никогда не отдается"""
+    directory, filename = os.path.split(path)
+    temp_path = os.path.join(directory, f'.{filename}.{uuid.uuid4().hex}.tmp')
+    try:
+        _encode(image, image_format, quality, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def check_pixels(size, max_pixels):
+    """ValueError, если изображение больше max_pixels (проверка по заголовку, до декодирования)"""
+    width, height = size
+    if width * height > max_pixels:
+        raise ValueError(f'Изображение слишком большое: {width}x{height}, '
+                         f'допустимо до {max_pixels / 1_000_000:.0f} Мп')
+
+
+def _needed_size(size, presets):
+    """Наименьший размер, из которого получатся наибольшие производные всех пресетов"""
+    width, height = size
+    need_width = need_height = 0
+    for preset in presets:
+        box_width, box_height = preset.size
+        # fit вписывает в рамку, square заполняет ее с обрезкой
+        scale = (max if preset.mode == 'square' else min)(box_width / width, box_height / height)
+        need_width = max(need_width, width * scale)
+        need_height = max(need_height, height * scale)
+    return math.ceil(need_width), math.ceil(need_height)
+
+
+def decode_image(source_path, presets, max_pixels):
+    """
+    Декодирует исходник один раз - в наименьшем размере, которого хватит всем пресетам
+
+    JPEG уменьшается в 2/4/8 раз прямо в декодере (draft): полноразмерный
+    буфер не создается. Остальные форматы после декодирования уменьшаются
+    reduce(). Остается запас REDUCING_GAP под финальное уменьшение LANCZOS.
+    Поворот по EXIF применяется к уже уменьшенному изображению.
+    """
+    image = Image.open(source_path)
+    try:
+        check_pixels(image.size, max_pixels)
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        rotated = orientation in (5, 6, 7, 8)
+        size = image.size[::-1] if rotated else image.size
+        request = tuple(min(side, math.ceil(need * REDUCING_GAP))
+                        for side, need in zip(size, _needed_size(size, presets)))
+        if rotated:
+            request = request[::-1]
+        image.draft(None, request)
+        image.load()
+    except BaseException:
+        image.close()
+        raise
+
+    factor = int(min(image.width / request[0], image.height / request[1]))
+    if factor >= 2:
+        image = image.reduce(factor)
+    if orientation in EXIF_TRANSPOSE:
+        image = image.transpose(EXIF_TRANSPOSE[orientation])
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+    return image
+
+
+def _resized(image, preset, width):
+    """Изображение пресета шириной не больше width, без увеличения"""
+    if preset.mode == 'square':
+        # Вписать по меньшей стороне и обрезать по центру
+        side = min(width, image.width, image.height)
+        return ImageOps.fit(image, (side, side), Image.Resampling.LANCZOS)
+    box_height = round(preset.size[1] * width / preset.size[0])
+    scale = min(width / image.width, box_height / image.height, 1)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image if size == image.size else image.resize(size, Image.Resampling.LANCZOS)
+
+
+def make_derivatives(source_path, target_path, presets, quality, max_pixels):
+    """
+    Строит наборы производных из исходного файла
+
+    Исходник декодируется один раз (decode_image), ширины пресета строятся
+    каскадом от большей к меньшей. Для каждой ширины пишутся современные
+    форматы и запасной формат цели (по расширению target_path); наибольшая
+    ширина в запасном формате - файл <имя><суффикс>.<ext>. Ширины, которые у
+    маленького исходника совпали, пишутся один раз. Возвращает записи для
+    image_variant: [(суффикс, формат, ширина, высота, байт, имя файла)].
+    """
+    directory = os.path.dirname(target_path)
+    stem, ext = os.path.splitext(os.path.basename(target_path))
+    fallback = _format_of(target_path)
+    decoded = decode_image(source_path, presets, max_pixels)
+    variants = []
+    for preset in presets:
+        image = decoded
+        written = set()
+        for index, width in enumerate(sorted(preset.widths, reverse=True)):
+            image = _resized(image, preset, width)
+            if image.width in written:
+                continue
+            written.add(image.width)
+            for image_format in MODERN_FORMATS + (fallback,):
+                if index == 0 and image_format == fallback:
+                    filename = f'{stem}{preset.suffix}{ext}'
+                else:
+                    filename = f'{stem}{preset.suffix}_{image.width}w{_extension(image_format)}'
+                path = os.path.join(directory, filename)
+                # Пересборка набора старой загрузки: исходник и есть основной файл
+                if path != source_path:
+                    _save_atomic(image, path, image_format, quality)
+                variants.append((preset.suffix, image_format, image.width, image.height,
+                                 os.path.getsize(path), filename))
+    return variants
+
+
+def make_derivative(source_path, path, mode, size, image_format, quality, max_pixels):
+    """Одна производная пресета mode/size из исходного файла (производные по запросу, image_cache.py)"""
+    preset = Preset('', mode, size, (size[0],))
+    image = _resized(decode_image(source_path, (preset,), max_pixels), preset, size[0])
+    _save_atomic(image, path, image_format, quality)
+
+
+# === Пути ===
+def _absolute(url):
+    """Путь на диске для URL вида /static/uploads/..."""
+    return os.path.join(current_app.root_path, url.lstrip('/'))
+
+
+def derivative_url(target, suffix):
+    stem, ext = os.path.splitext(target)
+    return f'{stem}{suffix}{ext}'
+
+
+def job_arguments(kind, source, target):
+    """Аргументы make_derivatives для задания"""
+    return (_absolute(source), _absolute(target), IMAGE_PRESETS[kind], IMAGE_QUALITY.get(kind, DEFAULT_QUALITY),
+            current_app.config.get('IMAGE_MAX_PIXELS', 50_000_000))
+
+
+# === Постановка в очередь ===
+def _write_hashed(stream, folder):
+    """Пишет поток во временный файл в folder, считая SHA-256 по ходу записи; (хэш, путь, байт)"""
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                output.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return digest.hexdigest(), temp_path, size
+
+
+def file_hash(path):
+    """SHA-256 файла (чтение кусками)"""
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_blob(kind, digest, source, url, size):
+    """Запись image_blob для хэша; при гонке двух одинаковых загрузок берется созданная первой"""
+    blob = ImageBlob.query.filter_by(kind=kind, hash=digest).first()
+    if blob is not None:
+        return blob, False
+    blob = ImageBlob(kind=kind, hash=digest, source=source, url=url, size=size)
+    try:
+        with db.session.begin_nested():
+            db.session.add(blob)
+    except IntegrityError:
+        return ImageBlob.query.filter_by(kind=kind, hash=digest).one(), False
+    return blob, True
+
+
+def queue_image(upload, kind, entity_id):
+    """
+    Сохраняет загрузку по хэшу содержимого и назначает ее сущности
+
+    Проверяется только заголовок файла (без декодирования пикселей);
+    ValueError - файл не является изображением. Для нового содержимого в
+    сессию добавляется задание на производные (уходит в пул после коммита),
+    для уже обработанного image_url назначается сразу. Возвращает задание
+    или None.
+    """
+    try:
+        with Image.open(upload.stream) as image:
+            image_format = image.format
+            size = image.size
+            transparent = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError('Файл не является изображением') from e
+    # Слишком большое изображение отклоняется сразу, а не ошибкой задания
+    check_pixels(size, current_app.config.get('IMAGE_MAX_PIXELS', 50_000_000))
+    upload.stream.seek(0)
+
+    _, ext = os.path.splitext(upload.filename or '')
+    ext = ext.lower()
+    if Image.registered_extensions().get(ext) != image_format:
+        # Расширение не совпадает с содержимым - берем расширение по формату
+        ext = next(e for e, f in Image.registered_extensions().items() if f == image_format)
+    # Запасной формат набора: JPEG, PNG - чтобы не потерять прозрачность
+    target_ext = '.png' if transparent else '.jpg'
+
+    folder = current_app.config['UPLOAD_FOLDERS'][kind]
+    os.makedirs(folder, exist_ok=True)
+    digest, temp_path, size = _write_hashed(upload.stream, folder)
+
+    # Раскладка по первым символам хэша - в одной папке не скапливаются тысячи файлов
+    url_folder = f'/static/uploads/{kind}/{digest[:2]}'
+    source = f'{url_folder}/{digest}{ORIGINAL_SUFFIX}{ext}'
+    blob, created = _get_blob(kind, digest, source, f'{url_folder}/{digest}{target_ext}', size)
+    if created or not os.path.exists(_absolute(blob.source)):
+        os.makedirs(os.path.dirname(_absolute(blob.source)), exist_ok=True)
+        os.replace(temp_path, _absolute(blob.source))
+    else:
+        os.unlink(temp_path)
+    if not created and os.path.exists(_absolute(blob.url)):
+        # То же содержимое уже обработано - новые файлы и задание не нужны
+        db.session.get(IMAGE_MODELS[kind], entity_id).image_url = blob.url
+        return None
+
+    job = ImageJob(kind=kind, entity_id=entity_id, source=blob.source, target=blob.url)
+    db.session.add(job)
+    return job
+
+
+# === Выполнение ===
+def claim_jobs(limit):
+    """
+    Захватывает до limit ожидающих заданий (pending -> running)
+
+    Работает через отдельное соединение: вызывается и из after_commit, где
+    сессия уже не может выполнять запросы. Возвращает строки (id, kind, source, target).
+    """
+    claimed = []
+    with db.engine.begin() as connection:
+        ids = connection.execute(
+            select(ImageJob.id).where(ImageJob.status == 'pending').order_by(ImageJob.id).limit(limit)
+        ).scalars().all()
+        for job_id in ids:
+            result = connection.execute(
+                update(ImageJob)
+                .where(ImageJob.id == job_id, ImageJob.status == 'pending')
+                .values(status='running', attempts=ImageJob.attempts + 1, updated_at=func.current_timestamp())
+            )
+            if result.rowcount:
+                claimed.append(job_id)
+        if not claimed:
+            return []
+        return connection.execute(
+            select(ImageJob.id, ImageJob.kind, ImageJob.source, ImageJob.target)
+            .where(ImageJob.id.in_(claimed)).order_by(ImageJob.id)
+        ).all()
+
+
+def finish_job(job_id, error=None, variants=()):
+    """
+    Записывает результат: набор производных и переключение image_url или
+    возврат задания в очередь/статус failed
+    """
+    job = db.session.get(ImageJob, job_id)
+    if job is None:
+        return
+    if error is None:
+        job.status = 'done'
+        job.error = None
+        folder = job.target.rsplit('/', 1)[0]
+        db.session.execute(delete(ImageVariant).where(ImageVariant.image == job.target))
+        if variants:
+            db.session.execute(insert(ImageVariant), [
+                {'image': job.target, 'preset': suffix, 'format': image_format, 'width': width,
+                 'height': height, 'size': size, 'url': f'{folder}/{filename}'}
+                for suffix, image_format, width, height, size, filename in variants
+            ])
+        model = IMAGE_MODELS.get(job.kind)
+        latest = db.session.execute(
+            select(func.max(ImageJob.id)).where(ImageJob.kind == job.kind, ImageJob.entity_id == job.entity_id)
+        ).scalar()
+        # Более новая загрузка для той же сущности уже в очереди - не перетираем ее
+        entity = db.session.get(model, job.entity_id) if model is not None and latest == job.id else None
+        if entity is not None:
+            entity.image_url = job.target
+    else:
+        job.error = error
+        job.status = 'pending' if job.attempts < current_app.config.get('IMAGE_JOB_ATTEMPTS', 3) else 'failed'
+    db.session.commit()
+
+
+def requeue_job(job_id):
+    """Возвращает захваченное задание в очередь, не засчитывая попытку (отдельное соединение)"""
+    with db.engine.begin() as connection:
+        connection.execute(
+            update(ImageJob)
+            .where(ImageJob.id == job_id, ImageJob.status == 'running')
+            # claim_jobs уже засчитал попытку при захвате
+            .values(status='pending', attempts=ImageJob.attempts - 1, updated_at=func.current_timestamp())
+        )
+
+
+def run_job(job):
+    """Выполняет захваченное задание в текущем процессе (CLI)"""
+    try:
+        variants = make_derivatives(*job_arguments(job.kind, job.source, job.target))
+    except Exception as e:
+        finish_job(job.id, f'{type(e).__name__}: {e}')
+        return False
+    finish_job(job.id, variants=variants)
+    return True
+
+
+class ImagePipeline:
+    """Расширение Flask: пул процессов для заданий image_job"""
+
+    def __init__(self, app=None):
+        self._executor = None
+        self._in_flight = 0
+        self._broken = Counter()  # id задания -> сколько раз пул падал, пока оно было в работе
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['image_pipeline'] = self
+        app.cli.add_command(images_cli)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                workers = current_app.config.get('IMAGE_WORKERS', 2)
+                if workers:
+                    # spawn: дочерние процессы не наследуют потоки и соединения воркера
+                    self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self._executor = ThreadPoolExecutor(1, thread_name_prefix='image-job')
+            return self._executor
+
+    def _reset_executor(self, executor):
+        """Отбрасывает сломанный пул; следующий _get_executor создаст новый"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, job):
+        """Отправляет задание в пул; (пул, future)"""
+        executor = self._get_executor()
+        arguments = job_arguments(job.kind, job.source, job.target)
+        try:
+            return executor, executor.submit(make_derivatives, *arguments)
+        except BrokenExecutor:
+            # Пул сломался между заданиями - одна попытка с новым пулом
+            self._reset_executor(executor)
+            executor = self._get_executor()
+            return executor, executor.submit(make_derivatives, *arguments)
+
+    def dispatch(self):
+        """Отправляет в пул ожидающие задания, пока есть свободные места"""
+        app = current_app._get_current_object()
+        with self._lock:
+            free = app.config.get('IMAGE_QUEUE_SIZE', 8) - self._in_flight
+            jobs = claim_jobs(free) if free > 0 else []
+            self._in_flight += len(jobs)
+
+        for job in jobs:
+            try:
+                executor, future = self._submit(job)
+            except Exception as e:
+                # Задание не запускалось: без повторного dispatch(), иначе при
+                # неисправимой ошибке пула он вызывал бы сам себя
+                with self._lock:
+                    self._in_flight -= 1
+                if isinstance(e, BrokenExecutor):
+                    requeue_job(job.id)
+                else:
+                    self._finish(app, job.id, f'{type(e).__name__}: {e}')
+                continue
+            future.add_done_callback(partial(self._done, app, job.id, executor))
+
+    def _done(self, app, job_id, executor, future):
+        with self._lock:
+            self._in_flight -= 1
+        exception = future.exception()
+        if isinstance(exception, BrokenExecutor) and self._pool_broken(app, job_id):
+            self._reset_executor(executor)
+            self._in_context(app, f'Ошибка при возврате задания изображения {job_id} в очередь',
+                             requeue_job, job_id)
+        elif exception is not None:
+            self._finish(app, job_id, f'{type(exception).__name__}: {exception}')
+        else:
+            self._finish(app, job_id, None, future.result())
+        self._in_context(app, 'Ошибка при запуске заданий изображений', self.dispatch)
+
+    def _pool_broken(self, app, job_id):
+        """Засчитывает заданию падение пула; False - падений слишком много, задание завершается с ошибкой"""
+        with self._lock:
+            self._broken[job_id] += 1
+            if self._broken[job_id] < app.config.get('IMAGE_JOB_ATTEMPTS', 3):
+                return True
+            del self._broken[job_id]
+            return False
+
+    def _finish(self, app, job_id, error, variants=()):
+        with self._lock:
+            self._broken.pop(job_id, None)
+        self._in_context(app, f'Ошибка при завершении задания изображения {job_id}',
+                         finish_job, job_id, error, variants)
+
+    @staticmethod
+    def _in_context(app, message, function, *args):
+        """Вызывает function в контексте приложения (колбэки пула идут в его служебном потоке)"""
+        try:
+            with app.app_context():
+                function(*args)
+        except Exception as e:
+            app.logger.warning(f'{message}: {e}')
+
+
+image_pipeline = ImagePipeline()
+
+
+def image_jobs_for(kind, entity_ids):
+    """{id сущности: последнее задание} - для статуса изображений в списках админки (один запрос)"""
+    if not entity_ids:
+        return {}
+    latest = (select(func.max(ImageJob.id))
+              .where(ImageJob.kind == kind, ImageJob.entity_id.in_(entity_ids))
+              .group_by(ImageJob.entity_id))
+    jobs = db.session.execute(select(ImageJob).where(ImageJob.id.in_(latest))).scalars()
+    return {job.entity_id: job for job in jobs}
+
+
+def retry_job(job_id):
+    """Возвращает упавшее задание в очередь с новым счетчиком попыток"""
+    job = db.session.get(ImageJob, job_id)
+    if job is None or job.status != 'failed':
+        return False
+    job.status = 'pending'
+    job.attempts = 0
+    db.session.commit()
+    return True
+
+
+# === Вывод в шаблонах ===
+def _variant_sets(entity, preset):
+    """{формат: [производные по возрастанию ширины]} пресета"""
+    sets = {}
+    for variant in entity.image_variants:
+        if variant.preset == preset:
+            sets.setdefault(variant.format, []).append(variant)
+    return sets
+
+
+def _srcset(variants):
+    return ', '.join(f'{variant.url} {variant.width}w' for variant in variants)
+
+
+def _attributes(attrs):
+    return ''.join(f' {name}="{escape(value)}"' for name, value in attrs.items() if value is not None)
+
+
+def image_srcset(entity, preset='', image_format=None):
+    """srcset пресета в формате (по умолчанию - запасном); пустая строка, если набора нет"""
+    sets = _variant_sets(entity, preset) if entity.image_url else {}
+    image_format = image_format or _format_of(entity.image_url or '')
+    return _srcset(sets.get(image_format, ()))
+
+
+def picture(entity, preset='', sizes='100vw', **attrs):
+    """
+    <picture> с источниками AVIF/WebP и <img> в запасном формате
+
+    entity - товар или новость (производные грузятся профилем load_options),
+    preset - суффикс пресета ('' или '_thumb'), sizes - ширина на странице.
+    Атрибуты attrs (class, alt, style, ...) переносятся на <img>. Пока набора
+    нет (старая загрузка, задание в работе), выводится обычный <img>.
+    """
+    if not entity.image_url:
+        return Markup('')
+    attrs.setdefault('loading', 'lazy')
+    fallback_url = derivative_url(entity.image_url, preset)
+    sets = _variant_sets(entity, preset)
+    fallback = sets.get(_format_of(entity.image_url))
+    if not fallback:
+        return Markup(f'<img{_attributes(dict(src=fallback_url, **attrs))}>')
+
+    sources = ''.join(
+        f'<source{_attributes({"type": FORMAT_TYPES[name], "srcset": _srcset(sets[name]), "sizes": sizes})}>'
+        for name in MODERN_FORMATS if name in sets
+    )
+    img = _attributes(dict(src=fallback_url, srcset=_srcset(fallback), sizes=sizes, **attrs))
+    return Markup(f'<picture>{sources}<img{img}></picture>')
+
+
+# === Хранение по хэшу: счетчик ссылок и сборка мусора ===
+def _kind_of(url):
+    """Тип загрузки по URL /static/uploads/<тип>/..."""
+    parts = url.split('/')
+    return parts[3] if len(parts) > 4 and parts[1:3] == ['static', 'uploads'] else None
+
+
+def image_files(url, variant_urls=()):
+    """Файлы изображения на диске: основной, производные пресетов, набор и оригинал загрузки"""
+    urls = {url, *variant_urls}
+    urls.update(derivative_url(url, preset.suffix) for preset in IMAGE_PRESETS.get(_kind_of(url), ()))
+    paths = {_absolute(item) for item in urls}
+    paths.update(glob.glob(glob.escape(os.path.splitext(_absolute(url))[0]) + ORIGINAL_SUFFIX + '.*'))
+    return {path for path in paths if os.path.isfile(path)}
+
+
+def _remove_files(paths):
+    """Удаляет файлы; возвращает освобожденные байты"""
+    freed = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            continue
+        freed += size
+    return freed
+
+
+def _remove_empty_folders(paths):
+    """Удаляет опустевшие папки раскладки по хэшу (uploads/<тип>/<xx>), сами папки типов не трогает"""
+    kind_folders = {os.path.normpath(folder) for folder in current_app.config['UPLOAD_FOLDERS'].values()}
+    for folder in {os.path.dirname(path) for path in paths}:
+        if os.path.normpath(os.path.dirname(folder)) not in kind_folders:
+            continue
+        try:
+            os.rmdir(folder)
+        except OSError:
+            # В папке остались другие загрузки
+            continue
+
+
+def collect_garbage(urls=None):
+    """
+    Удаляет загрузки без ссылок и без незавершенных заданий вместе с файлами
+
+    urls - проверить только эти image_url (после коммита), None - все.
+    Строка удаляется условным DELETE (refcount <= 0), поэтому загрузка,
+    на которую за это время сослался другой запрос, останется. Работает
+    через отдельное соединение (вызывается из after_commit). Возвращает
+    (число загрузок, освобожденные байты).
+    """
+    active = select(ImageJob.id).where(ImageJob.target == ImageBlob.url,
+                                       ImageJob.status.in_(ACTIVE_JOB_STATUSES)).exists()
+    query = select(ImageBlob.id, ImageBlob.url, ImageBlob.source).where(ImageBlob.refcount <= 0, ~active)
+    if urls is not None:
+        query = query.where(ImageBlob.url.in_(urls))
+    files = set()
+    removed = 0
+    with db.engine.begin() as connection:
+        for blob_id, url, source in connection.execute(query).all():
+            if not connection.execute(
+                    delete(ImageBlob).where(ImageBlob.id == blob_id, ImageBlob.refcount <= 0)).rowcount:
+                continue
+            variant_urls = connection.execute(
+                select(ImageVariant.url).where(ImageVariant.image == url)).scalars().all()
+            connection.execute(delete(ImageVariant).where(ImageVariant.image == url))
+            files.update(image_files(url, variant_urls))
+            files.update(image_files(source))
+            removed += 1
+    # Файлы удаляются после коммита: откат транзакции не оставит строк без файлов
+    freed = _remove_files(files)
+    _remove_empty_folders(files)
+    return removed, freed
+
+
+def recount_references():
+    """Пересчитывает refcount всех загрузок по image_url сущностей"""
+    counts = Counter()
+    for model in IMAGE_MODELS.values():
+        counts.update(dict(db.session.execute(
+            select(model.image_url, func.count()).where(model.image_url.is_not(None)).group_by(model.image_url)
+        ).all()))
+    for blob in ImageBlob.query.all():
+        blob.refcount = counts.get(blob.url, 0)
+    db.session.commit()
+
+
+@event.listens_for(db.session, 'before_flush')
+def _count_image_references(session, flush_context, instances):
+    """Переносит изменения image_url товаров и новостей в refcount загрузок"""
+    changes = Counter()
+    models = tuple(IMAGE_MODELS.values())
+    for obj in session.new:
+        if isinstance(obj, models) and obj.image_url:
+            changes[obj.image_url] += 1
+    for obj in session.dirty:
+        if isinstance(obj, models):
+            history = inspect(obj).attrs.image_url.history
+            changes.update(url for url in history.added if url)
+            changes.subtract(url for url in history.deleted if url)
+    for obj in session.deleted:
+        if isinstance(obj, models):
+            history = inspect(obj).attrs.image_url.history
+            changes.subtract(url for url in (history.deleted or history.unchanged) if url)
+
+    released = session.info.setdefault('image_urls_released', set())
+    connection = session.connection()
+    for url, delta in changes.items():
+        if delta:
+            connection.execute(update(ImageBlob).where(ImageBlob.url == url)
+                               .values(refcount=ImageBlob.refcount + delta))
+        if delta < 0:
+            released.add(url)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _collect_after_commit(session):
+    urls = session.info.pop('image_urls_released', None)
+    if urls and has_app_context():
+        collect_garbage(sorted(urls))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_released(session):
+    session.info.pop('image_urls_released', None)
+
+
+# === Отправка в пул после коммита ===
+@event.listens_for(db.session, 'after_flush')
+def _collect_new_jobs(session, flush_context):
+    if any(isinstance(obj, ImageJob) for obj in session.new) or any(
+            isinstance(obj, ImageJob) and obj.status == 'pending' for obj in session.dirty):
+        session.info['image_jobs_pending'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _dispatch_after_commit(session):
+    if session.info.pop('image_jobs_pending', False) and has_app_context() \
+            and 'image_pipeline' in current_app.extensions:
+        image_pipeline.dispatch()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('image_jobs_pending', None)
+
+
+# === CLI ===
+images_cli = AppGroup('images', help='Фоновая обработка изображений')
+
+
+def _process_pending():
+    """Выполняет ожидающие задания по одному в этом процессе; (выполнено, с ошибкой)"""
+    done = failed = 0
+    while True:
+        jobs = claim_jobs(1)
+        if not jobs:
+            break
+        if run_job(jobs[0]):
+            done += 1
+        else:
+            failed += 1
+    return done, failed
+
+
+@images_cli.command('process')
+@click.option('--stale-minutes', type=int, default=None,
+              help='Вернуть в очередь задания, которые выполняются дольше N минут (упавший воркер)')
+def process_command(stale_minutes):
+    """Выполнить ожидающие задания в этом процессе"""
+    if stale_minutes is not None:
+        stale_before = datetime.utcnow() - timedelta(minutes=stale_minutes)
+        result = db.session.execute(
+            update(ImageJob).where(ImageJob.status == 'running', ImageJob.updated_at < stale_before)
+            .values(status='pending')
+        )
+        db.session.commit()
+        click.echo(f'Возвращено в очередь зависших заданий: {result.rowcount}')
+    done, failed = _process_pending()
+    click.echo(f'Выполнено заданий: {done}, с ошибкой: {failed}')
+
+
+@images_cli.command('rebuild')
+@click.option('--kind', type=click.Choice(sorted(IMAGE_MODELS)), multiple=True, help='Тип сущности (по умолчанию все)')
+def rebuild_command(kind):
+    """Построить наборы производных для загрузок, у которых их нет"""
+    queued = 0
+    for name in kind or sorted(IMAGE_MODELS):
+        model = IMAGE_MODELS[name]
+        rows = db.session.execute(
+            select(model.id, model.image_url)
+            .where(model.image_url.is_not(None),
+                   ~select(ImageVariant.id).where(ImageVariant.image == model.image_url).exists())
+        ).all()
+        # Исходник - текущий основной файл; оригинала у старых загрузок нет
+        jobs = [{'kind': name, 'entity_id': entity_id, 'source': url, 'target': url}
+                for entity_id, url in rows if os.path.exists(_absolute(url))]
+        if jobs:
+            db.session.execute(insert(ImageJob), jobs)
+        queued += len(jobs)
+    db.session.commit()
+    click.echo(f'Поставлено в очередь: {queued}')
+    done, failed = _process_pending()
+    click.echo(f'Выполнено заданий: {done}, с ошибкой: {failed}')
+
+
+def _estimate(path, image_format, quality):
+    """Размер файла в формате при той же ширине (кодирование в памяти)"""
+    output = io.BytesIO()
+    with Image.open(path) as image:
+        _encode(image, image_format, quality, output)
+    return output.tell()
+
+
+@images_cli.command('report')
+@click.option('--kind', type=click.Choice(sorted(IMAGE_PRESETS)), multiple=True, help='Тип загрузок (по умолчанию все)')
+def report_command(kind):
+    """Сколько байт экономят современные форматы на текущих загрузках"""
+    folders = current_app.config['UPLOAD_FOLDERS']
+    formats = ' '.join(f'{name.upper():>16}' for name in MODERN_FORMATS)
+    click.echo(f'{"тип":<12}{"файлов":>8}{"сейчас, КБ":>14} {formats}  оценено')
+    for name in kind or sorted(IMAGE_PRESETS):
+        files = current = estimated = 0
+        totals = dict.fromkeys(MODERN_FORMATS, 0)
+        quality = IMAGE_QUALITY.get(name, DEFAULT_QUALITY)
+        for root, _, filenames in os.walk(folders.get(name, '')):
+            for filename in filenames:
+                stem, ext = os.path.splitext(filename)
+                # Основные файлы и миниатюры: без оригиналов, файлов наборов и временных
+                if (filename.startswith('.') or stem.endswith(ORIGINAL_SUFFIX) or VARIANT_NAME.search(filename)
+                        or ext.lower() not in Image.registered_extensions()):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    with Image.open(path) as image:
+                        width = image.width
+                except OSError:
+                    continue
+                files += 1
+                current += os.path.getsize(path)
+                for image_format in MODERN_FORMATS:
+                    variant_path = os.path.join(root, f'{stem}_{width}w{_extension(image_format)}')
+                    if os.path.exists(variant_path):
+                        totals[image_format] += os.path.getsize(variant_path)
+                    else:
+                        totals[image_format] += _estimate(path, image_format, quality)
+                        estimated += 1
+        columns = ' '.join(
+            f'{size // 1024:>9} ({(1 - size / current) * 100 if current else 0:>3.0f}%)' for size in totals.values()
+        )
+        click.echo(f'{name:<12}{files:>8}{current // 1024:>14} {columns}  {estimated}')
+
+
+def _upload_source(url):
+    """Файл, по которому считается хэш старой загрузки: оригинал, если он есть, иначе основной файл"""
+    path = _absolute(url)
+    originals = sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + ORIGINAL_SUFFIX + '.*'))
+    if originals:
+        return originals[0]
+    return path if os.path.isfile(path) else None
+
+
+def _url_of(path):
+    return '/' + os.path.relpath(path, current_app.root_path).replace(os.sep, '/')
+
+
+def _variant_urls(urls):
+    """{image_url: [URL файлов набора]}"""
+    result = {}
+    rows = db.session.execute(select(ImageVariant.image, ImageVariant.url).where(ImageVariant.image.in_(urls)))
+    for image, url in rows:
+        result.setdefault(image, []).append(url)
+    return result
+
+
+def _orphan_files(kind):
+    """Файлы в папке типа, которые не относятся ни к одной сущности, загрузке или незавершенному заданию"""
+    model = IMAGE_MODELS[kind]
+    urls = set(db.session.execute(select(model.image_url).where(model.image_url.is_not(None))).scalars())
+    sources = set()
+    for url, source in db.session.execute(select(ImageBlob.url, ImageBlob.source).where(ImageBlob.kind == kind)):
+        urls.add(url)
+        sources.add(source)
+    for target, source in db.session.execute(select(ImageJob.target, ImageJob.source).where(
+            ImageJob.kind == kind, ImageJob.status.in_(ACTIVE_JOB_STATUSES))):
+        urls.add(target)
+        sources.add(source)
+    variants = _variant_urls(urls)
+    referenced = set()
+    for url in urls:
+        referenced.update(image_files(url, variants.get(url, ())))
+    for source in sources:
+        referenced.update(image_files(source))
+    for root, _, filenames in os.walk(current_app.config['UPLOAD_FOLDERS'][kind]):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            # Скрытые - временные файлы незавершенной записи
+            if not filename.startswith('.') and path not in referenced:
+                yield path
+
+
+@images_cli.command('dedup')
+@click.option('--dry-run', is_flag=True, help='Только отчет, без изменений')
+@click.option('--orphans', is_flag=True, help='Удалить и файлы, на которые не ссылается ни одна сущность')
+def dedup_command(dry_run, orphans):
+    """Перевести загрузки на хранение по хэшу: одинаковые файлы объединяются, заводятся счетчики ссылок"""
+    merged = relinked = 0
+    obsolete = {}
+    for kind, model in sorted(IMAGE_MODELS.items()):
+        blobs = {blob.url: blob for blob in ImageBlob.query.filter_by(kind=kind)}
+        by_hash = {blob.hash: blob.url for blob in blobs.values()}
+        busy = set(db.session.execute(select(ImageJob.target).where(
+            ImageJob.kind == kind, ImageJob.status.in_(ACTIVE_JOB_STATUSES))).scalars())
+        urls = db.session.execute(
+            select(model.image_url).where(model.image_url.is_not(None)).distinct()).scalars().all()
+
+        groups = {}
+        for url in urls:
+            if url in blobs:
+                groups.setdefault(blobs[url].hash, []).append(url)
+                continue
+            source = _upload_source(url)
+            if source is not None and url not in busy:
+                groups.setdefault(file_hash(source), []).append(url)
+
+        for digest, group in groups.items():
+            canonical = by_hash.get(digest) or group[0]
+            duplicates = [url for url in group if url != canonical]
+            if duplicates:
+                merged += 1
+                obsolete.update(dict.fromkeys(duplicates, kind))
+            if dry_run:
+                continue
+            if canonical not in blobs:
+                source = _upload_source(canonical)
+                db.session.add(ImageBlob(kind=kind, hash=digest, source=_url_of(source), url=canonical,
+                                         size=os.path.getsize(source)))
+            # Через ORM - чтобы сработали хуки версий, кэша страниц и счетчиков ссылок
+            for entity in model.query.filter(model.image_url.in_(duplicates)):
+                entity.image_url = canonical
+                relinked += 1
+        if not dry_run:
+            db.session.commit()
+
+    variants = _variant_urls(list(obsolete))
+    files = set()
+    for url in obsolete:
+        files.update(image_files(url, variants.get(url, ())))
+    if orphans:
+        for kind in sorted(IMAGE_MODELS):
+            files.update(_orphan_files(kind))
+    if dry_run:
+        freed = sum(os.path.getsize(path) for path in files)
+    else:
+        db.session.execute(delete(ImageVariant).where(ImageVariant.image.in_(list(obsolete))))
+        db.session.commit()
+        recount_references()
+        freed = _remove_files(files)
+
+    action = 'Можно освободить' if dry_run else 'Освобождено'
+    click.echo(f'Групп одинаковых загрузок: {merged}, ссылок перенаправлено: {relinked}')
+    click.echo(f'{action}: {freed / 1024 / 1024:.2f} МБ в {len(files)} файлах')
+
+
+@images_cli.command('gc')
+def gc_command():
+    """Пересчитать ссылки и удалить загрузки, на которые не ссылается ни одна сущность"""
+    recount_references()
+    removed, freed = collect_garbage()
+    click.echo(f'Удалено загрузок: {removed}, освобождено {freed / 1024 / 1024:.2f} МБ')
+
+
+@images_cli.command('status')
+def status_command():
+    """Число заданий по статусам"""
+    rows = db.session.execute(select(ImageJob.status, func.count()).group_by(ImageJob.status)).all()
+    for status, count in sorted(rows):
+        click.echo(f'{status}: {count}')
+    if not rows:
+        click.echo('Заданий нет')
@@ -0,0 +1,334 @@
+"""
+Инструментирование запросов к приложению
+
+Для каждого HTTP-запроса считаются SQL-запросы и время в БД (события движка
+SQLAlchemy), время рендеринга шаблонов (сигналы Flask) и общее время
+обработчика. Результат:
+    - заголовок Server-Timing (db, tpl, app) - виден в DevTools браузера;
+    - структурированная строка лога (JSON) в логгер app.requests;
+    - гистограммы по endpoint в памяти воркера, отдаются в текстовом формате
+      Prometheus на /admin/metrics (у каждого воркера свои).
+
+Медленные SQL-запросы (дольше SLOW_QUERY_MS, с долей выборки
+SLOW_QUERY_SAMPLE) попадают в кольцевой буфер вместе с формой параметров,
+маршрутом и планом выполнения (EXPLAIN QUERY PLAN / EXPLAIN) - последние
+записи видны на дашборде админки.
+
+При QUERY_BUDGET > 0 (тесты, отладка) запрос дополнительно падает с
+QueryBudgetExceeded, если выполнил больше SQL-запросов, чем разрешено.
+Бюджет по умолчанию - QUERY_BUDGET, маршрут может задать свой декоратором
+@query_budget(n). Так N+1 на страницах списков (ленивая загрузка связей в
+цикле шаблона) ловится сразу, а не на проде.
+"""
+import bisect
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+
+from flask import current_app, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+from app import db
+
+logger = logging.getLogger('app.requests')
+
+# Границы корзин гистограмм
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# Метрики: имя -> (описание, границы корзин)
+METRICS = {
+    'request_duration_seconds': ('Время обработки запроса приложением', SECONDS_BUCKETS),
+    'db_duration_seconds': ('Суммарное время SQL-запросов за запрос', SECONDS_BUCKETS),
+    'render_duration_seconds': ('Время рендеринга шаблонов за запрос', SECONDS_BUCKETS),
+    'db_queries': ('Число SQL-запросов за запрос', QUERIES_BUCKETS),
+}
+
+
+# Префикс запроса плана по диалекту; для остальных СУБД план не снимается
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+}
+# Сколько типов параметров показывать в форме параметров
+PARAMS_SHAPE_LIMIT = 20
+
+SlowQuery = namedtuple('SlowQuery', 'recorded_at duration_ms statement params_shape endpoint path plan')
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """Маршрут выполнил больше SQL-запросов, чем ему разрешено"""
+
+
+class Histogram:
+    """Гистограмма в стиле Prometheus: счетчики по корзинам, сумма и количество"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Пары (граница, накопленное количество), как в формате экспозиции"""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class MetricsRegistry:
+    """Гистограммы метрик по endpoint (потокобезопасно, в памяти процесса)"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, values):
+        with self._lock:
+            for name, value in values.items():
+                histogram = self._histograms.get((name, endpoint))
+                if histogram is None:
+                    histogram = self._histograms[(name, endpoint)] = Histogram(self.metrics[name][1])
+                histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def render(self, prefix='flask_'):
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        with self._lock:
+            for name, (description, _) in self.metrics.items():
+                full_name = prefix + name
+                lines.append(f'# HELP {full_name} {description}')
+                lines.append(f'# TYPE {full_name} histogram')
+                for (metric, endpoint), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    label = f'endpoint="{_escape_label(endpoint)}"'
+                    for bound, count in histogram.cumulative():
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{full_name}_bucket{{{label},le="{le}"}} {count}')
+                    lines.append(f'{full_name}_sum{{{label}}} {histogram.sum!r}')
+                    lines.append(f'{full_name}_count{{{label}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = MetricsRegistry(METRICS)
+
+
+class SlowQueryLog:
+    """Кольцевой буфер медленных SQL-запросов (в памяти процесса)"""
+
+    def __init__(self):
+        self.threshold = None  # Секунды; None - запись выключена
+        self.sample_rate = 1.0
+        self._records = deque(maxlen=100)
+
+    def configure(self, threshold_ms, sample_rate, size):
+        self.threshold = threshold_ms / 1000 if threshold_ms else None
+        self.sample_rate = sample_rate
+        self._records = deque(self._records, maxlen=size)
+
+    def should_record(self, duration):
+        return (self.threshold is not None and duration >= self.threshold
+                and (self.sample_rate >= 1 or random.random() < self.sample_rate))
+
+    def record(self, conn, cursor, statement, parameters, duration):
+        if has_request_context():
+            endpoint, path = request.endpoint or 'unknown', request.path
+        else:
+            endpoint, path = None, None
+        self._records.append(SlowQuery(
+            recorded_at=datetime.now(),
+            duration_ms=round(duration * 1000, 1),
+            statement=statement,
+            params_shape=_params_shape(parameters),
+            endpoint=endpoint,
+            path=path,
+            plan=_explain(conn, cursor, statement, parameters),
+        ))
+
+    def records(self):
+        """Записи от новых к старым"""
+        return list(reversed(self._records))
+
+    def clear(self):
+        self._records.clear()
+
+
+def _params_shape(parameters):
+    """Типы параметров без значений: видно число и вид параметров (например, длину IN), но не данные"""
+    if isinstance(parameters, dict):
+        items = [f'{key}: {type(value).__name__}' for key, value in parameters.items()]
+    elif isinstance(parameters, (list, tuple)):
+        items = [type(value).__name__ for value in parameters]
+    else:
+        return type(parameters).__name__
+    if len(items) > PARAMS_SHAPE_LIMIT:
+        items = items[:PARAMS_SHAPE_LIMIT] + [f'... всего {len(items)}']
+    return ', '.join(items)
+
+
+def _explain(conn, cursor, statement, parameters):
+    """План выполнения запроса на том же соединении; только для SELECT"""
+    prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+    if prefix is None or not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    explain_cursor = cursor.connection.cursor()
+    postgresql = conn.dialect.name == 'postgresql'
+    try:
+        # В PostgreSQL ошибка прерывает транзакцию - план снимается внутри точки сохранения
+        if postgresql:
+            explain_cursor.execute('SAVEPOINT slow_query_explain')
+        explain_cursor.execute(prefix + statement, parameters)
+        rows = explain_cursor.fetchall()
+        if postgresql:
+            explain_cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+    except Exception as e:
+        if postgresql:
+            explain_cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+        return f'Не удалось получить план: {e}'
+    finally:
+        explain_cursor.close()
+    # Последняя колонка - текст шага плана (в SQLite перед ней служебные id узлов)
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+slow_queries = SlowQueryLog()
+
+
+def query_budget(limit):
+    """Декоратор маршрута: свой бюджет SQL-запросов (ставится под @route)"""
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+
+# === События SQLAlchemy и сигналы шаблонов ===
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_started'].pop()
+    if not executemany and slow_queries.should_record(duration):
+        slow_queries.record(conn, cursor, statement, parameters, duration)
+    if not has_request_context() or 'request_started' not in g:
+        return
+    g.query_count += 1
+    g.db_time += duration
+    if g.query_statements is not None:
+        g.query_statements.append(statement)
+
+
+def _query_failed(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context() and 'request_started' in g:
+        g.render_started.append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    if has_request_context() and g.get('render_started'):
+        g.render_time += time.perf_counter() - g.render_started.pop()
+
+
+# === Хуки запроса ===
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.db_time = 0.0
+    g.render_time = 0.0
+    g.render_started = []
+    # Тексты запросов нужны только для сообщения о превышении бюджета
+    g.query_statements = [] if current_app.config.get('QUERY_BUDGET') else None
+
+
+def _finish_request(response):
+    if 'request_started' not in g:
+        return response
+    duration = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unknown'
+
+    if current_app.config.get('QUERY_BUDGET'):
+        _check_budget()
+
+    if current_app.config.get('REQUEST_METRICS'):
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={g.db_time * 1000:.1f};desc="{g.query_count} queries"',
+            f'tpl;dur={g.render_time * 1000:.1f}',
+            f'app;dur={duration * 1000:.1f}',
+        ])
+        metrics.observe(endpoint, {
+            'request_duration_seconds': duration,
+            'db_duration_seconds': g.db_time,
+            'render_duration_seconds': g.render_time,
+            'db_queries': g.query_count,
+        })
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'endpoint': endpoint,
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 1),
+                'db_queries': g.query_count,
+                'db_ms': round(g.db_time * 1000, 1),
+                'render_ms': round(g.render_time * 1000, 1),
+            }, ensure_ascii=False))
+    return response
+
+
+def _check_budget():
+    view = current_app.view_functions.get(request.endpoint)
+    limit = getattr(view, 'query_budget', current_app.config['QUERY_BUDGET'])
+    if g.query_count > limit:
+        statements = '\n'.join(statement.replace('\n', ' ')[:200] for statement in g.query_statements)
+        raise QueryBudgetExceeded(f'{request.path}: {g.query_count} SQL-запросов при бюджете {limit}\n{statements}')
+
+
+def init_app(app):
+    """Подключает инструментирование, если включены метрики, журнал медленных запросов или QUERY_BUDGET"""
+    slow_queries.configure(app.config.get('SLOW_QUERY_MS'), app.config.get('SLOW_QUERY_SAMPLE', 1.0),
+                           app.config.get('SLOW_QUERY_LOG_SIZE', 100))
+    if not (app.config.get('REQUEST_METRICS') or app.config.get('QUERY_BUDGET') or app.config.get('SLOW_QUERY_MS')):
+        return
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_query)
+        event.listen(db.engine, 'after_cursor_execute', _after_query)
+        event.listen(db.engine, 'handle_error', _query_failed)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    if app.config.get('LOG_TO_STDOUT') and not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        # Строки - чистый JSON, без префикса обработчика app.logger
+        logger.propagate = False
@@ -0,0 +1,168 @@
+"""
+Миграции схемы базы
+
+db.create_all() создает только недостающие таблицы и не меняет существующие,
+поэтому новые индексы и колонки в уже работающей базе добавляются миграциями.
+Миграция - функция от соединения, зарегистрированная декоратором @migration
+под уникальным именем; примененные записываются в таблицу schema_migration,
+и каждая выполняется один раз, в своей транзакции, в порядке объявления.
+
+Миграции должны быть идемпотентными: в новой базе create_all уже создал все
+по моделям, и миграция только отмечается примененной.
+
+    flask migrate upgrade   - применить новые миграции
+    flask migrate status    - список миграций с отметкой о применении
+"""
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect, insert, select, text, update
+
+from app import db
+from app.models import SchemaMigration, Product, News, CartItem, Category, CategoryClosure, SeoMeta, CacheVersion, \
+    ImageJob, ImageVariant, ImageBlob, product_category
+from app.utilities.category_tree import fill_closure
+from app.utilities.search import rebuild_product_numbers
+
+# Миграции в порядке применения: (имя, функция)
+MIGRATIONS = []
+
+
+def migration(name):
+    """Регистрирует функцию(connection) как миграцию с именем name"""
+    def decorator(function):
+        if any(existing == name for existing, _ in MIGRATIONS):
+            raise ValueError(f'Миграция {name} уже объявлена')
+        MIGRATIONS.append((name, function))
+        return function
+    return decorator
+
+
+def create_indexes(connection, table, names=None):
+    """Создает объявленные в модели индексы таблицы, которых еще нет в базе"""
+    if not inspect(connection).has_table(table.name):
+        # Таблицу целиком (с индексами) создаст create_all
+        return
+    for index in table.indexes:
+        if names is None or index.name in names:
+            index.create(connection, checkfirst=True)
+
+
+def add_column(connection, table, name):
+    """Добавляет объявленную в модели колонку, если ее еще нет в таблице; True - колонка добавлена"""
+    inspector = inspect(connection)
+    if not inspector.has_table(table.name):
+        return False
+    if name in {column['name'] for column in inspector.get_columns(table.name)}:
+        return False
+    column = table.c[name]
+    preparer = connection.dialect.identifier_preparer
+    connection.execute(text(
+        f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} '
+        f'{column.type.compile(dialect=connection.dialect)}'
+    ))
+    return True
+
+
+# === Миграции ===
+@migration('0001_hot_path_indexes')
+def hot_path_indexes(connection):
+    """Индексы под фильтры и сортировки витрины, корзины и SEO"""
+    for table in (Product.__table__, News.__table__, CartItem.__table__, Category.__table__,
+                  SeoMeta.__table__, product_category):
+        create_indexes(connection, table)
+
+
+@migration('0002_updated_at')
+def updated_at_columns(connection):
+    """Колонки updated_at у товаров, категорий, новостей и версий кэша (для ETag/Last-Modified)"""
+    for model in (Product, Category, News):
+        if add_column(connection, model.__table__, 'updated_at'):
+            # Пока записи не менялись, время изменения - время создания
+            connection.execute(update(model).values(updated_at=model.created_at))
+    add_column(connection, CacheVersion.__table__, 'updated_at')
+
+
+@migration('0003_image_jobs')
+def image_jobs(connection):
+    """Таблица заданий фоновой обработки изображений"""
+    ImageJob.__table__.create(connection, checkfirst=True)
+
+
+@migration('0004_image_variants')
+def image_variants(connection):
+    """Наборы производных изображений (ширины x форматы для srcset)"""
+    ImageVariant.__table__.create(connection, checkfirst=True)
+
+
+@migration('0005_image_blobs')
+def image_blobs(connection):
+    """Загрузки по хэшу содержимого со счетчиком ссылок (дедупликация старых - flask images dedup)"""
+    ImageBlob.__table__.create(connection, checkfirst=True)
+
+
+@migration('0006_category_closure')
+def category_closure(connection):
+    """Таблица замыкания дерева категорий, заполненная по текущим parent_id"""
+    CategoryClosure.__table__.create(connection, checkfirst=True)
+    fill_closure(connection)
+
+
+@migration('0007_product_numbers')
+def product_numbers(connection):
+    """Номера товаров для поиска по артикулу, заполненные основными артикулами"""
+    rebuild_product_numbers(connection)
+
+
+# === Применение ===
+def applied_migrations(connection):
+    """Имена примененных миграций"""
+    SchemaMigration.__table__.create(connection, checkfirst=True)
+    return set(connection.execute(select(SchemaMigration.name)).scalars())
+
+
+def upgrade(engine=None):
+    """Применяет новые миграции по порядку, возвращает [(имя, секунды)]"""
+    engine = engine or db.engine
+    with engine.begin() as connection:
+        applied = applied_migrations(connection)
+
+    done = []
+    for name, function in MIGRATIONS:
+        if name in applied:
+            continue
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            function(connection)
+            connection.execute(insert(SchemaMigration).values(name=name))
+        done.append((name, time.perf_counter() - started))
+    return done
+
+
+# === CLI ===
+migrate_cli = AppGroup('migrate', help='Миграции схемы базы')
+
+
+@migrate_cli.command('upgrade')
+def upgrade_command():
+    """Применить новые миграции"""
+    done = upgrade()
+    for name, seconds in done:
+        click.echo(f'{name}: применена за {seconds:.2f} c')
+    if not done:
+        click.echo('Новых миграций нет')
+
+
+@migrate_cli.command('status')
+def status_command():
+    """Показать миграции и отметку о применении"""
+    with db.engine.begin() as connection:
+        applied = applied_migrations(connection)
+    for name, function in MIGRATIONS:
+        mark = '+' if name in applied else ' '
+        click.echo(f'[{mark}] {name} - {(function.__doc__ or "").strip()}')
+
+
+def init_app(app):
+    app.cli.add_command(migrate_cli)
@@ -0,0 +1,103 @@
+"""
+Снимок навигации каталога: дерево категорий, бренды и страны
+
+Снимок строится один раз на воркер из простых кортежей (без ORM-объектов,
+которые нельзя делить между запросами) и пересобирается только после того,
+как изменение категорий, брендов или стран увеличит версию 'navigation'. Поэтому
+сайдбар каталога рендерится без запросов к базе.
+
+Узлы повторяют атрибуты Category, которые используют шаблоны и SEO
+(id, name, slug, parent_id, children, get_full_name(), get_full_slug()).
+"""
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from sqlalchemy import select
+
+from app import db
+from app.models import Brand, Category, Country
+from app.utilities.versions import get_version
+
+
+class CategoryNode(namedtuple('CategoryNode', 'id name slug parent_id full_slug full_name children')):
+    """Категория в снимке навигации"""
+    __slots__ = ()
+
+    def is_parent(self):
+        return self.parent_id is None
+
+    def get_full_name(self):
+        return self.full_name
+
+    def get_full_slug(self):
+        return self.full_slug
+
+
+BrandItem = namedtuple('BrandItem', 'id name slug')
+CountryItem = namedtuple('CountryItem', 'id name')
+
+Navigation = namedtuple('Navigation', 'version roots categories by_id by_path brands brand_by_id countries country_by_id')
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def build_navigation(version=0):
+    """Собирает снимок из базы (три запроса)"""
+    rows = db.session.execute(
+        select(Category.id, Category.name, Category.slug, Category.parent_id).order_by(Category.id)
+    ).all()
+    brands = tuple(BrandItem(*row) for row in db.session.execute(
+        select(Brand.id, Brand.name, Brand.slug).order_by(Brand.id)
+    ).all())
+    countries = tuple(CountryItem(*row) for row in db.session.execute(
+        select(Country.id, Country.name).order_by(Country.id)
+    ).all())
+
+    by_id_row = {row.id: row for row in rows}
+    children = {}
+    for row in rows:
+        children.setdefault(row.parent_id, []).append(row.id)
+
+    nodes = {}
+
+    def make_node(category_id, parent_slug, parent_name, visited):
+        row = by_id_row[category_id]
+        full_slug = f'{parent_slug}/{row.slug}' if parent_slug else row.slug
+        # Как Category.get_full_name: только непосредственный родитель
+        full_name = f'{parent_name} → {row.name}' if parent_name else row.name
+        visited = visited | {category_id}
+        node = CategoryNode(row.id, row.name, row.slug, row.parent_id, full_slug, full_name, tuple(
+            make_node(child_id, full_slug, row.name, visited)
+            for child_id in children.get(category_id, ()) if child_id not in visited
+        ))
+        nodes[category_id] = node
+        return node
+
+    roots = tuple(make_node(category_id, None, None, frozenset()) for category_id in children.get(None, ()))
+    categories = tuple(nodes[row.id] for row in rows if row.id in nodes)
+    return Navigation(
+        version=version,
+        roots=roots,
+        categories=categories,
+        by_id=MappingProxyType(nodes),
+        by_path=MappingProxyType({node.full_slug: node for node in categories}),
+        brands=brands,
+        brand_by_id=MappingProxyType({brand.id: brand for brand in brands}),
+        countries=countries,
+        country_by_id=MappingProxyType({country.id: country for country in countries}),
+    )
+
+
+def get_navigation():
+    """Актуальный снимок навигации текущего воркера"""
+    global _snapshot
+    version = get_version('navigation')
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = build_navigation(version)
+            snapshot = _snapshot
+    return snapshot
@@ -0,0 +1,209 @@
+"""
+Кэш готовых страниц для анонимных посетителей
+
+Включается PAGE_CACHE_URL (тот же формат, что у кэша поиска: memory://,
+sqlite:////path/pages.db, redis://...). Кэшируются только GET-запросы без
+входа в аккаунт и без ожидающих flash-сообщений к endpoint из
+PAGE_CACHE_TTLS; ключ - хост, путь и нормализованная строка запроса
+(параметры отсортированы, пустые и utm-метки отброшены).
+
+Каждая страница помечена тегами: общими для endpoint (PAGE_TAGS) и
+конкретными, которые добавляет сам маршрут (add_page_tags('product:5')).
+У тега есть токен в том же хранилище; запись страницы хранит токены на
+момент рендеринга и считается устаревшей, если хоть один токен сменился.
+Токены меняются после коммита, изменившего соответствующие модели (в том
+числе из админки), - так правка товара сбрасывает только его страницу и
+списки каталога.
+
+В кэше memory:// у каждого воркера свои токены, поэтому к ним добавляется
+версия данных из cache_version (versions.py): правка в одном воркере сбросит
+страницы и в остальных, пусть и целой группой (каталог, новости, настройки).
+"""
+import uuid
+from urllib.parse import urlencode
+
+from flask import current_app, g, has_app_context, request, session
+from flask_login import current_user
+from sqlalchemy import event
+
+from app import db
+from app.models import Product, ProductNumber, Category, Brand, Country, News, Setting, SeoMeta
+from app.utilities.cache import create_cache
+from app.utilities.versions import get_version
+
+# Общие теги страниц по endpoint: от каких данных зависит страница целиком
+PAGE_TAGS = {
+    'main.index': ('settings', 'catalog', 'news'),
+    'main.catalog': ('settings', 'catalog'),
+    'main.catalog_by_slug': ('settings', 'catalog'),
+    'main.product_detail': ('settings', 'navigation'),
+    'main.news': ('settings', 'news', 'catalog'),
+    'main.news_item': ('settings', 'news', 'catalog'),
+}
+
+# Группа версий (versions.py) для тега - для кэша в памяти воркера
+TAG_VERSION_GROUPS = {
+    'settings': 'settings',
+    'catalog': 'catalog',
+    'navigation': 'navigation',
+    'news': 'news',
+    'product': 'catalog',
+    'category': 'catalog',
+}
+
+# Параметры запроса, не влияющие на страницу
+IGNORED_PARAMS = ('utm_', 'fbclid', 'gclid', 'yclid', '_openstat')
+
+# Заголовки ответа, которые не сохраняются вместе со страницей
+SKIPPED_HEADERS = {'Set-Cookie', 'Content-Length', 'Server-Timing'}
+
+
+def add_page_tags(*tags):
+    """Добавляет теги к кэшируемой странице текущего запроса (product:5, news:3, ...)"""
+    if 'page_cache_key' in g:
+        g.page_cache_tags.update(tags)
+
+
+def model_tags(obj):
+    """Теги страниц, которые устаревают при изменении объекта"""
+    if isinstance(obj, Product):
+        return ('catalog', f'product:{obj.id}')
+    if isinstance(obj, ProductNumber):
+        return ('catalog', f'product:{obj.product_id}')
+    if isinstance(obj, Category):
+        return ('catalog', 'navigation', f'category:{obj.id}')
+    if isinstance(obj, (Brand, Country)):
+        return ('catalog', 'navigation')
+    if isinstance(obj, News):
+        return ('news', f'news:{obj.id}')
+    if isinstance(obj, (Setting, SeoMeta)):
+        return ('settings',)
+    return ()
+
+
+def normalized_query_string(args):
+    """Строка запроса в каноническом виде для ключа кэша"""
+    items = sorted((key, value) for key, values in args.lists() for value in values
+                   if value != '' and not key.startswith(IGNORED_PARAMS))
+    return urlencode(items)
+
+
+class PageCache:
+    """Расширение Flask: кэш страниц с тегами"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('PAGE_CACHE_URL')
+        if not url:
+            return
+        app.extensions['page_cache'] = create_cache(url, app.config.get('PAGE_CACHE_SIZE', 2000))
+        app.before_request(self._serve_cached)
+        app.after_request(self._store_response)
+
+    @property
+    def cache(self):
+        return current_app.extensions.get('page_cache')
+
+    # === Теги ===
+    def _tag_token(self, cache, tag):
+        key = f'page-tag:{tag}'
+        token = cache.get(key)
+        if token is None:
+            # Тега нет (или он вытеснен) - новый токен делает устаревшими все страницы с ним
+            token = uuid.uuid4().hex
+            cache.set(key, token, ttl=0)
+        if cache.name == 'memory':
+            group = TAG_VERSION_GROUPS.get(tag.split(':', 1)[0])
+            if group:
+                token = f'{token}:{get_version(group)}'
+        return token
+
+    def invalidate(self, tags):
+        """Делает устаревшими все страницы с любым из тегов"""
+        if not has_app_context():
+            return
+        cache = self.cache
+        if cache is None:
+            return
+        for tag in tags:
+            cache.set(f'page-tag:{tag}', uuid.uuid4().hex, ttl=0)
+
+    def clear(self):
+        cache = self.cache
+        if cache is not None:
+            cache.clear()
+
+    # === Хуки запроса ===
+    @staticmethod
+    def _cacheable_request():
+        return (request.method in ('GET', 'HEAD')
+                and request.endpoint in current_app.config.get('PAGE_CACHE_TTLS', {})
+                and '_flashes' not in session
+                and not current_user.is_authenticated)
+
+    def _serve_cached(self):
+        if not self._cacheable_request():
+            return None
+        cache = self.cache
+        key = f'page:{request.host}{request.path}?{normalized_query_string(request.args)}'
+        entry = cache.get(key)
+        if entry is not None:
+            status, headers, body, tokens = entry
+            if all(self._tag_token(cache, tag) == token for tag, token in tokens.items()):
+                response = current_app.response_class(body, status=status, headers=headers)
+                response.headers['X-Page-Cache'] = 'HIT'
+                # Сохраненные ETag/Last-Modified позволяют ответить 304 и из кэша
+                return response.make_conditional(request)
+        # Страница будет отрендерена - запоминаем ключ и токены тегов до рендеринга,
+        # чтобы изменение во время рендеринга не попало в кэш под новым токеном
+        g.page_cache_key = key
+        g.page_cache_tokens = {tag: self._tag_token(cache, tag)
+                               for tag in PAGE_TAGS.get(request.endpoint, ('settings',))}
+        g.page_cache_tags = set(g.page_cache_tokens)
+        return None
+
+    def _store_response(self, response):
+        key = g.pop('page_cache_key', None)
+        if key is None:
+            return response
+        response.headers['X-Page-Cache'] = 'MISS'
+        # Ответ с cookie (измененная сессия, flash) или не 200 не годится для других посетителей;
+        # cookie сессии Flask добавит позже, поэтому проверяется session.modified
+        if (response.status_code != 200 or response.direct_passthrough or session.modified
+                or 'Set-Cookie' in response.headers):
+            return response
+        cache = self.cache
+        tokens = g.page_cache_tokens
+        for tag in g.page_cache_tags - set(tokens):
+            tokens[tag] = self._tag_token(cache, tag)
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name not in SKIPPED_HEADERS and name != 'X-Page-Cache']
+        ttl = current_app.config['PAGE_CACHE_TTLS'][request.endpoint]
+        cache.set(key, (response.status_code, headers, response.get_data(), tokens), ttl=ttl)
+        return response
+
+
+page_cache = PageCache()
+
+
+# === Сброс тегов после изменений в базе ===
+@event.listens_for(db.session, 'after_flush')
+def _collect_page_tags(session, flush_context):
+    tags = session.info.setdefault('page_cache_tags', set())
+    for obj in session.new | session.dirty | session.deleted:
+        tags.update(model_tags(obj))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_after_commit(session):
+    tags = session.info.pop('page_cache_tags', None)
+    if tags:
+        page_cache.invalidate(sorted(tags))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('page_cache_tags', None)
@@ -0,0 +1,215 @@
+"""
+Пагинация списков
+
+ManualPagination - для результатов, посчитанных вне Flask-SQLAlchemy.
+KeysetPagination - постраничный вывод по ключу сортировки (курсору): следующая
+страница выбирается условием "после последней строки", а не OFFSET, поэтому
+дальние страницы не дороже первой. Включается настройкой CURSOR_PAGINATION;
+общее количество берется из кэша и служит только для отображения.
+"""
+import hashlib
+from datetime import datetime
+
+from flask import abort, current_app, request, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import literal, tuple_, type_coerce
+from sqlalchemy.types import NullType
+
+from app.utilities.cache import MemoryCache
+from app.utilities.versions import get_versions
+
+# Кэш количества строк в списках (ключ включает версии данных)
+_count_cache = MemoryCache(max_entries=500, default_ttl=300)
+
+
+class ManualPagination:
+    """Пагинация для результатов, посчитанных вне Flask-SQLAlchemy (совместима с шаблонами)"""
+
+    def __init__(self, items, page, per_page, total):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.pages = (total + per_page - 1) // per_page if per_page > 0 else 0
+        self.has_prev = page > 1
+        self.has_next = page < self.pages
+        self.prev_num = page - 1 if self.has_prev else None
+        self.next_num = page + 1 if self.has_next else None
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
+        last = 0
+        for num in range(1, self.pages + 1):
+            if num <= left_edge or \
+                    (num > self.page - left_current - 1 and num < self.page + right_current) or \
+                    num > self.pages - right_edge:
+                if last + 1 != num:
+                    yield None
+                yield num
+                last = num
+
+    def cursor_for(self, page_num):
+        """Курсор для перехода на страницу (у обычной пагинации курсоров нет)"""
+        return None
+
+
+class KeysetOrder:
+    """
+    Стабильный порядок для курсорной пагинации
+
+    Колонки сортируются в одном направлении; последней должна быть уникальная
+    колонка (id), иначе строки с одинаковым ключом могут потеряться.
+    Ключ сравнивается в том виде, в каком он хранится в базе (без преобразования
+    типов): в SQLite даты записываются строками разного формата, и значение,
+    прошедшее через DateTime, может не совпасть с сохраненным.
+    """
+
+    def __init__(self, name, *columns, descending=False):
+        self.name = name
+        self.columns = columns
+        self.descending = descending
+
+    def order_by(self, reverse=False):
+        descending = self.descending != reverse
+        return [column.desc() if descending else column.asc() for column in self.columns]
+
+    def key_columns(self):
+        """Колонки ключа для выборки вместе со строками (сырые значения из базы)"""
+        return [type_coerce(column, NullType()).label(f'keyset_{i}') for i, column in enumerate(self.columns)]
+
+    def after(self, values, reverse=False):
+        """Условие "строго после ключа" в направлении обхода"""
+        key = tuple_(*(type_coerce(column, NullType()) for column in self.columns))
+        bound = tuple_(*(literal(value, NullType()) for value in values))
+        if self.descending != reverse:
+            return key < bound
+        return key > bound
+
+
+class KeysetPagination(ManualPagination):
+    """Страница курсорной пагинации с интерфейсом Pagination для шаблонов"""
+
+    def __init__(self, items, keys, page, per_page, total, has_prev, has_next, order):
+        # Количество приблизительное: не даем ему противоречить тому, что реально выбрано
+        total = max(total, (page - 1) * per_page + len(items) + (1 if has_next else 0))
+        super().__init__(items, page, per_page, total)
+        self.order = order
+        self.keys = keys
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_num = page - 1 if has_prev else None
+        self.next_num = page + 1 if has_next else None
+
+    def cursor_for(self, page_num):
+        if not self.items:
+            return None
+        if page_num == self.next_num:
+            return dump_cursor(self.order, self.keys[-1], page_num)
+        if page_num == self.prev_num and page_num > 1:
+            return dump_cursor(self.order, self.keys[0], page_num, backward=True)
+        return None
+
+
+# === Курсоры ===
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='pagination-cursor')
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return ['dt', value.isoformat()]
+    return ['v', value]
+
+
+def _load_value(value):
+    kind, raw = value
+    return datetime.fromisoformat(raw) if kind == 'dt' else raw
+
+
+def dump_cursor(order, key, page, backward=False):
+    """Непрозрачный подписанный токен: порядок, ключ граничной строки и номер страницы"""
+    payload = {'o': order.name, 'k': [_dump_value(v) for v in key], 'p': page}
+    if backward:
+        payload['b'] = 1
+    return _serializer().dumps(payload)
+
+
+def load_cursor(token, order):
+    """Разбирает курсор; None, если он поврежден или от другого порядка сортировки"""
+    try:
+        payload = _serializer().loads(token)
+        if payload['o'] != order.name or len(payload['k']) != len(order.columns):
+            return None
+        return [_load_value(v) for v in payload['k']], int(payload['p']), bool(payload.get('b'))
+    except (BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+
+# === Подсчет ===
+def cached_count(query, versions=()):
+    """
+    Количество строк запроса из кэша
+
+    Ключ - текст запроса с параметрами и версии данных, поэтому после изменения
+    каталога количество пересчитывается; без версий значение живет до TTL кэша.
+    """
+    statement = query.statement.compile()
+    digest = hashlib.sha1(
+        (str(statement) + repr(sorted(statement.params.items(), key=lambda item: item[0]))).encode('utf-8')
+    ).hexdigest()
+    key = f'count:{get_versions(*versions)}:{digest}'
+    return _count_cache.get_or_set(key, lambda: query.order_by(None).count())
+
+
+def paginate_query(query, order, per_page, versions=()):
+    """
+    Страница запроса по параметрам ?page= / ?cursor= текущего запроса
+
+    С включенной CURSOR_PAGINATION ссылки "вперед/назад" содержат курсор, и
+    следующая страница выбирается по ключу сортировки без OFFSET. Переход на
+    произвольный номер страницы по-прежнему работает через OFFSET.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    total = cached_count(query, versions)
+
+    if not current_app.config.get('CURSOR_PAGINATION'):
+        items = query.order_by(*order.order_by()).offset((page - 1) * per_page).limit(per_page).all()
+        if page > 1 and not items:
+            abort(404)
+        return ManualPagination(items, page, per_page, total)
+
+    cursor = request.args.get('cursor')
+    parsed = load_cursor(cursor, order) if cursor else None
+    query = query.add_columns(*order.key_columns())
+    if parsed is None:
+        rows = query.order_by(*order.order_by()).offset((page - 1) * per_page).limit(per_page + 1).all()
+        if page > 1 and not rows:
+            abort(404)
+        has_prev, has_next = page > 1, len(rows) > per_page
+        rows = rows[:per_page]
+    else:
+        key, page, backward = parsed
+        rows = query.filter(order.after(key, reverse=backward)) \
+            .order_by(*order.order_by(reverse=backward)).limit(per_page + 1).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backward:
+            rows.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = page > 1, more
+
+    return KeysetPagination([row[0] for row in rows], [list(row[1:]) for row in rows], page, per_page,
+                            total, has_prev=has_prev, has_next=has_next, order=order)
+
+
+def page_url(pagination, page_num):
+    """Ссылка на страницу списка с сохранением фильтров текущего запроса"""
+    args = request.args.to_dict(flat=False)
+    args.pop('page', None)
+    args.pop('cursor', None)
+    cursor = pagination.cursor_for(page_num)
+    if cursor:
+        args['cursor'] = cursor
+    elif page_num > 1:
+        args['page'] = page_num
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
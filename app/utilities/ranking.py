@@ -0,0 +1,119 @@
+"""
+Ранжирование результатов поиска
+
+Кандидаты приходят из поискового индекса (окно лучших по оценке СУБД),
+здесь они упорядочиваются по уровню совпадения:
+    точный артикул > начало названия > слово в названии > подстрока в названии,
+    артикуле или бренде > краткое описание > полное описание > категория
+Внутри уровня - BM25F по всем полям, при равенстве - по id товара, поэтому
+порядок выдачи детерминирован.
+"""
+import heapq
+import math
+import re
+
+from app.utilities.helpers import normalize_article
+
+# Уровни совпадения документа с запросом
+TIER_EXACT_ARTICLE = 7
+TIER_NAME_PREFIX = 6
+TIER_NAME_WORD = 5
+TIER_NAME_SUBSTRING = 4
+TIER_SHORT_DESC = 3
+TIER_FULL_DESC = 2
+TIER_CATEGORY = 1
+
+# Веса полей и параметры BM25F
+FIELD_WEIGHTS = {
+    'name': 5.0,
+    'article': 4.0,
+    'brand': 2.0,
+    'short_desc': 1.5,
+    'full_desc': 1.0,
+    'categories': 1.0,
+}
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def _word_level(word, document, name_words):
+    """Уровень совпадения одного слова запроса с документом"""
+    if word in name_words:
+        return TIER_NAME_WORD
+    if word in document['name'] or word in document['article'] or word in document['brand']:
+        return TIER_NAME_SUBSTRING
+    if word in document['short_desc']:
+        return TIER_SHORT_DESC
+    if word in document['full_desc']:
+        return TIER_FULL_DESC
+    if word in document['categories']:
+        return TIER_CATEGORY
+    return 0
+
+
+def _idf(total_documents, frequency):
+    return math.log(1 + (total_documents - frequency + 0.5) / (frequency + 0.5))
+
+
+def score_document(document, words, phrase, article, idf, average_lengths):
+    """Возвращает (уровень, число совпавших слов, bm25) для документа"""
+    if article and normalize_article(document['article']) == article:
+        return TIER_EXACT_ARTICLE, len(words), 0.0
+
+    name_words = set(_WORD_RE.findall(document['name']))
+    levels = [_word_level(word, document, name_words) for word in words]
+    tier = min(levels) if levels else 0
+    if phrase and document['name'].startswith(phrase):
+        tier = TIER_NAME_PREFIX
+
+    bm25 = 0.0
+    for word in words:
+        weighted_frequency = 0.0
+        for field, weight in FIELD_WEIGHTS.items():
+            value = document[field]
+            frequency = value.count(word) if value else 0
+            if frequency:
+                length_ratio = len(value) / (average_lengths[field] or 1)
+                weighted_frequency += weight * frequency / (1 - BM25_B + BM25_B * length_ratio)
+        if weighted_frequency:
+            bm25 += idf[word] * weighted_frequency / (BM25_K1 + weighted_frequency)
+
+    return tier, sum(1 for level in levels if level), bm25
+
+
+def rank_documents(documents, words, query_text, total_documents, limit=None, frequencies=None):
+    """
+    Упорядочивает документы по релевантности, возвращает id товаров
+
+    documents - словари с полями SEARCH_FIELDS в нижнем регистре и product_id;
+    words - нормализованные слова запроса (search.split_query);
+    frequencies - число документов с каждым словом во всем индексе (для IDF),
+    без него частоты считаются по самим кандидатам.
+    С limit сортируется только нужное количество лучших (heapq).
+    """
+    phrase = ' '.join(words)
+    if not documents or not words:
+        return [document['product_id'] for document in documents[:limit]]
+
+    if frequencies is None:
+        frequencies = {word: sum(1 for document in documents
+                                 if any(word in document[field] for field in FIELD_WEIGHTS))
+                       for word in words}
+    total_documents = max(total_documents, len(documents))
+    idf = {word: _idf(total_documents, frequencies.get(word, 0)) for word in words}
+    average_lengths = {field: sum(len(document[field]) for document in documents) / len(documents)
+                       for field in FIELD_WEIGHTS}
+    article = normalize_article(query_text)
+
+    keyed = []
+    for document in documents:
+        tier, matched, bm25 = score_document(document, words, phrase, article, idf, average_lengths)
+        keyed.append(((-tier, -matched, -round(bm25, 9), document['product_id']), document['product_id']))
+
+    if limit is not None and limit < len(keyed):
+        keyed = heapq.nsmallest(limit, keyed)
+    else:
+        keyed.sort()
+    return [product_id for _, product_id in keyed]
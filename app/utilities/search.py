@@ -0,0 +1,666 @@
+"""
+Полнотекстовый поиск товаров
+
+Индекс хранится в отдельной таблице product_search и обновляется в той же
+транзакции, что и изменения Product/Category/Brand (через события сессии).
+Бэкенд выбирается по SQLALCHEMY_DATABASE_URI:
+    sqlite      - FTS5 с триграммным токенайзером (поиск подстрок внутри слов)
+    postgresql  - tsvector + GIN индекс (поиск по префиксам слов)
+    like        - запасной вариант на LIKE для остальных СУБД
+"""
+import hashlib
+import re
+import sqlite3
+import time
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from sqlalchemy import event, inspect, select, text
+
+from app import db
+from app.models import Product, ProductNumber, Category, Brand, product_category
+from app.utilities.cache import create_cache
+from app.utilities.helpers import normalize_article
+from app.utilities.ranking import rank_documents
+from app.utilities.versions import get_version
+
+# Поля товара, попадающие в поисковый документ
+SEARCH_FIELDS = ('name', 'article', 'short_desc', 'full_desc', 'brand', 'categories')
+
+# Разделитель полей в документе бэкендов без отдельных колонок (в тексте полей не встречается)
+FIELD_SEPARATOR = '\x1f'
+
+# Размер пачки при индексации
+INDEX_BATCH_SIZE = 500
+
+# Минимальная длина нормализованного номера для быстрого поиска по артикулу
+MIN_ARTICLE_LENGTH = 4
+
+
+def normalize_text_for_search(text):
+    """Нормализует текст для поиска - убирает лишние пробелы и приводит к нижнему регистру"""
+    if not text:
+        return ""
+    return re.sub(r'\s+', ' ', str(text).strip().lower())
+
+
+def split_query(query_text):
+    """Разбивает поисковый запрос на уникальные нормализованные слова"""
+    words = []
+    for word in normalize_text_for_search(query_text).split():
+        if word not in words:
+            words.append(word)
+    return words
+
+
+def looks_like_article(query_text):
+    """Похож ли запрос на номер детали: 'AF-12345', 'af 12345', '0 986 452 041'"""
+    normalized = normalize_article(query_text)
+    return len(normalized) >= MIN_ARTICLE_LENGTH and any(ch.isdigit() for ch in normalized)
+
+
+def find_by_article(query_text, limit=None):
+    """
+    Поиск товаров по артикулу и кросс-номерам одним индексным запросом
+
+    Точные совпадения нормализованного номера идут первыми, затем совпадения
+    по префиксу. Возвращает список id товаров без повторов.
+    """
+    if not looks_like_article(query_text):
+        return []
+    normalized = normalize_article(query_text)
+
+    # Диапазон вместо LIKE, чтобы запрос использовал индекс при любой collation
+    query = (
+        select(ProductNumber.product_id)
+        .where(ProductNumber.normalized >= normalized,
+               ProductNumber.normalized < normalized + '\uffff')
+        .order_by((ProductNumber.normalized != normalized), ProductNumber.is_cross,
+                  ProductNumber.normalized, ProductNumber.product_id)
+    )
+    product_ids = []
+    for product_id in db.session.execute(query).scalars():
+        if product_id not in product_ids:
+            product_ids.append(product_id)
+            if limit and len(product_ids) >= limit:
+                break
+    return product_ids
+
+
+def rebuild_product_numbers(connection):
+    """Создает таблицу номеров при необходимости и добавляет недостающие основные артикулы"""
+    ProductNumber.__table__.create(connection, checkfirst=True)
+    existing = set(connection.execute(
+        select(ProductNumber.product_id).where(ProductNumber.is_cross.is_(False))
+    ).scalars())
+    missing = [
+        {'product_id': product_id, 'number': article, 'normalized': normalize_article(article), 'is_cross': False}
+        for product_id, article in connection.execute(select(Product.id, Product.article))
+        if product_id not in existing
+    ]
+    for start in range(0, len(missing), INDEX_BATCH_SIZE):
+        connection.execute(ProductNumber.__table__.insert(), missing[start:start + INDEX_BATCH_SIZE])
+    return len(missing)
+
+
+def _escape_like(value):
+    """Экранирует спецсимволы LIKE"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def collect_documents(connection, product_ids=None):
+    """
+    Собирает поисковые документы товаров (генератор пачек словарей)
+
+    Читает только нужные колонки, без загрузки ORM-объектов.
+    """
+    if product_ids is None:
+        id_query = select(Product.id).order_by(Product.id)
+        product_ids = [row[0] for row in connection.execute(id_query)]
+    else:
+        product_ids = sorted(set(product_ids))
+
+    for start in range(0, len(product_ids), INDEX_BATCH_SIZE):
+        batch = product_ids[start:start + INDEX_BATCH_SIZE]
+
+        rows = connection.execute(
+            select(Product.id, Product.name, Product.article, Product.short_desc,
+                   Product.full_desc, Brand.name)
+            .outerjoin(Brand, Brand.id == Product.brand_id)
+            .where(Product.id.in_(batch))
+        ).all()
+
+        categories = {}
+        category_rows = connection.execute(
+            select(product_category.c.product_id, Category.name)
+            .join(Category, Category.id == product_category.c.category_id)
+            .where(product_category.c.product_id.in_(batch))
+        )
+        for product_id, category_name in category_rows:
+            categories.setdefault(product_id, []).append(normalize_text_for_search(category_name))
+
+        documents = []
+        for product_id, name, article, short_desc, full_desc, brand_name in rows:
+            documents.append({
+                'product_id': product_id,
+                'name': normalize_text_for_search(name),
+                'article': normalize_text_for_search(article),
+                'short_desc': normalize_text_for_search(short_desc),
+                'full_desc': normalize_text_for_search(full_desc),
+                'brand': normalize_text_for_search(brand_name),
+                'categories': '\n'.join(sorted(categories.get(product_id, [])))
+            })
+        yield documents
+
+
+class LikeSearchBackend:
+    """Запасной бэкенд: одна текстовая колонка и поиск подстрок через LIKE"""
+    name = 'like'
+    table_name = 'product_search'
+    key_column = 'product_id'
+
+    def __init__(self):
+        self._ready = False
+
+    # === Схема ===
+    def create_index(self, connection):
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {self.table_name} ('
+            f'product_id INTEGER PRIMARY KEY, document TEXT NOT NULL)'
+        ))
+
+    def drop_index(self, connection):
+        connection.execute(text(f'DROP TABLE IF EXISTS {self.table_name}'))
+
+    def ensure(self, connection):
+        """
+        Создает индекс при первом обращении и наполняет его; True - индекс только что создан
+
+        Индекс создается в транзакции connection, поэтому готовым он считается
+        только после ее фиксации: при откате следующий вызов создаст его заново.
+        """
+        if self._ready:
+            return False
+        if inspect(connection).has_table(self.table_name):
+            self._ready = True
+            return False
+        self.create_index(connection)
+        self.index_products(connection)
+        self._ready_on_commit(connection)
+        return True
+
+    def _ready_on_commit(self, connection):
+        def mark_ready(conn):
+            self._ready = True
+
+        event.listen(connection, 'commit', mark_ready, once=True)
+
+    # === Запись ===
+    @staticmethod
+    def _document_text(document):
+        return FIELD_SEPARATOR.join(document[field] for field in SEARCH_FIELDS)
+
+    def write_documents(self, connection, documents):
+        self.delete_documents(connection, [d['product_id'] for d in documents])
+        connection.execute(
+            text(f'INSERT INTO {self.table_name} (product_id, document) VALUES (:product_id, :document)'),
+            [{'product_id': d['product_id'], 'document': self._document_text(d)} for d in documents]
+        )
+
+    def delete_documents(self, connection, product_ids):
+        product_ids = list(product_ids)
+        for start in range(0, len(product_ids), INDEX_BATCH_SIZE):
+            batch = product_ids[start:start + INDEX_BATCH_SIZE]
+            params = {f'id{i}': product_id for i, product_id in enumerate(batch)}
+            placeholders = ', '.join(f':{key}' for key in params)
+            connection.execute(
+                text(f'DELETE FROM {self.table_name} WHERE {self.key_column} IN ({placeholders})'), params
+            )
+
+    def index_products(self, connection, product_ids=None):
+        """(Пере)индексирует товары; без списка id - весь каталог"""
+        for documents in collect_documents(connection, product_ids):
+            if documents:
+                self.write_documents(connection, documents)
+
+    def rebuild(self, connection):
+        self.drop_index(connection)
+        self.create_index(connection)
+        self.index_products(connection)
+        self._ready_on_commit(connection)
+
+    # === Поиск ===
+    # Колонка, по началу которой ищется совпадение с началом названия
+    # (документ бэкенда на LIKE начинается с названия)
+    prefix_column = 'document'
+
+    def match_clause(self, words, require_all=False, fields=None):
+        """
+        Возвращает условие WHERE и параметры для слов запроса
+
+        require_all - совпадение всех слов (иначе любого), fields - ограничение
+        полями документа (бэкенд на LIKE его не поддерживает и ищет везде).
+        """
+        conditions = []
+        params = {}
+        for i, word in enumerate(words):
+            params[f'w{i}'] = f'%{_escape_like(word)}%'
+            conditions.append(f"document LIKE :w{i} ESCAPE '\\'")
+        return (' AND ' if require_all else ' OR ').join(conditions), params
+
+    def prefix_clause(self, words):
+        """Условие: название начинается с запроса"""
+        params = {'prefix': _escape_like(' '.join(words)) + '%'}
+        return f"{self.prefix_column} LIKE :prefix ESCAPE '\\'", params
+
+    def candidate_clauses(self, words):
+        """
+        Условия отбора кандидатов для ранжирования: от самых точных к самым широким
+
+        Внутри условия кандидаты берутся в порядке ключа индекса, поэтому СУБД
+        останавливается на первых найденных и не оценивает все совпадения.
+        """
+        clauses = [self.prefix_clause(words)]
+        if len(words) > 1:
+            clauses.append(self.match_clause(words, require_all=True))
+        clauses.append(self.match_clause(words))
+        return clauses
+
+    def fields_clause(self):
+        return 'document'
+
+    def row_to_document(self, row):
+        values = row[1].split(FIELD_SEPARATOR)
+        document = {field: values[i] if i < len(values) else '' for i, field in enumerate(SEARCH_FIELDS)}
+        document['product_id'] = row[0]
+        return document
+
+    def count(self, connection, words):
+        where, params = self.match_clause(words)
+        return connection.execute(
+            text(f'SELECT count(*) FROM {self.table_name} WHERE {where}'), params
+        ).scalar() or 0
+
+    def document_count(self, connection):
+        """Количество документов в индексе (для IDF), кэшируется на минуту"""
+        cached = getattr(self, '_document_count', None)
+        if cached is None or time.monotonic() - cached[1] > 60:
+            count = connection.execute(text(f'SELECT count(*) FROM {self.table_name}')).scalar() or 0
+            cached = self._document_count = (count, time.monotonic())
+        return cached[0]
+
+    def fetch(self, connection, clause, limit, offset=0, with_fields=False, exclude=()):
+        """
+        Совпадения по условию из match_clause в порядке ключа индекса
+
+        С with_fields возвращает документы (для ранжирования), иначе - только id.
+        exclude - id, которые нужно пропустить (уже отобранные кандидаты).
+        """
+        where, params = clause
+        params = dict(params, limit=limit, offset=offset)
+        if exclude:
+            placeholders = []
+            for i, product_id in enumerate(exclude):
+                params[f'x{i}'] = product_id
+                placeholders.append(f':x{i}')
+            where = f'({where}) AND {self.key_column} NOT IN ({", ".join(placeholders)})'
+        columns = self.key_column + (f', {self.fields_clause()}' if with_fields else '')
+        rows = connection.execute(
+            text(f'SELECT {columns} FROM {self.table_name} WHERE {where} '
+                 f'ORDER BY {self.key_column} LIMIT :limit OFFSET :offset'),
+            params
+        ).all()
+        if with_fields:
+            return [self.row_to_document(row) for row in rows]
+        return [row[0] for row in rows]
+
+
+class SqliteSearchBackend(LikeSearchBackend):
+    """SQLite FTS5 с триграммным токенайзером"""
+    name = 'sqlite'
+    key_column = 'rowid'
+
+    # Триграммный токенайзер не умеет искать слова короче трех символов
+    MIN_TRIGRAM_LENGTH = 3
+
+    def create_index(self, connection):
+        columns = ', '.join(SEARCH_FIELDS)
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table_name} "
+            f"USING fts5({columns}, tokenize='trigram')"
+        ))
+
+    def write_documents(self, connection, documents):
+        self.delete_documents(connection, [d['product_id'] for d in documents])
+        columns = ', '.join(SEARCH_FIELDS)
+        values = ', '.join(f':{field}' for field in SEARCH_FIELDS)
+        connection.execute(
+            text(f'INSERT INTO {self.table_name} (rowid, {columns}) VALUES (:product_id, {values})'),
+            documents
+        )
+
+    # LIKE по колонке FTS5 с триграммами тоже идет через индекс
+    prefix_column = 'name'
+
+    # Поля, совпадение в которых дает верхние уровни ранжирования
+    PRIMARY_FIELDS = ('name', 'article', 'brand')
+
+    def match_clause(self, words, require_all=False, fields=None):
+        conditions = []
+        params = {}
+        joiner = ' AND ' if require_all else ' OR '
+        fields = fields or SEARCH_FIELDS
+
+        long_words = [w for w in words if len(w) >= self.MIN_TRIGRAM_LENGTH]
+        short_words = [w for w in words if len(w) < self.MIN_TRIGRAM_LENGTH]
+
+        if long_words:
+            expression = joiner.join('"{}"'.format(w.replace('"', '""')) for w in long_words)
+            if fields != SEARCH_FIELDS:
+                expression = '{%s} : (%s)' % (' '.join(fields), expression)
+            params['match'] = expression
+            if require_all or not short_words:
+                conditions.append(f'{self.table_name} MATCH :match')
+            else:
+                # MATCH нельзя объединять с другими условиями через OR - только через подзапрос
+                conditions.append(f'rowid IN (SELECT rowid FROM {self.table_name} '
+                                  f'WHERE {self.table_name} MATCH :match)')
+
+        # Короткие слова ищем через LIKE (полный просмотр индекса, но только по коротким запросам)
+        for i, word in enumerate(short_words):
+            params[f'w{i}'] = f'%{_escape_like(word)}%'
+            conditions.append('(' + ' OR '.join(f"{field} LIKE :w{i} ESCAPE '\\'" for field in fields) + ')')
+
+        return joiner.join(conditions), params
+
+    def prefix_clause(self, words):
+        # С ESCAPE триграммный индекс не используется - он нужен, только если в запросе есть % или _
+        phrase = ' '.join(words)
+        if '%' in phrase or '_' in phrase:
+            return super().prefix_clause(words)
+        return f'{self.prefix_column} LIKE :prefix', {'prefix': phrase + '%'}
+
+    def candidate_clauses(self, words):
+        # Короткие слова (полный просмотр через LIKE) не обязательны для кандидатов -
+        # их совпадение учитывает ранжирование
+        required = [w for w in words if len(w) >= self.MIN_TRIGRAM_LENGTH] or words
+        clauses = []
+        if len(' '.join(words)) >= self.MIN_TRIGRAM_LENGTH:
+            clauses.append(self.prefix_clause(words))
+        clauses.append(self.match_clause(required, require_all=True, fields=self.PRIMARY_FIELDS))
+        if len(words) > 1:
+            clauses.append(self.match_clause(required, require_all=True))
+        clauses.append(self.match_clause(words))
+        return clauses
+
+    def fields_clause(self):
+        return ', '.join(SEARCH_FIELDS)
+
+    def row_to_document(self, row):
+        document = dict(zip(SEARCH_FIELDS, (value or '' for value in row[1:])))
+        document['product_id'] = row[0]
+        return document
+
+
+class PostgresSearchBackend(LikeSearchBackend):
+    """PostgreSQL: tsvector с конфигурацией simple и GIN индекс"""
+    name = 'postgresql'
+
+    def create_index(self, connection):
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {self.table_name} ('
+            f'product_id INTEGER PRIMARY KEY, document TEXT NOT NULL, document_tsv TSVECTOR NOT NULL)'
+        ))
+        connection.execute(text(
+            f'CREATE INDEX IF NOT EXISTS ix_{self.table_name}_tsv '
+            f'ON {self.table_name} USING GIN (document_tsv)'
+        ))
+
+    def write_documents(self, connection, documents):
+        connection.execute(
+            text(f"INSERT INTO {self.table_name} (product_id, document, document_tsv) "
+                 f"VALUES (:product_id, :document, to_tsvector('simple', :document)) "
+                 f"ON CONFLICT (product_id) DO UPDATE SET "
+                 f"document = EXCLUDED.document, document_tsv = EXCLUDED.document_tsv"),
+            [{'product_id': d['product_id'], 'document': self._document_text(d)} for d in documents]
+        )
+
+    def match_clause(self, words, require_all=False, fields=None):
+        # В tsquery допустимы только "словарные" символы, остальное - разделители
+        terms = []
+        for word in words:
+            terms.extend(f'{part}:*' for part in re.findall(r'\w+', word))
+        if not terms:
+            return 'false', {}
+        query = (' & ' if require_all else ' | ').join(terms)
+        return "document_tsv @@ to_tsquery('simple', :query)", {'query': query}
+
+    def prefix_clause(self, words):
+        # Сначала отбор по GIN индексу, LIKE проверяет только найденное
+        where, params = self.match_clause(words, require_all=True)
+        prefix_where, prefix_params = super().prefix_clause(words)
+        return f'{where} AND {prefix_where}', dict(params, **prefix_params)
+
+
+BACKENDS = {
+    'like': LikeSearchBackend,
+    'sqlite': SqliteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def _sqlite_fts5_available():
+    """Проверяет, собран ли SQLite с FTS5 и поддерживает ли триграммный токенайзер"""
+    if sqlite3.sqlite_version_info < (3, 34, 0):
+        return False
+    connection = sqlite3.connect(':memory:')
+    try:
+        options = {row[0] for row in connection.execute('PRAGMA compile_options')}
+    finally:
+        connection.close()
+    return 'ENABLE_FTS5' in options
+
+
+def create_backend(app):
+    """Выбирает бэкенд поиска по настройке SEARCH_BACKEND или по URI базы данных"""
+    name = app.config.get('SEARCH_BACKEND')
+    if not name:
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        if uri.startswith('sqlite'):
+            name = 'sqlite' if _sqlite_fts5_available() else 'like'
+        elif uri.startswith('postgres'):
+            name = 'postgresql'
+        else:
+            name = 'like'
+    return BACKENDS[name]()
+
+
+class SearchIndex:
+    """Расширение Flask: доступ к поисковому бэкенду приложения"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['search_index'] = create_backend(app)
+        app.extensions['search_cache'] = create_cache(app.config.get('SEARCH_CACHE_URL'),
+                                                      app.config.get('SEARCH_CACHE_SIZE', 1000),
+                                                      app.config.get('SEARCH_CACHE_TTL', 300))
+        app.cli.add_command(search_cli)
+
+    @property
+    def backend(self):
+        return current_app.extensions['search_index']
+
+    @property
+    def cache(self):
+        return current_app.extensions['search_cache']
+
+    def cached(self, kind, query_text, page, compute):
+        """
+        Результат поиска из кэша (id товаров, не ORM-объекты)
+
+        Ключ включает версию каталога, поэтому любая запись в Product/Category/Brand
+        делает старые результаты недоступными во всех воркерах.
+        """
+        query_key = normalize_text_for_search(query_text)
+        if len(query_key) > 100:
+            query_key = hashlib.sha1(query_key.encode('utf-8')).hexdigest()
+        key = f'search:{kind}:{get_version("catalog")}:{page}:{query_key}'
+        return self.cache.get_or_set(key, compute)
+
+    def search(self, query_text, limit, offset=0):
+        """
+        Ищет товары по запросу, возвращает (ids, total) в порядке релевантности
+
+        Кандидаты (не больше SEARCH_RANK_WINDOW) отбираются из индекса ступенями
+        backend.candidate_clauses - от совпадений всех слов в названии к
+        совпадению любого слова - и упорядочиваются ranking.rank_documents.
+        Страницы за пределами окна идут в порядке id товаров.
+        """
+        words = split_query(query_text)
+        if not words:
+            return [], 0
+        connection = db.session.connection()
+        backend = self.backend
+        if backend.ensure(connection):
+            # Индекс создан в транзакции запроса: без фиксации он пропал бы при ее откате
+            db.session.commit()
+            connection = db.session.connection()
+
+        total = backend.count(connection, words)
+        if not total or offset >= total:
+            return [], total
+
+        window = current_app.config.get('SEARCH_RANK_WINDOW', 500)
+        documents = []
+        seen = set()
+        for clause in backend.candidate_clauses(words):
+            if len(documents) >= window:
+                break
+            for document in backend.fetch(connection, clause, window - len(documents),
+                                          with_fields=True, exclude=seen):
+                seen.add(document['product_id'])
+                documents.append(document)
+
+        frequencies = None
+        if total > len(documents) and len(words) > 1:
+            # Кандидаты - не весь результат: IDF по частотам во всем индексе
+            frequencies = self.document_frequencies(connection, words)
+        ranked = rank_documents(documents, words, query_text, backend.document_count(connection),
+                                limit=offset + limit, frequencies=frequencies)
+        ids = ranked[offset:offset + limit]
+
+        if len(ids) < limit and total > len(documents):
+            # Хвост за пределами окна ранжирования
+            tail_offset = max(offset - len(documents), 0)
+            ids.extend(backend.fetch(connection, backend.match_clause(words), limit - len(ids),
+                                     tail_offset, exclude=sorted(seen)))
+        return ids, total
+
+    def document_frequencies(self, connection, words):
+        """Число документов с каждым словом (кэшируется до изменения каталога)"""
+        version = get_version('catalog')
+        frequencies = {}
+        for word in words:
+            word_key = word if len(word) <= 100 else hashlib.sha1(word.encode('utf-8')).hexdigest()
+            frequencies[word] = self.cache.get_or_set(
+                f'search:df:{version}:{word_key}', lambda: self.backend.count(connection, [word])
+            )
+        return frequencies
+
+    def rebuild(self):
+        """Полная перестройка индекса и таблицы номеров товаров"""
+        connection = db.session.connection()
+        rebuild_product_numbers(connection)
+        self.backend.rebuild(connection)
+        db.session.commit()
+
+
+search_index = SearchIndex()
+
+
+# === Синхронизация индекса с изменениями каталога ===
+def _pending_changes(session):
+    return session.info.setdefault('search_changes', {'products': set(), 'deleted': set(),
+                                                      'categories': set(), 'brands': set()})
+
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_search_deletions(session, flush_context, instances):
+    """Товары удаляемых категорий и брендов: после flush связей с ними уже не найти"""
+    category_ids = [obj.id for obj in session.deleted if isinstance(obj, Category)]
+    brand_ids = [obj.id for obj in session.deleted if isinstance(obj, Brand)]
+    if not category_ids and not brand_ids:
+        return
+    connection = session.connection()
+    changes = _pending_changes(session)
+    if category_ids:
+        changes['products'].update(connection.execute(
+            select(product_category.c.product_id).where(product_category.c.category_id.in_(category_ids))
+        ).scalars())
+    if brand_ids:
+        changes['products'].update(connection.execute(
+            select(Product.id).where(Product.brand_id.in_(brand_ids))
+        ).scalars())
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_search_changes(session, flush_context):
+    """Запоминает товары, документы которых нужно обновить"""
+    changes = _pending_changes(session)
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Product):
+            changes['products'].add(obj.id)
+        elif isinstance(obj, Category) and obj in session.dirty:
+            changes['categories'].add(obj.id)
+        elif isinstance(obj, Brand) and obj in session.dirty:
+            changes['brands'].add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Product):
+            changes['deleted'].add(obj.id)
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _apply_search_changes(session, flush_context):
+    """Обновляет индекс в той же транзакции, что и изменения каталога"""
+    changes = session.info.pop('search_changes', None)
+    if not changes or not any(changes.values()):
+        return
+    backend = current_app.extensions.get('search_index') if has_app_context() else None
+    if backend is None:
+        return
+
+    connection = session.connection()
+    backend.ensure(connection)
+
+    product_ids = set(changes['products'])
+    if changes['categories']:
+        product_ids.update(connection.execute(
+            select(product_category.c.product_id)
+            .where(product_category.c.category_id.in_(changes['categories']))
+        ).scalars())
+    if changes['brands']:
+        product_ids.update(connection.execute(
+            select(Product.id).where(Product.brand_id.in_(changes['brands']))
+        ).scalars())
+    product_ids -= changes['deleted']
+
+    if changes['deleted']:
+        backend.delete_documents(connection, changes['deleted'])
+    if product_ids:
+        backend.index_products(connection, product_ids)
+
+
+# === CLI ===
+search_cli = AppGroup('search', help='Управление поисковым индексом')
+
+
+@search_cli.command('rebuild')
+def rebuild_command():
+    """Полностью перестроить поисковый индекс"""
+    started = time.perf_counter()
+    search_index.rebuild()
+    click.echo(f'Индекс ({search_index.backend.name}) перестроен за {time.perf_counter() - started:.2f} c')
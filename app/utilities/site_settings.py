@@ -0,0 +1,73 @@
+"""
+Снимок настроек сайта и SEO-шаблонов
+
+Все строки Setting и общие (без page_id) строки SeoMeta читаются одним
+снимком на воркер и отдаются из словарей; для SeoMeta конкретных страниц в
+снимке хранится только список (page_type, page_id), чтобы запрашивать
+строку лишь для страниц, у которых она действительно есть. Снимок
+пересобирается после изменения Setting/SeoMeta (версия 'settings').
+"""
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from sqlalchemy import select
+
+from app import db
+from app.models import SeoMeta, Setting
+from app.utilities.versions import get_version
+
+SeoEntry = namedtuple('SeoEntry', 'title description keywords robots og_title og_description og_image')
+
+SiteSettings = namedtuple('SiteSettings', 'version settings seo page_seo_keys')
+
+_SEO_COLUMNS = (SeoMeta.title, SeoMeta.description, SeoMeta.keywords, SeoMeta.robots,
+                SeoMeta.og_title, SeoMeta.og_description, SeoMeta.og_image)
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def build_site_settings(version=0):
+    """Собирает снимок из базы (по запросу на таблицу)"""
+    settings = dict(db.session.execute(select(Setting.key, Setting.value)).all())
+    seo = {}
+    for page_type, *values in db.session.execute(
+            select(SeoMeta.page_type, *_SEO_COLUMNS).where(SeoMeta.page_id.is_(None)).order_by(SeoMeta.id)
+    ).all():
+        # Как SeoMeta.get_for_page: при дублях берется первая запись
+        seo.setdefault(page_type, SeoEntry(*values))
+    page_seo_keys = frozenset(db.session.execute(
+        select(SeoMeta.page_type, SeoMeta.page_id).where(SeoMeta.page_id.isnot(None))
+    ).all())
+    return SiteSettings(version, MappingProxyType(settings), MappingProxyType(seo), page_seo_keys)
+
+
+def get_site_settings():
+    """Актуальный снимок настроек текущего воркера"""
+    global _snapshot
+    version = get_version('settings')
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = build_site_settings(version)
+            snapshot = _snapshot
+    return snapshot
+
+
+def get_setting(key, default=None):
+    """Значение настройки сайта без запроса к базе"""
+    return get_site_settings().settings.get(key, default)
+
+
+def get_seo_entry(page_type, page_id=None):
+    """SEO-шаблон страницы: свой для page_id, если он задан, иначе общий для типа страницы"""
+    snapshot = get_site_settings()
+    if page_id and (page_type, page_id) in snapshot.page_seo_keys:
+        row = db.session.execute(
+            select(*_SEO_COLUMNS).where(SeoMeta.page_type == page_type, SeoMeta.page_id == page_id).limit(1)
+        ).first()
+        if row is not None:
+            return SeoEntry(*row)
+    return snapshot.seo.get(page_type)
@@ -0,0 +1,307 @@
+"""
+Sitemap: индекс и шарды, сборка в файлы
+
+Карта сайта разбита на шарды (лимит протокола - 50 000 URL и 50 МБ на файл):
+    pages           - основные страницы и категории;
+    products-N      - товары с id в диапазоне [N*size + 1, (N+1)*size];
+    news-N          - новости по тому же принципу.
+size - SITEMAP_SHARD_SIZE. Деление по диапазону id, а не по номеру строки,
+оставляет каждый URL в своем шарде при удалении и добавлении соседей.
+
+Строки шардов выбираются только нужными колонками с yield_per и отдаются
+генератором, так что память не зависит от размера каталога.
+
+Карту можно отдавать на лету (маршруты sitemap_routes) или собрать в файлы
+командой flask sitemap build (cron) или кнопкой в админке (фоновый поток).
+Сборка инкрементальная: у шарда есть подпись - число строк и максимальный
+updated_at (для pages - версии данных), и шард перезаписывается, только
+если подпись изменилась с прошлой сборки. Файлы шардов сжимаются gzip,
+все файлы пишутся во временный файл и атомарно заменяют старый. Итог
+сборки (время, число URL, перестроенные шарды) хранится в manifest.json
+рядом с файлами. Пока в SITEMAP_FOLDER есть собранный индекс, /sitemap.xml
+отдает его.
+"""
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+
+from app import db
+from app.models import Category, News, Product
+from app.utilities.navigation import get_navigation
+from app.utilities.versions import get_versions, get_version_time
+
+# Разделы с шардами по диапазону id: модель, префикс URL, changefreq, priority
+SHARDED_SECTIONS = {
+    'products': (Product, '/product/', 'monthly', '0.6'),
+    'news': (News, '/news/', 'monthly', '0.5'),
+}
+
+# Основные страницы: путь, группы данных для lastmod, changefreq, priority
+MAIN_PAGES = (
+    ('/', ('catalog', 'news'), 'daily', '1.0'),
+    ('/catalog', ('catalog',), 'weekly', '0.9'),
+    ('/news', ('news',), 'daily', '0.8'),
+)
+
+# Сколько строк забирать из курсора за раз
+FETCH_SIZE = 1000
+
+# Сколько элементов шаблона собирать в один кусок при записи/отправке
+STREAM_BUFFER = 200
+
+# Группы данных (versions.py), от которых зависит шард pages
+PAGES_VERSIONS = ('catalog', 'navigation', 'news')
+
+INDEX_FILE = 'sitemap.xml'
+MANIFEST_FILE = 'manifest.json'
+
+
+class Shard(namedtuple('Shard', 'section number rows updated_at')):
+    """Шард карты; для pages number и rows - None, updated_at - время версий данных"""
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.section if self.number is None else f'{self.section}-{self.number}'
+
+    @property
+    def lastmod(self):
+        return _date(self.updated_at)
+
+    @property
+    def filename(self):
+        return f'sitemap-{self.name}.xml.gz'
+
+    def signature(self):
+        """Меняется при любом изменении содержимого шарда"""
+        if self.number is None:
+            return get_versions(*PAGES_VERSIONS)
+        return f'{self.rows}:{self.updated_at}'
+
+
+def _date(value):
+    return (value or datetime.utcnow()).strftime('%Y-%m-%d')
+
+
+def shard_size():
+    return current_app.config.get('SITEMAP_SHARD_SIZE', 10000)
+
+
+def _shard_number(model):
+    return (model.id - 1) // shard_size()
+
+
+def list_shards():
+    """Шарды карты с числом строк и временем последнего изменения (один GROUP BY на раздел)"""
+    shards = [Shard('pages', None, None, get_version_time(*PAGES_VERSIONS))]
+    for section, (model, *_) in SHARDED_SECTIONS.items():
+        number = _shard_number(model).label('shard')
+        rows = db.session.execute(
+            select(number, func.count(), func.max(model.updated_at)).group_by(number).order_by(number)
+        ).all()
+        shards.extend(Shard(section, *row) for row in rows)
+    return shards
+
+
+def _id_range(number):
+    size = shard_size()
+    return number * size + 1, (number + 1) * size
+
+
+def shard_exists(section, number):
+    model = SHARDED_SECTIONS[section][0]
+    return db.session.execute(
+        select(model.id).where(model.id.between(*_id_range(number))).limit(1)
+    ).first() is not None
+
+
+def main_pages():
+    """Основные страницы и категории (категорий немного - полные пути берутся из снимка навигации)"""
+    for path, groups, changefreq, priority in MAIN_PAGES:
+        yield {'loc': path, 'lastmod': _date(get_version_time(*groups)),
+               'changefreq': changefreq, 'priority': priority}
+
+    by_id = get_navigation().by_id
+    rows = db.session.execute(select(Category.id, Category.updated_at).order_by(Category.id))
+    for category_id, updated_at in rows:
+        node = by_id.get(category_id)
+        if node is not None:
+            yield {'loc': f'/catalog/{node.full_slug}', 'lastmod': _date(updated_at),
+                   'changefreq': 'weekly', 'priority': '0.7'}
+
+
+def shard_pages(section, number):
+    """Страницы шарда раздела; строки читаются из курсора пачками по FETCH_SIZE"""
+    model, prefix, changefreq, priority = SHARDED_SECTIONS[section]
+    rows = db.session.execute(
+        select(model.slug, model.updated_at)
+        .where(model.id.between(*_id_range(number)))
+        .order_by(model.id)
+        .execution_options(yield_per=FETCH_SIZE)
+    )
+    for slug, updated_at in rows:
+        yield {'loc': prefix + slug, 'lastmod': _date(updated_at), 'changefreq': changefreq, 'priority': priority}
+
+
+def pages_of(shard):
+    return main_pages() if shard.number is None else shard_pages(shard.section, shard.number)
+
+
+def render_stream(template_name, **context):
+    """Поток кусков шаблона карты (без контекст-процессоров: шаблонам карты нужен только переданный контекст)"""
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return stream
+
+
+# === Сборка в файлы ===
+def sitemap_folder():
+    return current_app.config['SITEMAP_FOLDER']
+
+
+def read_manifest(folder=None):
+    """Итог последней сборки или None"""
+    path = os.path.join(folder or sitemap_folder(), MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_atomic(path, chunks, compress=False):
+    """Пишет куски текста во временный файл рядом с path и подменяет path одной операцией"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            # mtime=0 - одинаковое содержимое дает одинаковый файл (и ETag у веб-сервера)
+            output = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) if compress else raw
+            with output:
+                for chunk in chunks:
+                    output.write(chunk.encode('utf-8'))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def _counted(pages, counter):
+    for page in pages:
+        counter['urls'] += 1
+        yield page
+
+
+def build_sitemaps(base_url, force=False):
+    """
+    Собирает карту в SITEMAP_FOLDER, перезаписывая только измененные шарды
+
+    base_url - адрес сайта без завершающего слэша (https://example.com);
+    force - перестроить все шарды. Возвращает манифест сборки.
+    """
+    started = time.perf_counter()
+    folder = sitemap_folder()
+    os.makedirs(folder, exist_ok=True)
+    previous = read_manifest(folder)
+    known = {}
+    if (previous and not force and previous.get('base_url') == base_url
+            and previous.get('shard_size') == shard_size()):
+        known = {entry['name']: entry for entry in previous['shards']}
+
+    entries = []
+    for shard in list_shards():
+        signature = shard.signature()
+        old = known.get(shard.name)
+        if old and old['signature'] == signature and os.path.exists(os.path.join(folder, shard.filename)):
+            entries.append(dict(old, rebuilt=False))
+            continue
+        counter = {'urls': 0}
+        shard_started = time.perf_counter()
+        _write_atomic(os.path.join(folder, shard.filename),
+                      render_stream('sitemap.xml', pages=_counted(pages_of(shard), counter), base_url=base_url),
+                      compress=True)
+        entries.append({
+            'name': shard.name,
+            'file': shard.filename,
+            'signature': signature,
+            'lastmod': shard.lastmod,
+            'urls': counter['urls'],
+            'duration_ms': round((time.perf_counter() - shard_started) * 1000, 1),
+            'rebuilt': True,
+        })
+
+    # Шарды, которых больше нет (удалены все строки диапазона)
+    files = {entry['file'] for entry in entries}
+    for filename in os.listdir(folder):
+        if filename.startswith('sitemap-') and filename.endswith('.xml.gz') and filename not in files:
+            os.remove(os.path.join(folder, filename))
+
+    sitemaps = [{'loc': '/' + entry['file'], 'lastmod': entry['lastmod']} for entry in entries]
+    _write_atomic(os.path.join(folder, INDEX_FILE),
+                  render_stream('sitemap_index.xml', sitemaps=sitemaps, base_url=base_url))
+
+    manifest = {
+        'built_at': datetime.now().isoformat(timespec='seconds'),
+        'base_url': base_url,
+        'shard_size': shard_size(),
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+        'urls': sum(entry['urls'] for entry in entries),
+        'rebuilt': sum(entry['rebuilt'] for entry in entries),
+        'shards': entries,
+    }
+    _write_atomic(os.path.join(folder, MANIFEST_FILE), [json.dumps(manifest, ensure_ascii=False, indent=1)])
+    return manifest
+
+
+_build_lock = threading.Lock()
+
+
+def build_in_background(app, base_url, force=False):
+    """Запускает сборку в фоновом потоке; False - сборка в этом воркере уже идет"""
+    if not _build_lock.acquire(blocking=False):
+        return False
+
+    def target():
+        try:
+            with app.app_context():
+                manifest = build_sitemaps(base_url, force)
+                app.logger.info(f'Sitemap собран за {manifest["duration_ms"]} мс: {manifest["urls"]} URL, '
+                                f'перестроено шардов {manifest["rebuilt"]} из {len(manifest["shards"])}')
+        except Exception as e:
+            app.logger.warning(f'Ошибка при сборке sitemap: {e}')
+        finally:
+            _build_lock.release()
+
+    threading.Thread(target=target, name='sitemap-build', daemon=True).start()
+    return True
+
+
+# === CLI ===
+sitemap_cli = AppGroup('sitemap', help='Сборка sitemap в файлы')
+
+
+@sitemap_cli.command('build')
+@click.option('--base-url', help='Адрес сайта (по умолчанию SITEMAP_BASE_URL)')
+@click.option('--force', is_flag=True, help='Перестроить все шарды')
+def build_command(base_url, force):
+    """Собрать sitemap (только изменившиеся шарды)"""
+    base_url = base_url or current_app.config.get('SITEMAP_BASE_URL')
+    if not base_url:
+        raise click.UsageError('Укажите --base-url или SITEMAP_BASE_URL')
+    manifest = build_sitemaps(base_url.rstrip('/'), force)
+    click.echo(f'Собрано за {manifest["duration_ms"] / 1000:.2f} c: {manifest["urls"]} URL, '
+               f'перестроено шардов {manifest["rebuilt"]} из {len(manifest["shards"])}')
+
+
+def init_app(app):
+    app.cli.add_command(sitemap_cli)
@@ -1,17 +1,28 @@
-from app.models import Setting, SeoMeta
+import os
+
+from flask import current_app, g
+from flask_login import current_user
+from sqlalchemy import func
+
+from app import db
+from app.models import CartItem, News, Product, load_options
+from app.utilities.site_settings import get_setting, get_seo_entry
+from app.utilities.pagination import page_url
+from app.utilities.facets import filter_url
+from app.utilities.images import picture, image_srcset
+from app.utilities.image_cache import image_url_for
 
 
 def get_site_setting(key, default=None):
-    """Получение настройки сайта для шаблонов"""
-    setting = Setting.query.filter_by(key=key).first()
-    return setting.value if setting else default
+    """Получение настройки сайта для шаблонов (из снимка настроек, без запроса)"""
+    return get_setting(key, default)
 
 
 def get_seo_meta(page_type, page_id=None, **context):
     """
     Получение SEO мета-тегов для страницы
     """
-    seo = SeoMeta.get_for_page(page_type, page_id)
+    seo = get_seo_entry(page_type, page_id)
 
     if not seo:
         # Возвращаем дефолтные значения
@@ -81,6 +92,46 @@ def get_search_page_seo(query, count):
     return get_seo_meta('search', query=query, count=count)
 
 
+_templates_stamp = None
+
+
+def templates_version():
+    """Отпечаток шаблонов (время последнего изменения): после деплоя с новыми шаблонами меняются ETag и ключи фрагментов"""
+    global _templates_stamp
+    if _templates_stamp is None:
+        folder = os.path.join(current_app.root_path, current_app.template_folder)
+        latest = 0.0
+        for root, _, files in os.walk(folder):
+            for name in files:
+                latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+        _templates_stamp = str(int(latest))
+    return _templates_stamp
+
+
+def latest_news(limit=3, exclude_id=None):
+    """Последние новости для сайдбаров; запрос выполняется только при рендеринге (не из кэша фрагментов)"""
+    query = News.query.options(*load_options('news_card')).order_by(News.created_at.desc())
+    if exclude_id is not None:
+        query = query.filter(News.id != exclude_id)
+    return query.limit(limit).all()
+
+
+def latest_products(limit=3):
+    """Последние добавленные товары для сайдбаров"""
+    return Product.query.options(*load_options('product_card')).order_by(Product.created_at.desc()).limit(limit).all()
+
+
+def cart_quantity():
+    """Число товаров в корзине текущего пользователя (один SUM на запрос вместо загрузки позиций)"""
+    if not current_user.is_authenticated:
+        return 0
+    if 'cart_quantity' not in g:
+        g.cart_quantity = db.session.execute(
+            db.select(func.coalesce(func.sum(CartItem.quantity), 0)).where(CartItem.user_id == current_user.id)
+        ).scalar()
+    return g.cart_quantity
+
+
 # Экспортируем функции для контекста Jinja2
 template_functions = {
     'get_site_setting': get_site_setting,
@@ -89,5 +140,13 @@ template_functions = {
     'get_catalog_page_seo': get_catalog_page_seo,
     'get_product_page_seo': get_product_page_seo,
     'get_news_page_seo': get_news_page_seo,
-    'get_search_page_seo': get_search_page_seo
+    'get_search_page_seo': get_search_page_seo,
+    'page_url': page_url,
+    'filter_url': filter_url,
+    'cart_quantity': cart_quantity,
+    'latest_news': latest_news,
+    'latest_products': latest_products,
+    'picture': picture,
+    'image_srcset': image_srcset,
+    'image_url_for': image_url_for
 }
\ No newline at end of file
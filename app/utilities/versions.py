@@ -0,0 +1,121 @@
+"""
+Версии данных для инвалидации кэшей
+
+Каждая запись в таблице cache_version - счетчик, который увеличивается в той
+же транзакции, что и изменение соответствующих моделей. Кэши включают версию
+в ключ, поэтому после записи в админке старые значения просто перестают
+использоваться во всех воркерах.
+
+Вместе со счетчиком хранится время последнего увеличения - из него
+получается Last-Modified страниц, собранных из нескольких таблиц.
+
+Чтобы не читать счетчики на каждый запрос, воркер перечитывает их не чаще
+раза в VERSION_CHECK_INTERVAL секунд; собственные изменения воркер видит сразу.
+"""
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, select, update
+
+from app import db
+from app.models import CacheVersion, Product, ProductNumber, Category, Brand, Country, News, User, \
+    Setting, SeoMeta
+
+# Какие версии увеличивает запись в модель
+VERSIONED_MODELS = {
+    Product: ('catalog',),
+    ProductNumber: ('catalog',),
+    Category: ('catalog', 'navigation'),
+    Brand: ('catalog', 'navigation'),
+    Country: ('catalog', 'navigation'),
+    News: ('news',),
+    User: ('users',),
+    Setting: ('settings',),
+    SeoMeta: ('settings',),
+}
+
+_lock = threading.Lock()
+_versions = {}
+_updated = {}
+_checked_at = 0.0
+_table_ready = False
+
+
+def _ensure_table(connection):
+    global _table_ready
+    if not _table_ready:
+        CacheVersion.__table__.create(connection, checkfirst=True)
+        _table_ready = True
+
+
+def _reload_versions():
+    global _versions, _updated, _checked_at
+    connection = db.session.connection()
+    _ensure_table(connection)
+    rows = connection.execute(select(CacheVersion.name, CacheVersion.value, CacheVersion.updated_at)).all()
+    with _lock:
+        _versions = {name: value for name, value, _ in rows}
+        _updated = {name: updated_at for name, _, updated_at in rows if updated_at is not None}
+        _checked_at = time.monotonic()
+
+
+def get_version(name):
+    """Текущая версия данных (0, если данные ни разу не менялись)"""
+    interval = current_app.config.get('VERSION_CHECK_INTERVAL', 1)
+    if time.monotonic() - _checked_at >= interval:
+        _reload_versions()
+    return _versions.get(name, 0)
+
+
+def get_version_time(*names):
+    """Время последнего изменения любой из групп данных (None, если не менялись)"""
+    get_version(names[0])
+    times = [_updated[name] for name in names if name in _updated]
+    return max(times) if times else None
+
+
+def get_versions(*names):
+    """Строка из нескольких версий для ключей кэша: 'catalog=3,settings=7'"""
+    return ','.join(f'{name}={get_version(name)}' for name in names)
+
+
+def bump_versions(connection, names):
+    """Увеличивает версии в текущей транзакции"""
+    _ensure_table(connection)
+    for name in names:
+        result = connection.execute(
+            update(CacheVersion).where(CacheVersion.name == name)
+            .values(value=CacheVersion.value + 1, updated_at=func.current_timestamp())
+        )
+        if not result.rowcount:
+            connection.execute(CacheVersion.__table__.insert().values(name=name, value=1,
+                                                                      updated_at=func.current_timestamp()))
+
+
+def invalidate_local():
+    """Заставляет воркер перечитать версии при следующем обращении"""
+    global _checked_at
+    _checked_at = 0.0
+
+
+# === Увеличение версий при изменении моделей ===
+@event.listens_for(db.session, 'after_flush')
+def _bump_changed_versions(session, flush_context):
+    names = set()
+    for obj in session.new | session.dirty | session.deleted:
+        names.update(VERSIONED_MODELS.get(type(obj), ()))
+    if names and has_app_context():
+        bump_versions(session.connection(), sorted(names))
+        session.info['versions_bumped'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _refresh_after_commit(session):
+    if session.info.pop('versions_bumped', False):
+        invalidate_local()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('versions_bumped', None)
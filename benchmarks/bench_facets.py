@@ -0,0 +1,134 @@
+"""
+Бенчмарк фасетов каталога при росте числа брендов
+
+Запуск из корня проекта:
+    python benchmarks/bench_facets.py [--products 50000] [--brands 10,100,1000,5000]
+
+Для каждого числа брендов в отдельном процессе создает временную базу SQLite
+с одинаковым числом товаров и замеряет расчет матрицы фасетов одним GROUP BY, получение фасетов для
+страницы при матрице в кэше и, для сравнения, наивный COUNT на каждый бренд.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+COUNTRIES = 20
+CATEGORIES = 30
+
+
+def populate(db, text, products, brands):
+    rng = random.Random(7)
+    db.session.execute(text('INSERT INTO country (id, name) VALUES (:id, :name)'),
+                       [{'id': i, 'name': f'Страна {i}'} for i in range(1, COUNTRIES + 1)])
+    db.session.execute(text('INSERT INTO brand (id, name, slug) VALUES (:id, :name, :slug)'),
+                       [{'id': i, 'name': f'Бренд {i}', 'slug': f'brand-{i}'} for i in range(1, brands + 1)])
+    db.session.execute(text('INSERT INTO category (id, name, slug, parent_id) VALUES (:id, :name, :slug, :parent_id)'),
+                       [{'id': i, 'name': f'Категория {i}', 'slug': f'c{i}', 'parent_id': None if i <= 5 else rng.randint(1, 5)}
+                        for i in range(1, CATEGORIES + 1)])
+    # У бренда одна страна, как в реальном каталоге
+    brand_country = {i: rng.randint(1, COUNTRIES) for i in range(1, brands + 1)}
+    rows, links = [], []
+    for i in range(1, products + 1):
+        brand_id = rng.randint(1, brands)
+        rows.append({'id': i, 'name': f'Товар {i}', 'slug': f'p{i}', 'article': f'A{i}',
+                     'price': round(rng.lognormvariate(7.5, 1.0), 2), 'brand_id': brand_id,
+                     'country_id': brand_country[brand_id]})
+        links.append({'product_id': i, 'category_id': rng.randint(6, CATEGORIES)})
+    db.session.execute(
+        text('INSERT INTO product (id, name, slug, article, price, stock, brand_id, country_id) '
+             'VALUES (:id, :name, :slug, :article, :price, 1, :brand_id, :country_id)'), rows)
+    db.session.execute(
+        text('INSERT INTO product_category (product_id, category_id) VALUES (:product_id, :category_id)'), links)
+    db.session.commit()
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def run(products, brands, repeat):
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    os.environ['AUTOCOMPLETE_PRELOAD'] = '0'
+
+    from sqlalchemy import func, text
+    from app import create_app, db
+    from app.models import Product
+    from app.utilities.category_tree import products_in_subtree, rebuild_closure
+    from app.utilities.facets import CatalogFilters, catalog_facets, facet_matrix
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        populate(db, text, products, brands)
+        rebuild_closure(db.session.connection())
+        db.session.commit()
+
+        results = []
+        for label, filters in [
+            ('весь каталог', CatalogFilters(None, None, None, frozenset(), frozenset())),
+            ('категория + цена', CatalogFilters(1, 1000.0, 5000.0, frozenset(), frozenset())),
+            ('+ 3 бренда', CatalogFilters(1, 1000.0, 5000.0, frozenset({1, 2, 3}), frozenset())),
+        ]:
+            matrix_ms = measure(lambda: facet_matrix(filters), repeat)
+            rows = len(facet_matrix(filters))
+            # Счетчики фасетов для запроса страницы (матрица уже в кэше)
+            catalog_facets(filters)
+            sum_ms = measure(lambda: catalog_facets(filters), repeat)
+
+            def naive():
+                for brand_id in range(1, brands + 1):
+                    query = Product.query.filter(Product.brand_id == brand_id,
+                                                 Product.price.between(filters.price_from or 0, filters.price_to or 1e12))
+                    if filters.category_id:
+                        query = query.filter(Product.id.in_(products_in_subtree(filters.category_id)))
+                    query.with_entities(func.count()).scalar()
+
+            naive_ms = measure(naive, 1) if brands <= 1000 else None
+            results.append((label, rows, matrix_ms, sum_ms, naive_ms))
+        db.session.remove()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--products', type=int, default=50000)
+    parser.add_argument('--brands', default='10,100,1000,5000')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Один замер в чистом процессе: настройки приложения читаются при импорте
+        print(json.dumps(run(args.products, int(args.brands), args.repeat)))
+        return
+
+    print(f'{"брендов":>8} {"фильтр":<18} {"строк матрицы":>14} {"GROUP BY, мс":>13} '
+          f'{"из кэша, мс":>13} {"COUNT на бренд, мс":>19}')
+    for brands in args.brands.split(','):
+        output = subprocess.run(
+            [sys.executable, __file__, '--single', '--products', str(args.products),
+             '--brands', brands, '--repeat', str(args.repeat)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        for label, rows, matrix_ms, sum_ms, naive_ms in json.loads(output.strip().splitlines()[-1]):
+            naive = f'{naive_ms:.1f}' if naive_ms is not None else '-'
+            print(f'{brands:>8} {label:<18} {rows:>14} {matrix_ms:>13.1f} {sum_ms:>13.2f} {naive:>19}')
+
+
+if __name__ == '__main__':
+    main()
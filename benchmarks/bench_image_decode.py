@@ -0,0 +1,118 @@
+"""
+Бенчмарк декодирования загрузок: пиковая память и время на размер исходника
+
+Запуск из корня проекта:
+    python benchmarks/bench_image_decode.py [--sizes 2000x1500,4000x3000,8000x6000] [--kind products]
+
+Для каждого размера создает JPEG (и PNG того же размера, если задан --png) и
+в отдельном процессе строит набор производных пресетов типа загрузки двумя
+способами: прежним (полное декодирование, копия исходника на каждую
+производную) и make_derivatives (draft/reduce, одно декодирование на все
+производные). Пиковая память - прирост VmHWM процесса после импортов
+(/proc/self/status, только Linux; ru_maxrss не годится - он наследуется от
+родителя, который создавал большие исходники).
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+METHODS = ('прежний', 'draft')
+
+
+def peak_memory():
+    """Пик резидентной памяти процесса, МБ"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+
+
+def create_source(directory, width, height, image_format):
+    """Исходник с плавным градиентом и шумом - сжимается как фотография, а не как заливка"""
+    from PIL import Image
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width // 4, height // 4), 40).resize((width, height))
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    path = os.path.join(directory, f'source_{width}x{height}.{image_format}')
+    image.save(path, **({'quality': 92} if image_format == 'jpg' else {}))
+    return path
+
+
+def naive(source_path, target_path, presets, quality):
+    """Прежний путь: полный исходник в памяти, thumbnail() копии на каждую производную"""
+    from PIL import Image
+    from app.utilities.images import MODERN_FORMATS, _format_of, _save_atomic
+    directory = os.path.dirname(target_path)
+    stem, ext = os.path.splitext(os.path.basename(target_path))
+    with Image.open(source_path) as original:
+        original.load()
+        for preset in presets:
+            for width in preset.widths:
+                image = original.copy()
+                image.thumbnail((width, round(preset.size[1] * width / preset.size[0])), Image.Resampling.LANCZOS)
+                for image_format in MODERN_FORMATS + (_format_of(target_path),):
+                    _save_atomic(image, os.path.join(directory, f'{stem}{preset.suffix}_{width}w.{image_format}'),
+                                 image_format, quality)
+
+
+def run(source_path, kind, method):
+    from app.utilities.images import DEFAULT_QUALITY, IMAGE_PRESETS, IMAGE_QUALITY, make_derivatives
+
+    directory = tempfile.mkdtemp()
+    target_path = os.path.join(directory, 'target.jpg')
+    presets, quality = IMAGE_PRESETS[kind], IMAGE_QUALITY.get(kind, DEFAULT_QUALITY)
+    baseline = peak_memory()
+    started = time.perf_counter()
+    try:
+        if method == 'draft':
+            make_derivatives(source_path, target_path, presets, quality, 10 ** 9)
+        else:
+            naive(source_path, target_path, presets, quality)
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        shutil.rmtree(directory)
+    return peak_memory() - baseline, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='2000x1500,4000x3000,8000x6000')
+    parser.add_argument('--kind', default='products')
+    parser.add_argument('--png', action='store_true', help='Также замерить PNG тех же размеров')
+    parser.add_argument('--single', nargs=2, metavar=('SOURCE', 'METHOD'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Один замер в чистом процессе: VmHWM - пик за всю жизнь процесса
+        print(json.dumps(run(args.single[0], args.kind, args.single[1])))
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        print(f'{"исходник":<16} {"файл, МБ":>9} {"способ":<8} {"пик памяти, МБ":>15} {"время, мс":>10}')
+        for size in args.sizes.split(','):
+            width, height = map(int, size.split('x'))
+            for image_format in ('jpg', 'png') if args.png else ('jpg',):
+                source_path = create_source(directory, width, height, image_format)
+                megabytes = os.path.getsize(source_path) / 1024 / 1024
+                for method in METHODS:
+                    output = subprocess.run(
+                        [sys.executable, __file__, '--kind', args.kind, '--single', source_path, method],
+                        check=True, capture_output=True, text=True
+                    ).stdout
+                    peak, elapsed = json.loads(output.strip().splitlines()[-1])
+                    print(f'{size + " " + image_format:<16} {megabytes:>9.1f} {method:<8} {peak:>15.0f} {elapsed:>10.0f}')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Бенчмарк индексов миграции 0001_hot_path_indexes
+
+Запуск из корня проекта:
+    python benchmarks/bench_indexes.py [--products 500000] [--repeat 5]
+
+Создает временную базу SQLite со схемой до миграции (индексы миграции
+удаляются после create_all), наполняет ее синтетическим каталогом и для
+запросов горячих маршрутов снимает EXPLAIN QUERY PLAN и время выполнения -
+до и после применения миграции.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BRANDS = 500
+COUNTRIES = 30
+ROOT_CATEGORIES = 10
+CATEGORIES = 200
+NEWS = 20000
+USERS = 5000
+SEO_PAGES = 20000
+
+# Запросы маршрутов в том виде, в каком их строит ORM (значения подставлены)
+QUERIES = [
+    ('главная: новинки', 'SELECT id, name FROM product ORDER BY created_at DESC, id DESC LIMIT 6'),
+    ('каталог: ?sort=price_asc', 'SELECT id, name FROM product ORDER BY price, id LIMIT 9'),
+    ('каталог: диапазон цены', 'SELECT count(*) FROM product WHERE price >= 1000 AND price <= 1100'),
+    ('каталог: 3 бренда', 'SELECT count(*) FROM product WHERE brand_id IN (1, 2, 3)'),
+    ('каталог: страна', 'SELECT count(*) FROM product WHERE country_id = 7'),
+    ('каталог: категория',
+     'SELECT count(*) FROM product WHERE id IN (SELECT product_id FROM product_category '
+     'WHERE category_id IN (SELECT descendant_id FROM category_closure WHERE ancestor_id = 1))'),
+    ('фасеты: матрица',
+     'SELECT brand_id, country_id, CASE WHEN price < 500 THEN 0 WHEN price < 1000 THEN 1 WHEN price < 5000 THEN 2 '
+     'ELSE 3 END AS bucket, CASE WHEN price >= 1000 AND price <= 5000 THEN 1 ELSE 0 END AS in_price, count(*) '
+     'FROM product GROUP BY brand_id, country_id, bucket, in_price'),
+    ('корзина: число товаров', 'SELECT coalesce(sum(quantity), 0) FROM cart_item WHERE user_id = 42'),
+    ('корзина: позиция товара', 'SELECT id FROM cart_item WHERE user_id = 42 AND product_id = 4242'),
+    ('новости: лента', 'SELECT id, title FROM news ORDER BY created_at DESC, id DESC LIMIT 5'),
+    ('категории: подкатегории', 'SELECT id, name FROM category WHERE parent_id = 1'),
+    ('SEO: страница товара', "SELECT title FROM seo_meta WHERE page_type = 'product' AND page_id = 4242"),
+]
+
+
+def populate(db, text, products):
+    rng = random.Random(500)
+    execute = db.session.execute
+    execute(text('INSERT INTO country (id, name) VALUES (:id, :name)'),
+            [{'id': i, 'name': f'Страна {i}'} for i in range(1, COUNTRIES + 1)])
+    execute(text('INSERT INTO brand (id, name, slug) VALUES (:id, :name, :slug)'),
+            [{'id': i, 'name': f'Бренд {i}', 'slug': f'brand-{i}'} for i in range(1, BRANDS + 1)])
+    execute(text('INSERT INTO category (id, name, slug, parent_id) VALUES (:id, :name, :slug, :parent_id)'),
+            [{'id': i, 'name': f'Категория {i}', 'slug': f'c{i}',
+              'parent_id': None if i <= ROOT_CATEGORIES else rng.randint(1, ROOT_CATEGORIES)}
+             for i in range(1, CATEGORIES + 1)])
+
+    chunk = 50000
+    for start in range(1, products + 1, chunk):
+        ids = range(start, min(start + chunk, products + 1))
+        execute(text('INSERT INTO product (id, name, slug, article, price, stock, brand_id, country_id, created_at) '
+                     'VALUES (:id, :name, :slug, :article, :price, 1, :brand_id, :country_id, :created_at)'),
+                [{'id': i, 'name': f'Товар {i}', 'slug': f'p{i}', 'article': f'A{i}',
+                  'price': round(rng.lognormvariate(7.5, 1.0), 2), 'brand_id': rng.randint(1, BRANDS),
+                  'country_id': rng.randint(1, COUNTRIES),
+                  'created_at': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 12:00:00'} for i in ids])
+        execute(text('INSERT INTO product_category (product_id, category_id) VALUES (:product_id, :category_id)'),
+                [{'product_id': i, 'category_id': rng.randint(ROOT_CATEGORIES + 1, CATEGORIES)} for i in ids])
+
+    execute(text('INSERT INTO news (id, title, slug, content, created_at) '
+                 'VALUES (:id, :title, :slug, :content, :created_at)'),
+            [{'id': i, 'title': f'Новость {i}', 'slug': f'n{i}', 'content': 'Текст',
+              'created_at': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 12:00:00'}
+             for i in range(1, NEWS + 1)])
+    execute(text('INSERT INTO cart_item (user_id, product_id, quantity) VALUES (:user_id, :product_id, :quantity)'),
+            [{'user_id': rng.randint(1, USERS), 'product_id': rng.randint(1, products), 'quantity': rng.randint(1, 3)}
+             for _ in range(USERS * 10)])
+    execute(text("INSERT INTO seo_meta (page_type, page_id, title) VALUES ('product', :page_id, :title)"),
+            [{'page_id': i, 'title': f'SEO {i}'} for i in rng.sample(range(1, products + 1), SEO_PAGES)])
+    db.session.commit()
+
+
+def measure(connection, text, sql, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        connection.execute(text(sql)).all()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def snapshot(connection, text, repeat):
+    """{запрос: (план, медиана мс)}"""
+    connection.execute(text('ANALYZE'))
+    result = {}
+    for label, sql in QUERIES:
+        plan = '; '.join(row[-1] for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql)))
+        result[label] = (plan, measure(connection, text, sql, repeat))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--products', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    os.environ['AUTOCOMPLETE_PRELOAD'] = '0'
+
+    from sqlalchemy import text
+    from app import create_app, db
+    from app.utilities.category_tree import rebuild_closure
+    from app.utilities.migrations import MIGRATIONS, upgrade
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        # Схема до миграции: create_all уже создал индексы по моделям - убираем их
+        with db.engine.begin() as connection:
+            for name in [row[0] for row in connection.execute(text(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%' "
+                    "AND tbl_name IN ('product', 'news', 'cart_item', 'category', 'seo_meta', 'product_category')"))]:
+                connection.execute(text(f'DROP INDEX {name}'))
+
+        started = time.perf_counter()
+        populate(db, text, args.products)
+        rebuild_closure(db.session.connection())
+        db.session.commit()
+        print(f'Данные: {args.products} товаров за {time.perf_counter() - started:.1f} с')
+
+        with db.engine.connect() as connection:
+            before = snapshot(connection, text, args.repeat)
+
+        started = time.perf_counter()
+        applied = upgrade()
+        print(f'Миграции {", ".join(name for name, _ in applied)}: {time.perf_counter() - started:.1f} с '
+              f'(всего объявлено {len(MIGRATIONS)})')
+
+        with db.engine.connect() as connection:
+            after = snapshot(connection, text, args.repeat)
+
+        print(f'{"запрос":<30} {"до, мс":>9} {"после, мс":>10}')
+        for label, _ in QUERIES:
+            print(f'{label:<30} {before[label][1]:>9.2f} {after[label][1]:>10.2f}')
+            print(f'    до:    {before[label][0]}')
+            print(f'    после: {after[label][0]}')
+
+
+if __name__ == '__main__':
+    main()
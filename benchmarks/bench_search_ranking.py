@@ -0,0 +1,118 @@
+"""
+Бенчмарк ранжирования поиска на синтетическом каталоге
+
+Запуск из корня проекта:
+    python benchmarks/bench_search_ranking.py [--products 100000] [--repeat 20]
+
+Создает временную базу SQLite, наполняет ее товарами, строит поисковый индекс
+и замеряет время первой и дальних страниц выдачи. Заодно проверяет, что порядок
+детерминирован (повторные запросы дают одинаковый результат) и что точное
+совпадение артикула стоит первым.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ['фильтр', 'масляный', 'воздушный', 'салонный', 'масло', 'моторное', 'колодки', 'тормозные',
+         'свеча', 'зажигания', 'амортизатор', 'ремень', 'грм', 'передний', 'задний', 'комплект',
+         'диск', 'насос', 'помпа', 'датчик', 'лампа', 'щетка', 'стеклоочистителя', 'подшипник']
+BRANDS = ['Bosch', 'Mann', 'Castrol', 'Mobil', 'Shell', 'Motul', 'Continental', 'Michelin']
+CATEGORIES = ['Фильтры', 'Масла', 'Тормозная система', 'Подвеска', 'Электрика', 'Двигатель']
+
+QUERIES = ['фильтр', 'масляный фильтр', 'bosch', 'колодки тормозные передние', '5w фильтр', 'af-012345']
+
+
+def populate(db, text, count):
+    rng = random.Random(42)
+    db.session.execute(text('INSERT INTO country (id, name) VALUES (1, :name)'), {'name': 'Германия'})
+    db.session.execute(
+        text('INSERT INTO brand (id, name, slug) VALUES (:id, :name, :slug)'),
+        [{'id': i, 'name': name, 'slug': name.lower()} for i, name in enumerate(BRANDS, 1)]
+    )
+    db.session.execute(
+        text('INSERT INTO category (id, name, slug) VALUES (:id, :name, :slug)'),
+        [{'id': i, 'name': name, 'slug': f'c{i}'} for i, name in enumerate(CATEGORIES, 1)]
+    )
+    rows = []
+    links = []
+    for i in range(1, count + 1):
+        rows.append({
+            'id': i,
+            'name': ' '.join(rng.sample(WORDS, 3)).capitalize() + f' {i}',
+            'slug': f'product-{i}',
+            'article': f'AF-{i:06d}',
+            'short_desc': ' '.join(rng.sample(WORDS, 6)),
+            'full_desc': ' '.join(rng.choice(WORDS) for _ in range(40)),
+            'price': rng.randint(100, 20000),
+            'brand_id': rng.randint(1, len(BRANDS)),
+        })
+        links.append({'product_id': i, 'category_id': rng.randint(1, len(CATEGORIES))})
+    db.session.execute(
+        text('INSERT INTO product (id, name, slug, article, short_desc, full_desc, price, stock, brand_id, '
+             'country_id) VALUES (:id, :name, :slug, :article, :short_desc, :full_desc, :price, 1, :brand_id, 1)'),
+        rows
+    )
+    db.session.execute(
+        text('INSERT INTO product_category (product_id, category_id) VALUES (:product_id, :category_id)'), links
+    )
+    db.session.commit()
+
+
+def measure(function, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return result, timings[len(timings) // 2], timings[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    os.environ['AUTOCOMPLETE_PRELOAD'] = '0'
+
+    from sqlalchemy import text
+    from app import create_app, db
+    from app.utilities.search import search_index
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        populate(db, text, args.products)
+        print(f'Каталог: {args.products} товаров за {time.perf_counter() - started:.1f} с')
+
+        started = time.perf_counter()
+        search_index.rebuild()
+        print(f'Индекс ({search_index.backend.name}): {time.perf_counter() - started:.1f} с')
+
+        print(f'{"запрос":<30} {"найдено":>8} {"стр.1 мед/макс, мс":>20} {"стр.50 мед/макс, мс":>21}')
+        for query in QUERIES:
+            (first_page, total), median, worst = measure(lambda: search_index.search(query, 12, 0), args.repeat)
+            _, far_median, far_worst = measure(lambda: search_index.search(query, 12, 12 * 49), args.repeat)
+            print(f'{query:<30} {total:>8} {median:>9.1f} / {worst:<8.1f} {far_median:>9.1f} / {far_worst:<8.1f}')
+
+            # Детерминированность: повторный запрос дает тот же порядок
+            assert search_index.search(query, 12, 0)[0] == first_page, f'Порядок выдачи изменился: {query}'
+
+        exact_ids, _ = search_index.search('AF-012345', 12, 0)
+        assert exact_ids and exact_ids[0] == 12345, 'Точное совпадение артикула не на первом месте'
+        print('Порядок детерминирован, точный артикул - первый')
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,76 @@ class Config:
         'news': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'static', 'uploads', 'news')
     }
 
+    # Бэкенд поиска: sqlite (FTS5), postgresql (tsvector) или like; по умолчанию - по URI базы
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+
+    # Индекс автоподсказок: построение при старте и период перестройки (секунды)
+    AUTOCOMPLETE_PRELOAD = os.environ.get('AUTOCOMPLETE_PRELOAD', '1') == '1'
+    AUTOCOMPLETE_REFRESH_SECONDS = int(os.environ.get('AUTOCOMPLETE_REFRESH_SECONDS', 300))
+
+    # Кэш результатов поиска: memory://, sqlite:////path/cache.db или redis://host:6379/0
+    SEARCH_CACHE_URL = os.environ.get('SEARCH_CACHE_URL', 'memory://')
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1000))
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 300))
+
+    # Кэш готовых страниц для анонимных посетителей: URL как у SEARCH_CACHE_URL, не задан - выключен
+    PAGE_CACHE_URL = os.environ.get('PAGE_CACHE_URL')
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 2000))
+    # Время жизни страницы по endpoint (секунды); кэшируются только перечисленные
+    PAGE_CACHE_TTLS = {
+        'main.index': 120,
+        'main.catalog': 300,
+        'main.catalog_by_slug': 300,
+        'main.product_detail': 900,
+        'main.news': 300,
+        'main.news_item': 900,
+    }
+
+    # Кэш фрагментов шаблонов ({% cache %}): URL как у SEARCH_CACHE_URL, пустая строка - выключен
+    FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL', 'memory://')
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 500))
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+
+    # Сколько лучших совпадений из индекса пересчитывается ранжированием
+    SEARCH_RANK_WINDOW = int(os.environ.get('SEARCH_RANK_WINDOW', 500))
+
+    # Курсорная пагинация каталога, новостей и списков админки (ссылки "вперед/назад" без OFFSET)
+    CURSOR_PAGINATION = os.environ.get('CURSOR_PAGINATION', '0') == '1'
+
+    # Как часто воркер перечитывает версии данных для инвалидации кэшей (секунды)
+    VERSION_CHECK_INTERVAL = float(os.environ.get('VERSION_CHECK_INTERVAL', 1))
+
+    # Метрики запросов: Server-Timing, строка лога app.requests, гистограммы на /admin/metrics
+    REQUEST_METRICS = os.environ.get('REQUEST_METRICS', '1') == '1'
+
+    # Журнал медленных SQL-запросов с планом выполнения (дашборд админки): порог в мс (0 - выключен),
+    # доля записываемых запросов из медленных и размер кольцевого буфера
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+    SLOW_QUERY_SAMPLE = float(os.environ.get('SLOW_QUERY_SAMPLE', 1.0))
+    SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', 100))
+
+    # Бюджет SQL-запросов на HTTP-запрос (для тестов и отладки N+1): 0 - проверка выключена
+    QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', 0))
+
+    # Размер шарда sitemap: диапазон id товаров/новостей в одном файле (лимит протокола - 50 000 URL)
+    SITEMAP_SHARD_SIZE = int(os.environ.get('SITEMAP_SHARD_SIZE', 10000))
+    # Сборка sitemap в файлы (flask sitemap build): папка и адрес сайта для ссылок
+    SITEMAP_FOLDER = os.environ.get('SITEMAP_FOLDER') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'app', 'static', 'sitemaps')
+    SITEMAP_BASE_URL = os.environ.get('SITEMAP_BASE_URL')
+
+    # Фоновая обработка загруженных изображений: процессы пула (0 - один поток без процессов),
+    # сколько заданий держать в пуле одновременно и сколько попыток до статуса failed
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+    IMAGE_QUEUE_SIZE = int(os.environ.get('IMAGE_QUEUE_SIZE', 8))
+    IMAGE_JOB_ATTEMPTS = int(os.environ.get('IMAGE_JOB_ATTEMPTS', 3))
+    # Предел размера загружаемого изображения в пикселях (проверяется по заголовку, до декодирования)
+    IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50_000_000))
+    # Дисковый кэш производных по запросу (/img/<preset>/...): папка и предел размера
+    IMAGE_CACHE_FOLDER = os.environ.get('IMAGE_CACHE_FOLDER') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'app', 'static', 'uploads', 'cache')
+    IMAGE_CACHE_MAX_MB = int(os.environ.get('IMAGE_CACHE_MAX_MB', 512))
+
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
 
     # Логирование
@@ -1,14 +1,16 @@
 from app import create_app, db
 from app.models import User, Category, Brand, Country, Product, News, Setting, SeoMeta
 from app.utilities.helpers import transliterate
+from app.utilities.migrations import upgrade
 import os
 
 
 def init_database():
     app = create_app()
     with app.app_context():
-        # Создаем все таблицы
+        # Создаем все таблицы и применяем миграции схемы (в новой базе они только отмечаются)
         db.create_all()
+        upgrade()
 
         # Проверяем, есть ли уже данные
         if User.query.first() is None: